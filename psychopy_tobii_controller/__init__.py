@@ -6,3 +6,4 @@
 # 
 
 from .core import tobii_controller
+from .multi import tobii_multi_controller
@@ -0,0 +1,319 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import sys
+import threading
+import numpy as np
+
+
+class shared_ring_buffer:
+    """
+    Ring buffer of raw gaze samples in shared memory
+    (multiprocessing.shared_memory).
+
+    The memory block starts with a header of 8 int64 values followed by
+    a (capacity, 9) float64 array.  Header[0] is the total number of
+    samples written so far and header[1] is the capacity.  Each row holds
+    (t, lx, ly, lp, lv, rx, ry, rp, rv) as in
+    :class:`~psychopy_tobii_controller.buffer.gaze_buffer`.
+
+    There must be only one writer.  The writer fills a row before it
+    increments the count, so readers never see incomplete rows.  If a
+    reader falls behind by more than capacity samples, the oldest
+    samples are lost (see :func:`read`).
+    """
+
+    header_size = 8
+
+    def __init__(self, capacity=None, name=None):
+        """
+        Create a new buffer (if name is None) or attach to an existing one.
+
+        :param int capacity: Number of rows.  Required when creating a buffer.
+        :param str name: Name of an existing shared memory block.
+        """
+
+        from multiprocessing import shared_memory
+
+        if name is None:
+            capacity = int(capacity)
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=8*(self.header_size+capacity*9))
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.header = np.ndarray((self.header_size,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[1] = capacity
+        self.capacity = int(self.header[1])
+        self.data = np.ndarray((self.capacity, 9), dtype=np.float64, buffer=self.shm.buf,
+                               offset=8*self.header_size)
+
+
+    @property
+    def name(self):
+        return self.shm.name
+
+
+    @property
+    def count(self):
+        """
+        Total number of samples written so far.
+        """
+
+        return int(self.header[0])
+
+
+    def append(self, record):
+        """
+        Write a sample.  Only the writer may call this method.
+
+        :param record: Sequence of 9 values.
+        """
+
+        n = int(self.header[0])
+        self.data[n % self.capacity] = record
+        self.header[0] = n+1
+
+
+    def latest(self):
+        """
+        Get the latest sample as a view of shared memory (not a copy),
+        or None if no sample has been written.
+        """
+
+        n = int(self.header[0])
+        if n == 0:
+            return None
+        return self.data[(n-1) % self.capacity]
+
+
+    def read(self, start, end=None):
+        """
+        Copy samples from start to end (total count of samples).
+        Returned value is a tuple of (samples, first) where first is the
+        index of the first sample actually returned.  first is larger than
+        start if samples have been overwritten.
+
+        :param int start: Index of the first sample.
+        :param int end: Index after the last sample.  If None, all
+            available samples are read.
+        """
+
+        if end is None:
+            end = int(self.header[0])
+        start = max(start, end-self.capacity)
+        if end <= start:
+            return np.empty((0, 9)), start
+        i, j = start % self.capacity, end % self.capacity
+        if i < j:
+            samples = self.data[i:j].copy()
+        else:
+            samples = np.concatenate((self.data[i:], self.data[:j]))
+        # rows overwritten while copying are discarded.
+        overwritten = int(self.header[0])-self.capacity-start
+        if overwritten > 0:
+            samples = samples[overwritten:]
+            start += overwritten
+        return samples, start
+
+
+    def close(self):
+        """
+        Detach from shared memory.  The memory block is released if this
+        object created it.
+        """
+
+        self.header = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _acquisition_main(address, shm_name, ready, stop):
+    """
+    Entry point of the acquisition process.
+    """
+
+    import tobii_research
+
+    ring = shared_ring_buffer(name=shm_name)
+
+    def on_gaze_data(gaze_data):
+        left = gaze_data.left_eye
+        right = gaze_data.right_eye
+        ring.append((gaze_data.system_time_stamp,
+                     left.gaze_point.position_on_display_area[0],
+                     left.gaze_point.position_on_display_area[1],
+                     left.pupil.diameter,
+                     left.gaze_point.validity,
+                     right.gaze_point.position_on_display_area[0],
+                     right.gaze_point.position_on_display_area[1],
+                     right.pupil.diameter,
+                     right.gaze_point.validity))
+
+    try:
+        eyetracker = tobii_research.EyeTracker(address)
+        eyetracker.subscribe_to(tobii_research.EYETRACKER_GAZE_DATA, on_gaze_data)
+        ready.set()
+        stop.wait()
+        eyetracker.unsubscribe_from(tobii_research.EYETRACKER_GAZE_DATA)
+    finally:
+        ring.close()
+
+
+class acquisition_process:
+    """
+    Receive gaze data from Tobii in a child process.
+
+    The child process owns the subscription to gaze data and writes samples
+    to a :class:`shared_ring_buffer`, so Tobii's callback does not compete
+    with rendering for the GIL of the experiment process.  In the
+    experiment process, a thread copies new samples from the ring buffer
+    to the gaze buffer of the controller in batches (one vectorized copy
+    per interval instead of one Python callback per sample).
+
+    Sample hooks registered with a batch function (the sampling monitor,
+    AOIs, gaze filters and asyncio streams) are called once per block.
+    Other hooks (e.g. SAMPLE stages of the pipeline) are still called for
+    each sample by this thread, which costs about 1 us per sample plus the
+    cost of the hooks in the experiment process.  Remove such hooks if the
+    experiment process must be kept idle.
+
+    multiprocessing.shared_memory is required, so this class is not
+    available on Python 3.7.
+
+    Usually, users don't have to use this class directly.  Call
+    tobii_controller.subscribe(out_of_process=True).
+    """
+
+    def __init__(self, controller, capacity=131072, interval=0.002):
+        """
+        :param controller: :class:`~psychopy_tobii_controller.tobii_controller` object.
+        :param int capacity: Number of samples in the ring buffer.
+            Default value is 131072 (about 109 s at 1200 Hz).
+        :param float interval: Interval of copying samples to the gaze
+            buffer (s).  Default value is 0.002.
+        """
+
+        if sys.version_info < (3, 8):
+            raise RuntimeError('psychopy_tobii_controller: out_of_process requires Python 3.8 or later '
+                               '(multiprocessing.shared_memory).')
+
+        self.controller = controller
+        self.capacity = capacity
+        self.interval = interval
+        self.ring = None
+        self.dropped = 0
+        self._cursor = 0
+        self._process = None
+        self._thread = None
+        self._stop = None
+        self._thread_stop = threading.Event()
+
+
+    def start(self, timeout=10.0):
+        """
+        Start the acquisition process.  RuntimeError is raised if the
+        process fails to subscribe to gaze data within timeout (s).
+        """
+
+        import multiprocessing
+
+        # spawn is safe with OpenGL contexts and threads of PsychoPy.
+        context = multiprocessing.get_context('spawn')
+        self.ring = shared_ring_buffer(self.capacity)
+        self._cursor = 0
+        self.dropped = 0
+        ready = context.Event()
+        self._stop = context.Event()
+        self._process = context.Process(
+            target=_acquisition_main,
+            args=(self.controller.eyetracker.address, self.ring.name, ready, self._stop),
+            daemon=True)
+        self._process.start()
+        if not ready.wait(timeout):
+            self._stop.set()
+            self._process.join(1.0)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+            self.ring.close()
+            self.ring = None
+            raise RuntimeError('psychopy_tobii_controller: failed to start acquisition process.')
+
+        self._thread_stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the acquisition process.  Remaining samples are copied to the
+        gaze buffer.
+        """
+
+        if self._process is None:
+            return
+        self._stop.set()
+        self._process.join(5.0)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self._thread_stop.set()
+        self._thread.join()
+        self._thread = None
+        self.update()
+        self.ring.close()
+        self.ring = None
+
+
+    def _run(self):
+        while not self._thread_stop.wait(self.interval):
+            self.update()
+
+
+    def update(self):
+        """
+        Copy new samples from the ring buffer to the gaze buffer of the
+        controller and call sample hooks (batch functions of the hooks if
+        available).  Usually, users don't have to call this method.
+        """
+
+        samples, first = self.ring.read(self._cursor)
+        self.dropped += first-self._cursor
+        self._cursor = first+len(samples)
+        if len(samples) == 0:
+            return
+        self.controller.gaze_data.extend(samples)
+        batch_hooks = self.controller._batch_hooks
+        hooks = []
+        for hook in self.controller._sample_hooks:
+            if hook in batch_hooks:
+                batch_hooks[hook](samples)
+            else:
+                hooks.append(hook)
+        if hooks:
+            for record in samples.tolist():
+                record = tuple(record)
+                for hook in hooks:
+                    hook(record)
+
+
+    def latest(self):
+        """
+        Get the latest sample in the ring buffer (view of shared memory),
+        or None if no sample is available.
+        """
+
+        return None if self.ring is None else self.ring.latest()
@@ -0,0 +1,238 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+import asyncio
+import weakref
+import numpy as np
+
+
+class gaze_stream:
+    """
+    Asynchronous iterator of batches of raw gaze samples.
+
+    Samples are not passed to the event loop one by one.  Tobii's callback
+    thread only wakes the event loop up (at most once per interval and only
+    if the previous wakeup has been handled), and the consumer reads all
+    new samples from the gaze buffer at once.  Therefore, the number of
+    wakeups per second is bounded by 1/interval regardless of the sampling
+    rate.
+
+    Each batch is a numpy.ndarray of shape (n, 9) that holds
+    (t, lx, ly, lp, lv, rx, ry, rp, rv).  Batches are read-only views of
+    the gaze buffer.  Iteration stops when recording is stopped.
+
+    If the consumer is slower than Tobii, unread samples accumulate in
+    the gaze buffer.  If max_pending is given, older samples beyond
+    max_pending are skipped and counted in :attr:`dropped`.
+
+    The stream stops receiving wakeups when iteration stops, when
+    :func:`aclose` is called or when the stream is garbage-collected.
+    Use the stream as an asynchronous context manager to stop wakeups
+    as soon as the loop is left by break or an exception.
+
+    *Example* ::
+
+        async with controller.stream() as stream:
+            async for batch in stream:
+                process(batch)
+    """
+
+    def __init__(self, controller, interval=0.01, max_pending=None, max_batch=None):
+        """
+        :param controller: :class:`~psychopy_tobii_controller.tobii_controller` object.
+        :param float interval: Minimum interval between wakeups of the
+            event loop (s).  Default value is 0.01.
+        :param int max_pending: Maximum number of unread samples.
+            If None, no sample is skipped.  Default value is None.
+        :param int max_batch: Maximum number of samples in a batch.
+            If None, all unread samples are returned.  Default value is None.
+        """
+
+        self.controller = controller
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.dropped = 0
+        self.wakeups = 0
+        self._buffer = None
+        self._cursor = 0
+        self._loop = None
+        self._hook = None
+        self._event = None
+        self._pending = False
+        self._last_wakeup = 0.0
+
+
+    def _wakeup(self):
+        # called from Tobii's callback thread
+        if self._pending:
+            return
+        now = time.perf_counter()
+        if now-self._last_wakeup < self.interval:
+            return
+        self._pending = True
+        self._last_wakeup = now
+        self.wakeups += 1
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # the event loop has been closed.
+            self.close()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            self._hook, batch_hook = _make_hooks(self)
+            self.controller.add_sample_hook(self._hook, batch_hook)
+
+        while True:
+            # clear before reading so that a wakeup during reading is not lost.
+            self._event.clear()
+            self._pending = False
+
+            buffer = self.controller.gaze_data
+            if buffer is not self._buffer:
+                self._buffer = buffer
+                self._cursor = 0
+            n = len(buffer)
+            if self.max_pending is not None and n-self._cursor > self.max_pending:
+                self.dropped += n-self._cursor-self.max_pending
+                self._cursor = n-self.max_pending
+            if n > self._cursor:
+                end = n if self.max_batch is None else min(n, self._cursor+self.max_batch)
+                batch = buffer[self._cursor:end]
+                self._cursor = end
+                batch.flags.writeable = False
+                return batch
+
+            if not self.controller.recording:
+                self.close()
+                raise StopAsyncIteration
+
+            # samples received just before the rate limit are picked up
+            # by the timer.  asyncio.wait_for() is not used here because
+            # it may swallow cancellation of the caller in old Pythons.
+            timer = self._loop.call_later(2*self.interval, self._event.set)
+            try:
+                await self._event.wait()
+            finally:
+                timer.cancel()
+
+
+    def close(self):
+        """
+        Stop receiving wakeups from Tobii's callback thread.
+        This is called when iteration stops, when the stream is used as
+        an asynchronous context manager and exits, and when the stream
+        is garbage-collected.
+        """
+
+        hook = self._hook
+        if hook is not None:
+            self._hook = None
+            self.controller.remove_sample_hook(hook)
+
+
+    async def aclose(self):
+        """
+        Coroutine version of :func:`close`.
+        """
+
+        self.close()
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _make_hooks(stream):
+    """
+    Make sample hooks of a stream.  The hooks refer to the stream weakly,
+    so that a stream left by break or an exception in an async-for loop
+    is garbage-collected and its hooks are removed.
+    """
+
+    ref = weakref.ref(stream)
+    controller = stream.controller
+
+    def on_sample(record):
+        stream = ref()
+        if stream is None:
+            controller.remove_sample_hook(on_sample)
+        else:
+            stream._wakeup()
+
+    def on_batch(samples):
+        on_sample(None)
+
+    return on_sample, on_batch
+
+
+async def wait_fixation(controller, duration=200.0, max_dispersion=None, aoi=None,
+                        timeout=None, interval=0.01):
+    """
+    Wait until gaze is stable for duration.
+    Returned value is the mean gaze position (left_x, left_y, right_x,
+    right_y) over duration in PsychoPy's coordinates, or None if timeout
+    expires or recording is stopped.
+
+    If aoi is given, gaze must stay in the AOI registered to the controller.
+    If max_dispersion is given, standard deviation of gaze position of
+    each eye must be smaller than max_dispersion (PsychoPy's units).
+    Conditions are tested at every batch of samples, not at every sample.
+
+    :param controller: :class:`~psychopy_tobii_controller.tobii_controller` object.
+    :param float duration: Duration of fixation (ms).  Default value is 200.0.
+    :param float max_dispersion: Maximum standard deviation of gaze position.
+    :param aoi: Name of AOI.
+    :param float timeout: Timeout (s).  If None, wait forever.
+    :param float interval: Interval of tests (s).  Default value is 0.01.
+    """
+
+    if max_dispersion is None and aoi is None:
+        raise ValueError('max_dispersion or aoi must be specified.')
+
+    async def wait():
+        async with gaze_stream(controller, interval, max_pending=1) as stream:
+            async for batch in stream:
+                gaze_data = controller.gaze_data
+                if len(gaze_data) == 0 or gaze_data[-1][0]-gaze_data[0][0] < duration*1000.0:
+                    continue
+                if aoi is not None and controller.get_aoi_dwell(aoi) < duration:
+                    continue
+                if max_dispersion is not None:
+                    std = np.array(controller.get_gaze_window(duration, 'std'))
+                    if np.all(np.isnan(std)) or np.nanmax(std) >= max_dispersion:
+                        continue
+                return controller.get_gaze_window(duration, 'mean')
+        return None
+
+    try:
+        return await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        return None
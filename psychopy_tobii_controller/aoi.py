@@ -0,0 +1,494 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import threading
+import numpy as np
+
+RECT = 0
+CIRCLE = 1
+POLYGON = 2
+
+
+class _grid_index:
+    """
+    Uniform grid over the AOI bounding boxes.  Each cell holds AOIs whose
+    bounding box overlaps the cell and the edges of polygons among them,
+    so that a point is tested only against nearby AOIs.  AOIs and edges
+    of all cells are stored in flat arrays sorted by cell (the range of
+    cell c is ptr[c]:ptr[c+1]).
+    """
+
+    def __init__(self, bounds, grid_size, kind, bbox, circle, edges, edge_owner):
+        n = len(bbox)
+        if bounds is None:
+            if n > 0:
+                bounds = (bbox[:,0].min(), bbox[:,1].min(), bbox[:,2].max(), bbox[:,3].max())
+            else:
+                bounds = (0.0, 0.0, 1.0, 1.0)
+        if grid_size is None:
+            size = int(np.clip(np.ceil(np.sqrt(n)), 1, 256))
+            grid_size = (size, size)
+        self.bounds = bounds
+        self.grid_size = grid_size
+        self.cell_size = (max(bounds[2]-bounds[0], 1e-12)/grid_size[0],
+                          max(bounds[3]-bounds[1], 1e-12)/grid_size[1])
+        n_cells = grid_size[0]*grid_size[1]
+
+        # (cell, AOI) pairs
+        cx0, cy0 = self.cell_of(bbox[:,0], bbox[:,1])
+        cx1, cy1 = self.cell_of(bbox[:,2], bbox[:,3])
+        nx = cx1-cx0+1
+        count = nx*(cy1-cy0+1)
+        aoi = np.repeat(np.arange(n), count)
+        local = np.arange(len(aoi)) - np.repeat(np.cumsum(count)-count, count)
+        cell = (cy0[aoi] + local//nx[aoi])*grid_size[0] + cx0[aoi] + local%nx[aoi]
+        order = np.lexsort((aoi, cell))
+        aoi = aoi[order]
+        cell = cell[order]
+        self.ptr = np.concatenate(([0], np.cumsum(np.bincount(cell, minlength=n_cells))))
+        self.aoi = aoi
+        self.kind = kind[aoi]
+        self.bbox = bbox[aoi]
+        self.circle = circle[aoi]
+
+        # (cell, edge) pairs.  edge_owner is sorted in ascending order.
+        edge_start = np.searchsorted(edge_owner, np.arange(n))
+        edge_count = np.bincount(edge_owner, minlength=n)
+        pair_edge_count = edge_count[aoi]
+        pair = np.repeat(np.arange(len(aoi)), pair_edge_count)
+        local = np.arange(len(pair)) - np.repeat(np.cumsum(pair_edge_count)-pair_edge_count,
+                                                 pair_edge_count)
+        self.edges = edges[edge_start[aoi[pair]] + local].reshape(-1,4)
+        self.edge_owner = pair - self.ptr[cell[pair]]
+        self.edge_ptr = np.concatenate(([0], np.cumsum(np.bincount(cell[pair], minlength=n_cells))))
+
+
+    def cell_of(self, x, y):
+        cx = np.clip(np.floor((np.asarray(x)-self.bounds[0])/self.cell_size[0]),
+                     0, self.grid_size[0]-1).astype(int)
+        cy = np.clip(np.floor((np.asarray(y)-self.bounds[1])/self.cell_size[1]),
+                     0, self.grid_size[1]-1).astype(int)
+        return cx, cy
+
+
+    def in_bounds(self, x, y):
+        return (self.bounds[0] <= x) & (x <= self.bounds[2]) & \
+               (self.bounds[1] <= y) & (y <= self.bounds[3])
+
+
+    def _test(self, c, x, y):
+        """
+        Test points (x, y) against AOIs in cell c.
+        Returned value is a boolean array of shape (n_points, n_aois_in_cell).
+        """
+        s, e = self.ptr[c], self.ptr[c+1]
+        x = x[:,np.newaxis]
+        y = y[:,np.newaxis]
+
+        bbox = self.bbox[s:e]
+        hit = (bbox[:,0] <= x) & (x <= bbox[:,2]) & (bbox[:,1] <= y) & (y <= bbox[:,3])
+
+        kind = self.kind[s:e]
+        is_circle = kind == CIRCLE
+        if is_circle.any():
+            circle = self.circle[s:e]
+            in_circle = (x-circle[:,0])**2 + (y-circle[:,1])**2 <= circle[:,2]**2
+            hit &= ~is_circle | in_circle
+
+        is_polygon = kind == POLYGON
+        if is_polygon.any():
+            # even-odd rule (ray casting toward +x)
+            es, ee = self.edge_ptr[c], self.edge_ptr[c+1]
+            edges = self.edges[es:ee]
+            x0, y0, x1, y1 = edges[:,0], edges[:,1], edges[:,2], edges[:,3]
+            straddle = (y0 > y) != (y1 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cross = straddle & (x < x0 + (x1-x0)*(y-y0)/(y1-y0))
+            n_aois = e-s
+            point, edge = np.nonzero(cross)
+            crossings = np.bincount(point*n_aois + self.edge_owner[es:ee][edge],
+                                    minlength=len(x)*n_aois).reshape(len(x), n_aois)
+            hit &= ~is_polygon | (crossings % 2 == 1)
+
+        return hit
+
+
+    def contains(self, x, y):
+        if not self.in_bounds(x, y):
+            return np.empty(0, dtype=np.intp)
+        cx, cy = self.cell_of(x, y)
+        c = cy*self.grid_size[0]+cx
+        hit = self._test(c, np.array([x], dtype=float), np.array([y], dtype=float))[0]
+        return self.aoi[self.ptr[c]:self.ptr[c+1]][hit]
+
+
+    def contains_points(self, x, y, chunk_size=4096):
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        with np.errstate(invalid='ignore'):
+            valid = np.nonzero(self.in_bounds(x, y))[0]
+        cx, cy = self.cell_of(x[valid], y[valid])
+        cell = cy*self.grid_size[0]+cx
+        order = np.argsort(cell, kind='stable')
+        valid = valid[order]
+        cell = cell[order]
+        cells, starts = np.unique(cell, return_index=True)
+        ends = np.append(starts[1:], len(cell))
+
+        points = []
+        aois = []
+        for c, s, e in zip(cells, starts, ends):
+            if self.ptr[c] == self.ptr[c+1]:
+                continue
+            for cs in range(s, e, chunk_size):
+                idx = valid[cs:min(cs+chunk_size, e)]
+                p, a = np.nonzero(self._test(c, x[idx], y[idx]))
+                points.append(idx[p])
+                aois.append(self.aoi[self.ptr[c]+a])
+
+        if len(points) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        points = np.concatenate(points)
+        aois = np.concatenate(aois)
+        order = np.lexsort((aois, points))
+        return points[order], aois[order]
+
+
+class aoi_set:
+    """
+    Registry of areas of interest (AOIs) with a uniform grid index.
+
+    Rectangles, circles and polygons can be registered.  Positions are
+    given in any 2D coordinate system.  Points outside of the bounds of
+    the grid are never contained in AOIs.  By default, the grid covers
+    all registered AOIs.
+
+    In addition to hit-testing, this object accumulates dwell time,
+    number of samples and number of entries of each AOI from successive
+    gaze samples passed to
+    :func:`~psychopy_tobii_controller.aoi.aoi_set.update`.
+    """
+
+    def __init__(self, bounds=None, grid_size=None):
+        """
+        :param bounds: Region covered by the grid (xmin, ymin, xmax, ymax).
+            If None, bounding box of all AOIs is used.  Default value is None.
+        :param grid_size: Number of cells (horizontal, vertical).
+            If None, about the same number of cells as AOIs is used.
+            Default value is None.
+        """
+
+        self.bounds = None if bounds is None else tuple(float(v) for v in bounds)
+        self.grid_size = None if grid_size is None else (int(grid_size[0]), int(grid_size[1]))
+        self._lock = threading.Lock()
+        self._version = 0
+        self.clear()
+
+
+    def clear(self):
+        """
+        Remove all AOIs.
+        """
+
+        with self._lock:
+            self.names = []
+            self._kind = np.empty(0, dtype=int)
+            self._bbox = np.empty((0,4))
+            self._circle = np.empty((0,3))
+            self._edges = np.empty((0,4))
+            self._edge_owner = np.empty(0, dtype=np.intp)
+            self._index = None
+            self._version += 1
+            self._reset_counters()
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def _add(self, name, kind, bbox, circle=(np.nan, np.nan, np.nan), vertices=None):
+        with self._lock:
+            if name in self.names:
+                raise ValueError('AOI ({}) already exists.'.format(name))
+            n = len(self.names)
+            self.names = self.names + [name]
+            self._kind = np.append(self._kind, kind)
+            self._bbox = np.vstack((self._bbox, bbox))
+            self._circle = np.vstack((self._circle, circle))
+            if vertices is not None:
+                edges = np.hstack((vertices, np.roll(vertices, -1, axis=0)))
+                self._edges = np.vstack((self._edges, edges))
+                self._edge_owner = np.append(self._edge_owner, np.full(len(edges), n, dtype=np.intp))
+            self._index = None
+            self._version += 1
+            self._dwell_time = np.append(self._dwell_time, 0.0)
+            self._sample_count = np.append(self._sample_count, 0)
+            self._entry_count = np.append(self._entry_count, 0)
+            self._entry_time = np.append(self._entry_time, np.nan)
+            self._inside = np.append(self._inside, False)
+
+
+    def add_rect(self, name, xmin, ymin, xmax, ymax):
+        """
+        Add a rectangular AOI.
+
+        :param name: Name of the AOI.
+        :param float xmin: Left edge.
+        :param float ymin: Lower edge.
+        :param float xmax: Right edge.
+        :param float ymax: Upper edge.
+        """
+
+        self._add(name, RECT, (min(xmin, xmax), min(ymin, ymax), max(xmin, xmax), max(ymin, ymax)))
+
+
+    def add_circle(self, name, x, y, radius):
+        """
+        Add a circular AOI.
+
+        :param name: Name of the AOI.
+        :param float x: Horizontal position of the center.
+        :param float y: Vertical position of the center.
+        :param float radius: Radius.
+        """
+
+        self._add(name, CIRCLE, (x-radius, y-radius, x+radius, y+radius), (x, y, radius))
+
+
+    def add_polygon(self, name, vertices):
+        """
+        Add a polygonal AOI.  Self-intersecting polygons are tested by
+        the even-odd rule.
+
+        :param name: Name of the AOI.
+        :param vertices: Array-like of shape (n_vertices, 2).
+        """
+
+        vertices = np.asarray(vertices, dtype=float).reshape(-1,2)
+        if len(vertices) < 3:
+            raise ValueError('polygon must have at least 3 vertices.')
+        bbox = (vertices[:,0].min(), vertices[:,1].min(), vertices[:,0].max(), vertices[:,1].max())
+        self._add(name, POLYGON, bbox, vertices=vertices)
+
+
+    def remove(self, name):
+        """
+        Remove an AOI.  Counters of other AOIs are kept.  Dwell time of
+        other AOIs between the latest sample and the next sample is counted
+        as usual.
+
+        :param name: Name of the AOI.
+        """
+
+        with self._lock:
+            i = self.names.index(name)
+            keep = np.arange(len(self.names)) != i
+            self.names = [n for n in self.names if n != name]
+            self._kind = self._kind[keep]
+            self._bbox = self._bbox[keep]
+            self._circle = self._circle[keep]
+            keep_edges = self._edge_owner != i
+            self._edges = self._edges[keep_edges]
+            self._edge_owner = self._edge_owner[keep_edges]
+            self._edge_owner[self._edge_owner > i] -= 1
+            self._index = None
+            self._version += 1
+            self._dwell_time = self._dwell_time[keep]
+            self._sample_count = self._sample_count[keep]
+            self._entry_count = self._entry_count[keep]
+            self._entry_time = self._entry_time[keep]
+            # indices of the AOIs that contained the latest sample are
+            # shifted so that the next sample credits dwell time of the
+            # interval to them and does not count a new entry.
+            last_hits = self._last_hits[self._last_hits != i]
+            last_hits[last_hits > i] -= 1
+            self._last_hits = last_hits
+            self._inside = np.zeros(len(self.names), dtype=bool)
+            self._inside[last_hits] = True
+
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = _grid_index(self.bounds, self.grid_size,
+                        self._kind, self._bbox, self._circle, self._edges, self._edge_owner)
+                index = self._index
+        return index
+
+
+    def contains(self, x, y):
+        """
+        Get indices of AOIs that contain a point.
+        Returned value is a numpy.ndarray of indices into
+        :attr:`names`.  If x or y is NaN, no AOI contains the point.
+
+        :param float x: Horizontal position.
+        :param float y: Vertical position.
+        """
+
+        if np.isnan(x) or np.isnan(y):
+            return np.empty(0, dtype=np.intp)
+        return self._get_index().contains(x, y)
+
+
+    def contains_points(self, x, y):
+        """
+        Test many points at once.
+        Returned value is a tuple of numpy.ndarray (point_indices, aoi_indices)
+        that lists every pair of a point and an AOI containing the point
+        (i.e. a sparse boolean matrix in coordinate format), sorted by
+        point_indices.  Points with NaN are not contained in any AOI.
+
+        :param x: Array-like of horizontal positions.
+        :param y: Array-like of vertical positions.
+        """
+
+        return self._get_index().contains_points(x, y)
+
+
+    def get_names(self, indices):
+        """
+        Convert indices of AOIs to a list of names.
+
+        :param indices: Sequence of indices.
+        """
+
+        names = self.names
+        return [names[i] for i in indices]
+
+
+    def _reset_counters(self):
+        n = len(self.names)
+        self._dwell_time = np.zeros(n)
+        self._sample_count = np.zeros(n, dtype=int)
+        self._entry_count = np.zeros(n, dtype=int)
+        self._entry_time = np.full(n, np.nan)
+        self._inside = np.zeros(n, dtype=bool)
+        self._last_t = None
+        self._last_hits = np.empty(0, dtype=np.intp)
+
+
+    def reset_counters(self):
+        """
+        Reset dwell time, number of samples and number of entries.
+        """
+
+        with self._lock:
+            self._reset_counters()
+
+
+    def update(self, t, x, y):
+        """
+        Update counters with a new gaze sample.
+        The interval from the previous sample is added to dwell time of
+        AOIs that contained the previous sample.
+        Returned value is indices of AOIs that contain (x, y).
+
+        :param float t: Timestamp.  Dwell time is measured in this unit.
+        :param float x: Horizontal gaze position.
+        :param float y: Vertical gaze position.
+        """
+
+        version = self._version
+        hits = self.contains(x, y)
+        with self._lock:
+            if version != self._version:
+                # AOIs were changed while hits were calculated.
+                return np.empty(0, dtype=np.intp)
+            if self._last_t is not None:
+                self._dwell_time[self._last_hits] += t-self._last_t
+            self._sample_count[hits] += 1
+            entered = hits[~self._inside[hits]]
+            self._entry_count[entered] += 1
+            self._entry_time[entered] = t
+            self._inside[self._last_hits] = False
+            self._inside[hits] = True
+            self._last_t = t
+            self._last_hits = hits
+        return hits
+
+
+    def update_batch(self, t, x, y):
+        """
+        Update counters with a block of gaze samples at once.  The result
+        is the same as calling :func:`update` for each sample.
+        Returned value is indices of AOIs that contain the last sample.
+
+        :param t: Array-like of timestamps in ascending order.
+        :param x: Array-like of horizontal gaze positions.
+        :param y: Array-like of vertical gaze positions.
+        """
+
+        t = np.asarray(t, dtype=float)
+        n = len(t)
+        if n == 0:
+            return np.empty(0, dtype=np.intp)
+        version = self._version
+        point, aoi = self.contains_points(x, y)
+        with self._lock:
+            if version != self._version:
+                # AOIs were changed while hits were calculated.
+                return np.empty(0, dtype=np.intp)
+            n_aois = len(self.names)
+            # the interval to the next sample is added to AOIs that
+            # contain the sample.
+            interval = np.diff(t)
+            inner = point < n-1
+            self._dwell_time += np.bincount(aoi[inner], weights=interval[point[inner]],
+                                            minlength=n_aois)
+            if self._last_t is not None:
+                self._dwell_time[self._last_hits] += t[0]-self._last_t
+            self._sample_count += np.bincount(aoi, minlength=n_aois)
+
+            # a hit is an entry if the AOI did not contain the previous sample.
+            key = point*n_aois+aoi
+            was_inside = np.where(point == 0, self._inside[aoi], np.isin(key-n_aois, key))
+            entered = ~was_inside
+            self._entry_count += np.bincount(aoi[entered], minlength=n_aois)
+            last_entry = np.full(n_aois, -1)
+            np.maximum.at(last_entry, aoi[entered], point[entered])
+            self._entry_time[last_entry >= 0] = t[last_entry[last_entry >= 0]]
+
+            hits = np.sort(aoi[point == n-1])
+            self._inside[:] = False
+            self._inside[hits] = True
+            self._last_t = t[-1]
+            self._last_hits = hits
+        return hits
+
+
+    def get_current_dwell(self, name):
+        """
+        Get how long gaze has stayed in an AOI without leaving it, i.e.
+        time from the entry to the latest sample.  If gaze is not in the
+        AOI, 0.0 is returned.  Cost is O(1).
+
+        :param name: Name of the AOI.
+        """
+
+        with self._lock:
+            i = self.names.index(name)
+            if not self._inside[i]:
+                return 0.0
+            return float(self._last_t-self._entry_time[i])
+
+
+    def get_counters(self):
+        """
+        Get counters as a dict object that maps name of AOI to a tuple of
+        (dwell_time, n_samples, n_entries).
+        """
+
+        with self._lock:
+            return dict(zip(self.names, zip(self._dwell_time.tolist(),
+                                            self._sample_count.tolist(),
+                                            self._entry_count.tolist())))
@@ -0,0 +1,318 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import threading
+import numpy as np
+
+
+class gaze_buffer:
+    """
+    Append-only buffer of raw gaze samples received from Tobii.
+
+    Each row holds (t, lx, ly, lp, lv, rx, ry, rp, rv) where t is Tobii's
+    system timestamp (microseconds), lx/ly/rx/ry are positions on the
+    display area, lp/rp are pupil diameters and lv/rv are validity flags.
+
+    The buffer is written by a single thread (Tobii's callback thread) and
+    can be read from any thread without locking.  A row is filled before
+    the number of samples is incremented, and the storage array is only
+    replaced (when the buffer grows) before the count exceeds the size of
+    the old array.  Readers get the count first and the array second, so
+    every row they see is complete.
+
+    Indexing works like a list of tuples: buffer[-1][0] is the timestamp
+    of the latest sample and buffer[a:b] is a (b-a, 9) numpy.ndarray view.
+
+    Running sums of gaze positions of valid samples are maintained for
+    each eye, so that statistics over a time window are calculated by
+    bisection of timestamps and a difference of two rows of sums.
+    """
+
+    n_columns = 9
+    # lx, ly, n_left, rx, ry, n_right, lx^2, ly^2, rx^2, ry^2
+    n_sums = 10
+
+    def __init__(self, capacity=65536):
+        """
+        :param int capacity: Initial number of rows.  The buffer is
+            enlarged automatically.  Default value is 65536.
+        """
+        capacity = max(int(capacity), 1)
+        self._data = np.empty((capacity, self.n_columns))
+        # row i holds sums of samples 0 to i-1.
+        self._sums = np.zeros((capacity+1, self.n_sums))
+        self._n = 0
+
+
+    def append(self, record):
+        """
+        Append a sample.  Only one thread may call this method.
+
+        :param record: Sequence of 9 values.
+        """
+        n = self._n
+        if n >= self._data.shape[0]:
+            self._reserve(n+1)
+        data = self._data
+        sums = self._sums
+        data[n] = record
+
+        t, lx, ly, lp, lv, rx, ry, rp, rv = record
+        if not lv or lx != lx or ly != ly:
+            lx = ly = 0.0
+            lv = 0
+        else:
+            lv = 1
+        if not rv or rx != rx or ry != ry:
+            rx = ry = 0.0
+            rv = 0
+        else:
+            rv = 1
+        sums[n+1] = sums[n]
+        sums[n+1] += (lx, ly, lv, rx, ry, rv, lx*lx, ly*ly, rx*rx, ry*ry)
+        self._n = n+1
+
+
+    def extend(self, records):
+        """
+        Append samples at once.  Only one thread may call this method.
+        This is much faster than calling append() for each sample.
+
+        :param records: numpy.ndarray of shape (n, 9).
+        """
+        records = np.asarray(records, dtype=float).reshape(-1, self.n_columns)
+        k = len(records)
+        if k == 0:
+            return
+        n = self._n
+        if n+k > self._data.shape[0]:
+            self._reserve(n+k)
+        data = self._data
+        sums = self._sums
+        data[n:n+k] = records
+
+        with np.errstate(invalid='ignore'):
+            lv = (records[:,4] != 0) & ~np.isnan(records[:,1]) & ~np.isnan(records[:,2])
+            rv = (records[:,8] != 0) & ~np.isnan(records[:,5]) & ~np.isnan(records[:,6])
+        values = np.zeros((k, self.n_sums))
+        values[:,0:2] = np.where(lv[:,np.newaxis], records[:,1:3], 0.0)
+        values[:,2] = lv
+        values[:,3:5] = np.where(rv[:,np.newaxis], records[:,5:7], 0.0)
+        values[:,5] = rv
+        values[:,6:8] = values[:,0:2]**2
+        values[:,8:10] = values[:,3:5]**2
+        sums[n+1:n+k+1] = sums[n] + np.cumsum(values, axis=0)
+        self._n = n+k
+
+
+    def _reserve(self, size):
+        n = self._n
+        capacity = self._data.shape[0]
+        while capacity < size:
+            capacity *= 2
+        new_data = np.empty((capacity, self.n_columns))
+        new_data[:n] = self._data[:n]
+        new_sums = np.zeros((capacity+1, self.n_sums))
+        new_sums[:n+1] = self._sums[:n+1]
+        self._sums = new_sums
+        self._data = new_data
+
+
+    def array(self):
+        """
+        Get all samples as a numpy.ndarray (view, not copy).
+        """
+        n = self._n
+        return self._data[:n]
+
+
+    def get_since(self, cursor):
+        """
+        Get samples appended after cursor.
+        Returned value is a tuple of (samples, new_cursor).
+        Pass new_cursor to the next call to receive only new samples.
+
+        :param int cursor: Number of samples already read.
+        """
+        n = self._n
+        return self._data[cursor:n], n
+
+
+    def get_window_sums(self, t_start, t_end=None):
+        """
+        Get sums over samples with timestamps in [t_start, t_end].
+        Returned value is a tuple of (sums, n_samples) where sums is a
+        numpy.ndarray of (lx, ly, n_left, rx, ry, n_right, lx^2, ly^2,
+        rx^2, ry^2) of valid samples.  Cost is O(log n).
+
+        :param float t_start: Start of the window (Tobii's system timestamp).
+        :param float t_end: End of the window.  If None, the window
+            continues to the latest sample.
+        """
+        n = self._n
+        data = self._data
+        sums = self._sums
+        t = data[:n,0]
+        start = np.searchsorted(t, t_start, side='left')
+        end = n if t_end is None else np.searchsorted(t, t_end, side='right')
+        end = max(start, end)
+        return sums[end]-sums[start], end-start
+
+
+    def __len__(self):
+        return self._n
+
+
+    def __getitem__(self, key):
+        n = self._n
+        return self._data[:n][key]
+
+
+class event_buffer:
+    """
+    Buffer of events recorded by
+    :func:`~psychopy_tobii_controller.tobii_controller.record_event`.
+
+    Timestamps, label indices and optional numeric values are stored in
+    numpy.ndarray objects.  Each distinct label string is stored only
+    once in self.labels (labels are interned), so recording the same
+    label every frame does not create new objects.  Events can be
+    appended from any thread.
+
+    For compatibility with older versions, buffer[i] returns a tuple of
+    (timestamp, label) followed by numeric values if any.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        :param int capacity: Initial number of events.  The buffer is
+            enlarged automatically.  Default value is 4096.
+        """
+        capacity = max(int(capacity), 1)
+        self._time = np.empty(capacity)
+        self._label = np.empty(capacity, dtype=np.int32)
+        self._values = np.empty((capacity, 0))
+        self._n = 0
+        self.labels = []
+        self._label_index = {}
+        self._lock = threading.Lock()
+
+
+    def append(self, t, label, values=None):
+        """
+        Append an event.
+
+        :param t: Timestamp.
+        :param str label: Label of the event.
+        :param values: Sequence of numbers associated with the event.
+            Default value is None.
+        """
+        with self._lock:
+            label_id = self._label_index.get(label)
+            if label_id is None:
+                label_id = self._label_index[label] = len(self.labels)
+                self.labels.append(label)
+
+            n = self._n
+            n_values = 0 if values is None else len(values)
+            if n >= len(self._time) or n_values > self._values.shape[1]:
+                self._resize(max(len(self._time)*(2 if n >= len(self._time) else 1), 1),
+                             max(n_values, self._values.shape[1]))
+
+            self._time[n] = t
+            self._label[n] = label_id
+            if self._values.shape[1] > 0:
+                self._values[n] = np.nan
+                if n_values > 0:
+                    self._values[n,:n_values] = values
+            self._n = n+1
+
+
+    def _resize(self, capacity, n_values):
+        n = self._n
+        new_time = np.empty(capacity)
+        new_label = np.empty(capacity, dtype=np.int32)
+        new_values = np.full((capacity, n_values), np.nan)
+        new_time[:n] = self._time[:n]
+        new_label[:n] = self._label[:n]
+        new_values[:n,:self._values.shape[1]] = self._values[:n]
+        self._time, self._label, self._values = new_time, new_label, new_values
+
+
+    def times(self):
+        """
+        Get timestamps of events as a numpy.ndarray.
+        """
+        n = self._n
+        return self._time[:n]
+
+
+    def label_ids(self):
+        """
+        Get indices of labels (in self.labels) of events as a numpy.ndarray.
+        """
+        n = self._n
+        return self._label[:n]
+
+
+    def values(self):
+        """
+        Get numeric values of events as a numpy.ndarray of shape
+        (n_events, n_values).  Missing values are numpy.nan.
+        """
+        n = self._n
+        return self._values[:n]
+
+
+    def format_events(self, index=None):
+        """
+        Format labels and numeric values of events for the data file.
+        Values are separated by tabs.  Returned value is a list of strings.
+
+        :param index: Indices of events to be formatted.  If None,
+            all events are formatted.
+        """
+        with self._lock:
+            n = self._n
+            labels = list(self.labels)
+            label_ids = self._label[:n]
+            values = self._values[:n]
+        if index is None:
+            index = range(n)
+
+        if values.shape[1] == 0:
+            return [labels[label_ids[i]] for i in index]
+
+        has_value = ~np.isnan(values)
+        n_values = np.where(has_value.any(axis=1),
+                            values.shape[1]-np.argmax(has_value[:,::-1], axis=1), 0)
+        return [labels[label_ids[i]] + ''.join(['\t%g' % v for v in values[i,:n_values[i]]])
+                for i in index]
+
+
+    def __len__(self):
+        return self._n
+
+
+    def __getitem__(self, index):
+        with self._lock:
+            if index < 0:
+                index += self._n
+            if not (0 <= index < self._n):
+                raise IndexError('event index out of range')
+            values = self._values[index]
+            values = tuple(values[:np.flatnonzero(~np.isnan(values)).max()+1]) \
+                if np.any(~np.isnan(values)) else ()
+            return (self._time[index], self.labels[self._label[index]]) + values
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,204 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import threading
+import numpy as np
+
+clock_names = ('system', 'device', 'psychopy', 'session')
+
+
+def map_timestamps(t, src, dst, fit):
+    """
+    Convert timestamps from one clock to another.
+
+    Following clocks are supported.
+
+    - 'system': Tobii's system timestamp (microseconds).
+    - 'device': Tobii's device timestamp (microseconds).
+    - 'psychopy': psychopy.core.getTime() (seconds).
+    - 'session': timestamp in the data file, i.e. milliseconds from the
+      beginning of the recording session.
+
+    Each clock is mapped to the system clock by a linear function.
+    The parameters are given by fit, which is a dict object returned by
+    :func:`~psychopy_tobii_controller.clock.clock_sync.get_fit` or
+    :func:`~psychopy_tobii_controller.utility.load_session_info`.
+
+    *Example* ::
+
+        t_psychopy = map_timestamps(gaze_data[:,TimeStamp],
+                                    'session', 'psychopy', fit)
+
+    :param t: Timestamp(s).  Scalar or array-like.
+    :param str src: Name of clock of t.
+    :param str dst: Name of clock to which t is converted.
+    :param dict fit: Dict object that maps name of clock to a tuple of
+        (slope, system0, clock0) so that
+        clock = clock0 + slope*(system - system0).
+    """
+
+    for name in (src, dst):
+        if name not in clock_names:
+            raise ValueError('clock must be one of {}'.format(', '.join(clock_names)))
+        if name != 'system' and name not in fit:
+            raise RuntimeError('no mapping for {} clock is available.'.format(name))
+
+    t = np.asarray(t, dtype=float)
+    if src == dst:
+        return t.copy()
+
+    if src == 'system':
+        system = t
+    else:
+        slope, system0, clock0 = fit[src]
+        system = system0 + (t - clock0)/slope
+
+    if dst == 'system':
+        return system
+    slope, system0, clock0 = fit[dst]
+    return clock0 + slope*(system - system0)
+
+
+class clock_sync:
+    """
+    Linear mapping between Tobii's device clock, Tobii's system clock
+    and PsychoPy's clock.
+
+    Time synchronization data sent by Tobii
+    (tobii_research.EYETRACKER_TIME_SYNCHRONIZATION_DATA) are stored in a
+    ring buffer with PsychoPy's clock read at the same time.  Linear fits
+    over the ring buffer are recalculated when they are requested after
+    new data arrived, so drift between clocks is corrected during long
+    sessions.
+    """
+
+    def __init__(self, get_system_time, get_psychopy_time, size=256):
+        """
+        :param get_system_time: Function that returns Tobii's system
+            timestamp (e.g. tobii_research.get_system_time_stamp).
+        :param get_psychopy_time: Function that returns PsychoPy's time
+            (e.g. psychopy.core.getTime).
+        :param int size: Size of the ring buffer.  Default value is 256.
+        """
+
+        self.get_system_time = get_system_time
+        self.get_psychopy_time = get_psychopy_time
+        # columns: system (request/response midpoint), device, system, psychopy
+        self._data = np.full((size, 4), np.nan)
+        self._count = 0
+        self._fit = None
+        self._lock = threading.Lock()
+        self.add_psychopy_reference()
+
+
+    def add_psychopy_reference(self):
+        """
+        Sample Tobii's system clock and PsychoPy's clock.
+        This is called automatically when time synchronization data
+        is received.
+        """
+
+        self._append((np.nan, np.nan)+self._read_clocks())
+
+
+    def on_time_synchronization_data(self, data):
+        """
+        Callback function for tobii_research.EYETRACKER_TIME_SYNCHRONIZATION_DATA.
+
+        Usually, users don't have to call this method.
+        """
+
+        system = (data.system_request_time_stamp + data.system_response_time_stamp)/2.0
+        self._append((system, data.device_time_stamp)+self._read_clocks())
+
+
+    def _read_clocks(self):
+        # take the middle of two system clock readings to reduce bias.
+        s1 = self.get_system_time()
+        p = self.get_psychopy_time()
+        s2 = self.get_system_time()
+        return ((s1+s2)/2.0, p)
+
+
+    def _append(self, row):
+        with self._lock:
+            self._data[self._count % self._data.shape[0]] = row
+            self._count += 1
+            self._fit = None
+
+
+    def get_fit(self):
+        """
+        Get parameters of linear mapping as a dict object.
+        See :func:`~psychopy_tobii_controller.clock.map_timestamps`.
+        """
+
+        with self._lock:
+            if self._fit is not None:
+                return self._fit
+            count = self._count
+            data = self._data[:min(count, self._data.shape[0])].copy()
+
+        fit = {}
+        for name, x_col, y_col in (('device', 0, 1), ('psychopy', 2, 3)):
+            valid = ~np.isnan(data[:,x_col])
+            x = data[valid, x_col]
+            y = data[valid, y_col]
+            if len(x) == 0:
+                continue
+            x0 = x.mean()
+            y0 = y.mean()
+            if len(x) == 1 or np.all(x == x0):
+                # nominal slope
+                slope = 1.0 if name == 'device' else 1e-6
+            else:
+                slope = np.sum((x-x0)*(y-y0))/np.sum((x-x0)**2)
+            fit[name] = (slope, x0, y0)
+
+        with self._lock:
+            if self._count == count:
+                self._fit = fit
+        return fit
+
+
+    def map_timestamps(self, t, src, dst, session_start=None):
+        """
+        Convert timestamps using the current linear fit.
+        See :func:`~psychopy_tobii_controller.clock.map_timestamps`.
+
+        :param t: Timestamp(s).  Scalar or array-like.
+        :param str src: Name of clock of t.
+        :param str dst: Name of clock to which t is converted.
+        :param session_start: Tobii's system timestamp at the beginning of
+            the session.  This is necessary if src or dst is 'session'.
+        """
+
+        fit = dict(self.get_fit())
+        if session_start is not None:
+            fit['session'] = (1e-3, session_start, 0.0)
+        return map_timestamps(t, src, dst, fit)
+
+
+    def write_fit(self, fp, session_start):
+        """
+        Write parameters of linear mapping to a data file.
+        Each line has the name of clock and (slope, system0, clock0).
+        Usually, users don't have to call this method.
+
+        :param fp: File object.
+        :param session_start: Tobii's system timestamp at the beginning of
+            the session.
+        """
+
+        fit = dict(self.get_fit())
+        fit['session'] = (1e-3, session_start, 0.0)
+        for name in clock_names[1:]:
+            if name in fit:
+                fp.write('Clock sync:\t%s\t%r\t%r\t%r\n' % ((name,)+tuple(float(v) for v in fit[name])))
@@ -0,0 +1,383 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import io
+import os
+import re
+import zlib
+import gzip
+import bz2
+import lzma
+import collections
+
+compression_extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma', '.lzma': 'lzma'}
+
+compression_magic = ((b'\x1f\x8b', 'gzip'),
+                     (b'BZh', 'bz2'),
+                     (b'\xfd7zXZ\x00', 'lzma'))
+
+# start of a member (gzip) or a stream (bz2, lzma).  These bytes may also
+# appear in compressed data, so they are only candidates of boundaries.
+member_magic = {'gzip': re.compile(b'\x1f\x8b\x08'),
+                'bz2': re.compile(b'BZh[1-9]1AY&SY'),
+                'lzma': re.compile(re.escape(b'\xfd7zXZ\x00'))}
+
+default_buffer_size = 1024*1024
+default_member_size = 4*1024*1024
+max_parallel_member_size = 16*1024*1024
+
+
+def detect_compression(filename):
+    """
+    Detect compression of a file from its first bytes.
+    Returned value is 'gzip', 'bz2', 'lzma' or None (not compressed).
+
+    :param str filename: Name of file.
+    """
+
+    with open(filename, 'rb') as fp:
+        head = fp.read(6)
+    for magic, name in compression_magic:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _make_compressor(compression, compresslevel):
+    if compression == 'gzip':
+        return zlib.compressobj(9 if compresslevel is None else compresslevel, zlib.DEFLATED, 31)
+    elif compression == 'bz2':
+        return bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+    elif compression == 'lzma':
+        return lzma.LZMACompressor(lzma.FORMAT_XZ, preset=compresslevel)
+    raise ValueError('compression ({}) is not supported.'.format(compression))
+
+
+def _make_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(31)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'lzma':
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    raise ValueError('compression ({}) is not supported.'.format(compression))
+
+
+class _member_writer(io.BufferedIOBase):
+    """
+    Binary writer that compresses data into a series of independent
+    members (gzip members, bz2 streams or xz streams).  The current member
+    is finished when member_size bytes have been written to it and when
+    :func:`end_member` is called (i.e. at the end of each session), so
+    that members can be decompressed in parallel.  :func:`flush` does not
+    finish the member, so frequent flushing does not reduce compression.
+    Concatenated members are valid gzip, bz2 and xz files.
+    """
+
+    def __init__(self, filename, mode, compression, compresslevel,
+                 buffer_size=default_buffer_size, member_size=default_member_size):
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.buffer_size = buffer_size
+        self.member_size = member_size
+        # check compression before the file is opened.
+        _make_compressor(compression, compresslevel)
+        self._fp = open(filename, mode+'b')
+        self._buffer = bytearray()
+        self._compressor = None
+        self._member_bytes = 0
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file.')
+        n = len(self._buffer)
+        self._buffer += b
+        n = len(self._buffer)-n
+        if len(self._buffer) >= self.buffer_size:
+            self._compress()
+        return n
+
+
+    def _compress(self):
+        if len(self._buffer) == 0:
+            return
+        if self._compressor is None:
+            self._compressor = _make_compressor(self.compression, self.compresslevel)
+        self._fp.write(self._compressor.compress(self._buffer))
+        self._member_bytes += len(self._buffer)
+        self._buffer = bytearray()
+        if self._member_bytes >= self.member_size:
+            self._end_member()
+
+
+    def _end_member(self):
+        if self._compressor is not None:
+            self._fp.write(self._compressor.flush())
+            self._compressor = None
+            self._member_bytes = 0
+
+
+    def flush(self):
+        """
+        Pass buffered data to the compressor and write compressed data.
+        The current member is not finished.
+        """
+
+        if self.closed:
+            raise ValueError('flush of closed file.')
+        self._compress()
+        self._fp.flush()
+
+
+    def end_member(self):
+        """
+        Write buffered data and finish the current member.
+        """
+
+        if self.closed:
+            raise ValueError('flush of closed file.')
+        self._compress()
+        self._end_member()
+        self._fp.flush()
+
+
+    def close(self):
+        if not self.closed:
+            try:
+                io.BufferedIOBase.close(self)
+                self._end_member()
+            finally:
+                self._fp.close()
+
+
+def end_member(fp):
+    """
+    Flush a file opened by :func:`open_text` and, if the file is
+    compressed, finish the current member.  This is called at the end of
+    each session.  Usually, users don't have to call this function.
+
+    :param fp: File object returned by :func:`open_text`.
+    """
+
+    fp.flush()
+    raw = getattr(fp, 'buffer', None)
+    if isinstance(raw, _member_writer):
+        raw.end_member()
+
+
+def _decompress_member(data, start, compression, chunk_size=default_buffer_size):
+    """
+    Decompress a member that starts at start.  Returned value is a tuple
+    of (decompressed_data, end_of_member).
+    """
+
+    decompressor = _make_decompressor(compression)
+    chunks = []
+    pos = start
+    while not decompressor.eof:
+        chunk = data[pos:pos+chunk_size]
+        if len(chunk) == 0:
+            raise EOFError('compressed file ended before the end-of-stream marker was reached.')
+        chunks.append(decompressor.decompress(chunk))
+        pos += len(chunk)
+    return b''.join(chunks), pos-len(decompressor.unused_data)
+
+
+def _find_members(data, compression):
+    """
+    Get offsets of candidates of member boundaries.  Returned value is
+    None if the file should not be decompressed in parallel (e.g. it has
+    only one member or has too large members).
+    """
+
+    starts = [m.start() for m in member_magic[compression].finditer(data)]
+    if len(starts) < 2 or starts[0] != 0:
+        return None
+    if max(b-a for a, b in zip(starts, starts[1:]+[len(data)])) > max_parallel_member_size:
+        return None
+    return starts
+
+
+def _iter_members(data, starts, compression, workers):
+    """
+    Decompress members in parallel and yield decompressed data in order.
+    Members are followed from the start of the file by the end of each
+    member, so candidates that are not real boundaries are skipped.
+    """
+
+    import concurrent.futures
+
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    pending = collections.deque()
+    candidates = iter(starts)
+    try:
+        pos = 0
+        while True:
+            # a few members ahead are decompressed while the data are used.
+            while len(pending) <= workers:
+                start = next(candidates, None)
+                if start is None:
+                    break
+                pending.append((start, executor.submit(_decompress_member, data, start, compression)))
+            if len(pending) == 0:
+                break
+            start, future = pending.popleft()
+            if start < pos:
+                future.cancel()
+                continue
+            if start > pos:
+                break
+            decompressed, pos = future.result()
+            yield decompressed
+        if pos < len(data):
+            # not a file written by this module (e.g. padding or garbage).
+            yield {'gzip': gzip, 'bz2': bz2, 'lzma': lzma}[compression].decompress(data[pos:])
+    finally:
+        for start, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class _member_reader(io.RawIOBase):
+    """
+    Raw reader of data decompressed by :func:`_iter_members`.
+    """
+
+    def __init__(self, fp, data, members):
+        self._fp = fp
+        self._data = data
+        self._members = members
+        self._chunk = memoryview(b'')
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, b):
+        while len(self._chunk) == 0:
+            chunk = next(self._members, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+    def close(self):
+        if not self.closed:
+            try:
+                io.RawIOBase.close(self)
+                self._members.close()
+                self._chunk = None
+                self._data.close()
+            finally:
+                self._fp.close()
+
+
+def _open_parallel_reader(filename, compression, workers):
+    """
+    Open a reader that decompresses members in parallel, or return None
+    if the file is not suitable.
+    """
+
+    import mmap
+
+    fp = open(filename, 'rb')
+    try:
+        if os.fstat(fp.fileno()).st_size == 0:
+            fp.close()
+            return None
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        fp.close()
+        raise
+    starts = _find_members(data, compression)
+    if starts is None:
+        data.close()
+        fp.close()
+        return None
+    return _member_reader(fp, data, _iter_members(data, starts, compression, workers))
+
+
+def open_text(filename, mode='r', compression='auto', compresslevel=None,
+              buffer_size=default_buffer_size, member_size=default_member_size,
+              workers=None):
+    """
+    Open a text file which may be compressed by gzip, bz2 or lzma.
+
+    In read mode, compression='auto' detects compression from the content
+    of the file.  In write mode, compression='auto' selects compression from
+    the extension of filename ('.gz', '.bz2', '.xz' or '.lzma').
+    Compressed streams are accessed through a buffer of buffer_size bytes
+    so that the compressor receives large blocks.
+
+    Compressed files are written as a series of independent members
+    (gzip members, bz2 streams or xz streams).  A member is finished when
+    member_size bytes have been written to it and at the end of each
+    session (see :func:`end_member`).  Flushing the file does not finish
+    the member.  Such files can be read by
+    any gzip, bz2 or xz reader, and this function decompresses their
+    members in parallel threads.  Other compressed files (e.g. files
+    written by older versions) are decompressed sequentially.
+
+    :param str filename: Name of file.
+    :param str mode: 'r' (read), 'w' (write) or 'a' (append).
+    :param compression: 'auto', 'gzip', 'bz2', 'lzma' or None.
+    :param int compresslevel: Compression level (preset for lzma).
+        If None, default level of each module is used.
+    :param int buffer_size: Size of buffer in bytes.  Default value is 1MB.
+    :param int member_size: Maximum size of uncompressed data in a member
+        (write mode).  Default value is 4MB.
+    :param int workers: Number of threads used for decompression (read
+        mode).  If None, up to 4 threads are used.  If 1, members are
+        decompressed sequentially.
+    """
+
+    if mode not in ('r', 'w', 'a'):
+        raise ValueError('mode must be \'r\', \'w\' or \'a\'')
+
+    if compression == 'auto':
+        if mode == 'r':
+            compression = detect_compression(filename)
+        else:
+            compression = compression_extensions.get(os.path.splitext(filename)[1].lower())
+
+    if compression is None:
+        return open(filename, mode, buffering=buffer_size)
+
+    if compression not in member_magic:
+        raise ValueError('compression ({}) is not supported.'.format(compression))
+
+    if mode != 'r':
+        return io.TextIOWrapper(_member_writer(filename, mode, compression, compresslevel,
+                                               buffer_size, member_size))
+
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
+    if workers > 1:
+        raw = _open_parallel_reader(filename, compression, workers)
+        if raw is not None:
+            return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=buffer_size))
+
+    if compression == 'gzip':
+        raw = gzip.GzipFile(filename, 'rb')
+    elif compression == 'bz2':
+        raw = bz2.BZ2File(filename, 'rb')
+    else:
+        raw = lzma.LZMAFile(filename, 'rb')
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=buffer_size))
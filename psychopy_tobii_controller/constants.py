@@ -16,6 +16,7 @@ PupilRight = 7
 ValidityRight = 8
 GazePointX = 9
 GazePointY = 10
+Device = 11
 
 FixStart = 0
 FixEnd = 1
@@ -8,13 +8,26 @@
 from __future__ import division
 from __future__ import absolute_import
 
-# import os
+import os
+import json
+import base64
 import types
 import datetime
 import numpy as np
 import time
 import warnings
 
+from .buffer import gaze_buffer, event_buffer
+from .clock import clock_sync
+from .discovery import connect_eyetracker
+from .validation import compute_validation_metrics, write_validation_metrics
+from .compression import open_text, end_member
+from .aoi import aoi_set
+from .filters import gaze_filter, make_filter
+from .prediction import gaze_predictor
+from .pipeline import gaze_pipeline
+from .health import sampling_monitor
+
 default_calibration_target_dot_size = {
         'pix': 2.0, 'norm':0.004, 'height':0.002, 'cm':0.05,
         'deg':0.05, 'degFlat':0.05, 'degFlatPos':0.05
@@ -40,48 +53,56 @@ class tobii_controller:
     calibration = None
     eyetracker_id = None
     win = None
-    gaze_data = []
-    event_data = []
-    retry_points = []
+    gaze_data = None
+    event_data = None
+    retry_points = None
     datafile = None
+    datafile_summaries = None
     embed_events = False
+    raw_datafile = False
     recording = False
     key_index_dict = default_key_index_dict.copy()
 
 
-    def __init__(self, win, id=0):
+    def __init__(self, win, id=0, eyetracker=None, address=None, use_cache=True):
         """
         Initialize tobii_controller object.
         
+        Searching Tobii units takes a few seconds.  To start quickly,
+        addresses of Tobii units found by the last search are cached in
+        the user's home directory and the unit is connected directly.
+        Tobii units are searched only if the connection fails.
+        
         :param win: PsychoPy Window object.
         :param int id: ID of Tobii unit to connect with.
             Default value is 0.
+        :param eyetracker: tobii_research.EyeTracker object to connect with.
+            If this is given, id is ignored and Tobii units are not searched.
+            Default value is None.
+        :param str address: Address of Tobii unit to connect with
+            (e.g. 'tet-tcp://172.28.195.1').  If this is given, id is ignored.
+            Default value is None.
+        :param bool use_cache: If True, cached addresses of Tobii units
+            are used.  Default value is True.
         """
         import tobii_research
         self.tobii_research = tobii_research
 
-        try:
-            import Image
-            import ImageDraw
-        except:
-            from PIL import Image
-            from PIL import ImageDraw
-
-        self.Image = Image
-        self.ImageDraw = ImageDraw
-
         import psychopy.visual
         import psychopy.event
         import psychopy.core
-        import psychopy.tools.monitorunittools
 
         self.psychopy_visual = psychopy.visual
         self.psychopy_event = psychopy.event
         self.psychopy_core = psychopy.core
-        self.psychopy_unittools = psychopy.tools.monitorunittools
 
         self.eyetracker_id = id
         self.win = win
+        self.gaze_data = gaze_buffer()
+        self.event_data = event_buffer()
+        self.retry_points = []
+        self.clock_sync = clock_sync(tobii_research.get_system_time_stamp,
+                                     psychopy.core.getTime)
         
         self.calibration_target_dot_size = default_calibration_target_dot_size[self.win.units]
         self.calibration_target_disc_size = default_calibration_target_disc_size[self.win.units]
@@ -93,25 +114,44 @@ class tobii_controller:
             lineColor='white', lineWidth=1, autoLog=False)
         self.update_calibration = self.update_calibration_default
         self.update_validation = self.update_validation_default
+        self.update_progress = None
+        self.calibration_worker = None
+        self._sample_hooks = []
+        self._batch_hooks = {}
+        self.aoi = aoi_set()
+        self.aoi_hits = self.aoi.contains(np.nan, np.nan)
+        self.gaze_filter = None
+        self.filtered_gaze = None
+        self.gaze_predictor = gaze_predictor()
+        self.publisher = None
+        self.acquisition = None
+        self.pipeline = gaze_pipeline(self)
+        self.health = sampling_monitor()
+        self.add_sample_hook(self.health.update, self.health.update_batch)
         if self.win.units == 'norm': # fix oval
             self.calibration_target_dot.setSize([float(self.win.size[1])/self.win.size[0], 1.0])
             self.calibration_target_disc.setSize([float(self.win.size[1])/self.win.size[0], 1.0])
         
-        eyetrackers = tobii_research.find_all_eyetrackers()
-
-        if len(eyetrackers)==0:
-            raise RuntimeError('No Tobii eyetrackers')
-        
-        try:
-            self.eyetracker = eyetrackers[self.eyetracker_id]
-        except:
-            raise ValueError(
-                'Invalid eyetracker ID {}\n({} eyetrackers found)'.format(
-                    self.eyetracker_id, len(eyetrackers)))
+        if eyetracker is not None:
+            self.eyetracker = eyetracker
+        else:
+            self.eyetracker = connect_eyetracker(tobii_research, self.eyetracker_id,
+                                                 address, use_cache)
         
         self.calibration = tobii_research.ScreenBasedCalibration(self.eyetracker)
 
 
+    @property
+    def psychopy_unittools(self):
+        """
+        psychopy.tools.monitorunittools module.  This module is imported
+        when this is accessed at first.
+        """
+        
+        import psychopy.tools.monitorunittools
+        return psychopy.tools.monitorunittools
+
+
     def show_status(self, text_color='white', enable_mouse=False):
         """
         Draw eyetracker status on the screen.
@@ -128,6 +168,7 @@ class tobii_controller:
             mouse = self.psychopy_event.Mouse(visible=False, win=self.win)
         
         self.gaze_data_status = None
+        self.health.reset(self._get_nominal_rate())
         self.eyetracker.subscribe_to(self.tobii_research.EYETRACKER_GAZE_DATA,
                                      self.on_gaze_data_status)
         
@@ -146,6 +187,9 @@ class tobii_controller:
                     msgst += 'R: {:7.2f}, {:7.2f}, {:7.2f}\n'.format(*rp)
                 else:
                     msgst += ''
+                status = self.health.status
+                msgst += '\n{:.0f} Hz (nominal {}), dropped: {}'.format(
+                    status.rate, status.nominal_rate, status.dropped)
                 msg.setText(msgst)
             
             for key in self.psychopy_event.getKeys():
@@ -174,6 +218,34 @@ class tobii_controller:
         rp = gaze_data.right_eye.gaze_origin.position_in_user_coordinates
         rv = gaze_data.right_eye.gaze_origin.validity
         self.gaze_data_status = (lp, lv, rp, rv)
+        self.health.add(gaze_data.system_time_stamp, lv, rv)
+
+
+    def _get_nominal_rate(self):
+        try:
+            return self.eyetracker.get_gaze_output_frequency()
+        except Exception:
+            return None
+
+
+    def get_sampling_status(self):
+        """
+        Get health of sampling as
+        :class:`~psychopy_tobii_controller.health.sampling_status`
+        (effective rate, late intervals, dropped samples, discontinuities
+        of timestamps and streaks of data loss).
+        Counters are updated in the sample path, so this method is cheap
+        enough to be called every frame.  Use controller.health.set_threshold()
+        to receive callbacks.
+        
+        *Example* ::
+        
+            status = controller.get_sampling_status()
+            if status.dropped > 0:
+                ...
+        """
+        
+        return self.health.status
 
 
     def run_calibration(self, calibration_points, move_duration=1.5,
@@ -208,10 +280,7 @@ class tobii_controller:
         if enable_mouse:
             mouse = self.psychopy_event.Mouse(visible=False, win=self.win)
         
-        img = self.Image.new('RGBA',tuple(self.win.size))
-        img_draw = self.ImageDraw.Draw(img)
-        
-        result_img = self.psychopy_visual.SimpleImageStim(self.win, img, autoLog=False)
+        result_overlay = []
         result_msg = self.psychopy_visual.TextStim(self.win, pos=(0,-self.win.size[1]/4),
             color=text_color, units='pix', autoLog=False)
         remove_marker = self.psychopy_visual.Circle(
@@ -262,40 +331,33 @@ class tobii_controller:
             self.update_calibration()
 
             result_msg.setText('Calculating. Please wait...')
-            result_msg.draw()
-            self.win.flip()
-
-            calibration_result = self.calibration.compute_and_apply()
+            calibration_result = self.wait_calibration_task(
+                self.submit_calibration_task(self.calibration.compute_and_apply),
+                [result_msg])
             
             self.win.flip()
            
-            img_draw.rectangle(((0,0),tuple(self.win.size)),fill=(0,0,0,0))
+            targets = []
+            left_lines = []
+            right_lines = []
             if calibration_result.status == self.tobii_research.CALIBRATION_STATUS_FAILURE:
                 #computeCalibration failed.
                 pass
             else:
-                if len(calibration_result.calibration_points) == 0:
-                    pass
-                else:
-                    for calibration_point in calibration_result.calibration_points:
-                        p = calibration_point.position_on_display_area
-                        for calibration_sample in calibration_point.calibration_samples:
-                            lp = calibration_sample.left_eye.position_on_display_area
-                            rp = calibration_sample.right_eye.position_on_display_area
-                            if calibration_sample.left_eye.validity == self.tobii_research.VALIDITY_VALID_AND_USED:
-                                img_draw.line(((p[0]*self.win.size[0], p[1]*self.win.size[1]),
-                                              (lp[0]*self.win.size[0], lp[1]*self.win.size[1])), fill=(0,255,0,255))
-                            if calibration_sample.right_eye.validity == self.tobii_research.VALIDITY_VALID_AND_USED:
-                                img_draw.line(((p[0]*self.win.size[0], p[1]*self.win.size[1]),
-                                              (rp[0]*self.win.size[0], rp[1]*self.win.size[1])), fill=(255,0,0,255))
-                        img_draw.ellipse(((p[0]*self.win.size[0]-3, p[1]*self.win.size[1]-3),
-                                         (p[0]*self.win.size[0]+3, p[1]*self.win.size[1]+3)), outline=(0,0,0,255))
+                for calibration_point in calibration_result.calibration_points:
+                    p = calibration_point.position_on_display_area
+                    targets.append(p)
+                    for calibration_sample in calibration_point.calibration_samples:
+                        if calibration_sample.left_eye.validity == self.tobii_research.VALIDITY_VALID_AND_USED:
+                            left_lines.append(tuple(p)+tuple(calibration_sample.left_eye.position_on_display_area))
+                        if calibration_sample.right_eye.validity == self.tobii_research.VALIDITY_VALID_AND_USED:
+                            right_lines.append(tuple(p)+tuple(calibration_sample.right_eye.position_on_display_area))
+            result_overlay = self.build_result_overlay(targets, left_lines, right_lines)
 
             if enable_mouse:
                 result_msg.setText('Accept/Retry: {} or right-click\nSelect recalibration points: 0-9 key or left-click\nAbort: esc'.format(decision_key))
             else:
                 result_msg.setText('Accept/Retry: {}\nSelect recalibration points: 0-9 key\nAbort: esc'.format(decision_key))
-            result_img.setImage(img)
             
             waitkey = True
             self.retry_points = []
@@ -333,7 +395,8 @@ class tobii_controller:
                                     self.retry_points.append(key_index)
                                 time.sleep(0.2)
                                 break
-                result_img.draw()
+                for stim in result_overlay:
+                    stim.draw()
                 if len(self.retry_points)>0:
                     for index in self.retry_points:
                         if index > len(self.original_calibration_points):
@@ -371,9 +434,18 @@ class tobii_controller:
 
     def run_validation(self, calibration_points, move_duration=1.5,
             shuffle=True, target_shift=0, n_samples=30, start_key='space', decision_key='space',
-            text_color='white', enable_mouse=False):
+            text_color='white', enable_mouse=False, sample_timeout=1.0):
         """
         Run validation.
+        Accuracy, precision and data loss are calculated in degrees of
+        visual angle (see
+        :func:`~psychopy_tobii_controller.validation.compute_validation_metrics`)
+        and stored in self.validation_result.  If the result is accepted
+        and a data file is opened, the result is also written to the data file.
+        Returned value is 'accept' or 'abort'.
+        
+        Monitor profile with screen width and viewing distance is necessary
+        to calculate visual angles.
         
         :param calibration_points: List of position of validation points.
         :param float move_duration: Duration of animation of validation target.
@@ -396,6 +468,9 @@ class tobii_controller:
         :param text_color: Color of message text. Default value is 'white'
         :param bool enable_mouse: If True, mouse operation is enabled.
             Default value is False.
+        :param float sample_timeout: If n_samples are not received within
+            this time (s) after the target stops, missing samples are
+            treated as invalid.  Default value is 1.0.
         """
         if self.eyetracker is None:
             raise RuntimeError('Eyetracker is not found.')
@@ -408,15 +483,12 @@ class tobii_controller:
         if enable_mouse:
             mouse = self.psychopy_event.Mouse(visible=False, win=self.win)
         
-        img = self.Image.new('RGBA',tuple(self.win.size))
-        img_draw = self.ImageDraw.Draw(img)
-        
-        result_img = self.psychopy_visual.SimpleImageStim(self.win, img, autoLog=False)
         result_msg = self.psychopy_visual.TextStim(self.win, pos=(0,-self.win.size[1]/4),
             color=text_color, units='pix', autoLog=False)
 
         self.n_samples = n_samples
-        self.validation_data = []
+        self.sample_timeout = sample_timeout
+        self.validation_result = None
         self.move_duration = move_duration
         if target_shift > 0:
             self.original_calibration_points = []
@@ -459,36 +531,37 @@ class tobii_controller:
             else:
                 self.win.flip()
 
+            self.validation_data = []
             self.update_validation()
+            if self.validation_data:
+                # custom validation procedures written for older versions
+                self.validation_targets, self.validation_samples = \
+                    self._convert_validation_data(self.validation_data)
 
             self.win.flip()
 
-            error = {'L':[],'R':[]}
-            img_draw.rectangle(((0,0),tuple(self.win.size)),fill=(0,0,0,0))
-            for vdat in self.validation_data:
-                px, py = self.get_tobii_pos(vdat[0])
-                lx, ly = self.get_tobii_pos(vdat[1][0:2])
-                rx, ry = self.get_tobii_pos(vdat[1][2:4])
-                if not np.isnan(lx):
-                    img_draw.line(((px*self.win.size[0], py*self.win.size[1]),
-                                   (lx*self.win.size[0], ly*self.win.size[1])), fill=(0,255,0,255))
-                    error['L'].append(np.linalg.norm((lx-px, ly-py)))
-                if not np.isnan(rx):
-                    img_draw.line(((px*self.win.size[0], py*self.win.size[1]),
-                                   (rx*self.win.size[0], ry*self.win.size[1])), fill=(255,0,0,255))
-                    error['R'].append(np.linalg.norm((rx-px, ry-py)))
-            for pp in self.original_calibration_points:
-                p = self.get_tobii_pos(pp)
-                img_draw.ellipse(((p[0]*self.win.size[0]-3, p[1]*self.win.size[1]-3),
-                                    (p[0]*self.win.size[0]+3, p[1]*self.win.size[1]+3)), outline=(0,0,0,255))
- 
+            points = np.column_stack(self.get_tobii_pos((self.validation_targets[:,0],
+                                                         self.validation_targets[:,1])))
+            self.validation_result = compute_validation_metrics(points, self.validation_samples,
+                                                                self.win.size, *self.get_screen_geometry())
+            
+            samples = self.validation_samples.reshape(-1, 9)
+            lines = np.column_stack((np.repeat(points, self.validation_samples.shape[1], axis=0),
+                                     samples[:,[1,2,5,6]]))
+            left_lines = lines[:,0:4][~np.isnan(lines[:,0:4]).any(axis=1)]
+            right_lines = lines[:,[0,1,4,5]][~np.isnan(lines[:,[0,1,4,5]]).any(axis=1)]
+            targets = np.array(self.original_calibration_points, dtype=float)
+            targets = np.column_stack(self.get_tobii_pos((targets[:,0], targets[:,1])))
+            result_overlay = self.build_result_overlay(targets, left_lines, right_lines)
+            
+            msg = 'Accuracy L:{:.2f}  R:{:.2f} deg\nPrecision (RMS) L:{:.2f}  R:{:.2f} deg\nData loss L:{:.1f}%  R:{:.1f}%\n'.format(
+                self.validation_result['mean_accuracy_L'], self.validation_result['mean_accuracy_R'],
+                self.validation_result['mean_precision_rms_L'], self.validation_result['mean_precision_rms_R'],
+                self.validation_result['mean_data_loss_L']*100, self.validation_result['mean_data_loss_R']*100)
             if enable_mouse:
-                result_msg.setText('Mean Error L:{:.3f}  R:{:.3f}\nAccept: {} or right-click\nAbort: esc'.format(
-                    np.average(error['L']), np.average(error['R']), decision_key))
+                result_msg.setText(msg+'Accept: {} or right-click\nAbort: esc'.format(decision_key))
             else:
-                result_msg.setText('Mean Error L:{:.3f}  R:{:.3f}\nAccept: {}\nAbort: esc'.format(
-                    np.average(error['L']), np.average(error['R']), decision_key))
-            result_img.setImage(img)
+                result_msg.setText(msg+'Accept: {}\nAbort: esc'.format(decision_key))
 
             waitkey = True
             if enable_mouse:
@@ -502,7 +575,8 @@ class tobii_controller:
                     if pressed[2]: # right click
                         key = decision_key
                         waitkey = False
-                result_img.draw()
+                for stim in result_overlay:
+                    stim.draw()
                 result_msg.draw()
                 self.win.flip()
         
@@ -519,6 +593,59 @@ class tobii_controller:
                 mouse.setVisible(False)
 
         self.unsubscribe()
+        
+        if retval == 'accept' and self.datafile is not None:
+            write_validation_metrics(self.datafile, self.validation_targets, self.validation_result)
+        
+        return retval
+
+
+    def build_result_overlay(self, targets, left_lines, right_lines):
+        """
+        Build stimuli to show the result of calibration and validation.
+        Lines from targets to gaze positions are drawn as one
+        ElementArrayStim for each eye, so that the overlay can be redrawn
+        every frame regardless of the resolution of the window.
+        Returned value is a list of stimuli.
+        
+        Usually, users don't have to call this method.
+        
+        :param targets: Array-like of shape (n, 2) that holds position of
+            targets in Tobii's display area coordinates.
+        :param left_lines: Array-like of shape (m, 4) that holds
+            (target_x, target_y, gaze_x, gaze_y) of the left eye in Tobii's
+            display area coordinates.
+        :param right_lines: The same as left_lines for the right eye.
+        """
+        
+        size = np.asarray(self.win.size, dtype=float)
+        
+        def to_pix(xy):
+            return np.column_stack(((xy[:,0]-0.5)*size[0], (0.5-xy[:,1])*size[1]))
+        
+        overlay = []
+        for lines, color in ((left_lines, (0,255,0)), (right_lines, (255,0,0))):
+            lines = np.asarray(lines, dtype=float).reshape(-1,4)
+            if len(lines) == 0:
+                continue
+            p0 = to_pix(lines[:,0:2])
+            p1 = to_pix(lines[:,2:4])
+            d = p1-p0
+            overlay.append(self.psychopy_visual.ElementArrayStim(self.win, units='pix',
+                nElements=len(lines), xys=(p0+p1)/2.0,
+                sizes=np.column_stack((np.maximum(np.hypot(d[:,0], d[:,1]), 1.0), np.ones(len(lines)))),
+                oris=-np.degrees(np.arctan2(d[:,1], d[:,0])),
+                elementTex=None, elementMask=None, colors=color, colorSpace='rgb255',
+                autoLog=False))
+        
+        targets = np.asarray(targets, dtype=float).reshape(-1,2)
+        if len(targets) > 0:
+            overlay.append(self.psychopy_visual.ElementArrayStim(self.win, units='pix',
+                nElements=len(targets), xys=to_pix(targets), sizes=7,
+                elementTex=None, elementMask='circle', colors=(0,0,0), colorSpace='rgb255',
+                autoLog=False))
+        
+        return overlay
 
 
     def collect_calibration_data(self, p, cood='PsychoPy'):
@@ -529,14 +656,89 @@ class tobii_controller:
         Usually, users don't have to call this method.
         """
         
+        return self.collect_calibration_data_async(p, cood).result()
+
+
+    def collect_calibration_data_async(self, p, cood='PsychoPy'):
+        """
+        Start collecting calibration data on the calibration worker thread.
+        Returned value is a concurrent.futures.Future object.
+        Use :func:`~psychopy_tobii_controller.tobii_controller.wait_calibration_task`
+        to keep updating the screen until data collection finishes.
+        
+        :param p: Position of calibration point.
+        :param str cood: Coordinate system of p.  'PsychoPy' or 'Tobii'.
+            Default value is 'PsychoPy'.
+        """
+        
         if cood=='PsychoPy':
-            self.calibration.collect_data(*self.get_tobii_pos(p))
+            return self.submit_calibration_task(self.calibration.collect_data, *self.get_tobii_pos(p))
         elif cood =='Tobii':
-            self.calibration.collect_data(*p)
+            return self.submit_calibration_task(self.calibration.collect_data, *p)
         else:
             raise ValueError('cood must be \'PsychoPy\' or \'Tobii\'')
 
 
+    def submit_calibration_task(self, func, *args):
+        """
+        Call func(*args) on the calibration worker thread.
+        Tasks are processed one by one in the order of submission.
+        Returned value is a concurrent.futures.Future object.
+        
+        Usually, users don't have to call this method.
+        
+        :param func: Function to be called.
+        """
+        
+        if self.calibration_worker is None:
+            import concurrent.futures
+            self.calibration_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.calibration_worker.submit(func, *args)
+
+
+    def wait_calibration_task(self, future, stimuli=()):
+        """
+        Keep drawing stimuli and flipping the window until future is done.
+        If a progress function is set by
+        :func:`~psychopy_tobii_controller.tobii_controller.set_progress_callback`,
+        it is called every frame.
+        Returned value is the result of future.
+        
+        :param future: concurrent.futures.Future object returned by
+            :func:`~psychopy_tobii_controller.tobii_controller.submit_calibration_task`
+            or :func:`~psychopy_tobii_controller.tobii_controller.collect_calibration_data_async`.
+        :param stimuli: List of stimuli to be drawn.
+        """
+        
+        clock = self.psychopy_core.Clock()
+        while not future.done():
+            for stim in stimuli:
+                stim.draw()
+            if self.update_progress is not None:
+                self.update_progress(clock.getTime())
+            self.psychopy_event.getKeys()
+            self.win.flip()
+        
+        return future.result()
+
+
+    def set_progress_callback(self, func):
+        """
+        Set a function that is called every frame while waiting for
+        calibration data collection and calculation and validation samples
+        (e.g. to draw a spinner).
+        The function receives the controller and the time elapsed since
+        waiting started (in seconds).  Set None to remove the function.
+        
+        :param func: progress function.
+        """
+        
+        if func is None:
+            self.update_progress = None
+        else:
+            self.update_progress = types.MethodType(func, self)
+
+
     def update_calibration_default(self):
         """
         Updating calibration target and correcting calibration data.
@@ -564,7 +766,9 @@ class tobii_controller:
                 self.calibration_target_dot.draw()
                 self.win.flip()
                 current_time = clock.getTime()
-            self.calibration.collect_data(x, y)
+            self.wait_calibration_task(
+                self.collect_calibration_data_async((x, y), cood='Tobii'),
+                [self.calibration_target_disc, self.calibration_target_dot])
 
 
     def set_custom_calibration(self, func):
@@ -591,9 +795,26 @@ class tobii_controller:
         This method is called by
         :func:`~psychopy_tobii_controller.tobii_controller.run_validation`
         
+        Position of targets (PsychoPy coordinates) are stored in
+        self.validation_targets as a numpy.ndarray of shape (n_targets, 2).
+        Raw Tobii samples recorded at each target are stored in
+        self.validation_samples as a numpy.ndarray of shape
+        (n_targets, n_samples, 9).  If samples are not received within
+        self.sample_timeout (s), missing samples are filled with NaN
+        (i.e. counted as data loss).
+        
+        Custom validation procedures may instead append tuples of
+        (target_position, (lx, ly, rx, ry)) in PsychoPy's coordinates to
+        self.validation_data as in older versions.  In this case,
+        validation_targets and validation_samples are made from
+        validation_data.
+        
         Usually, users don't have to call this method.
         """
         
+        self.validation_targets = np.array(self.calibration_points, dtype=float)
+        self.validation_samples = np.full((len(self.calibration_points), self.n_samples, 9), np.nan)
+        
         clock = self.psychopy_core.Clock()
         for point_index in range(len(self.calibration_points)):
             self.calibration_target_dot.setPos(self.calibration_points[point_index])
@@ -611,15 +832,53 @@ class tobii_controller:
                 self.calibration_target_dot.draw()
                 self.win.flip()
                 current_time = clock.getTime()
-            n = 0
-            last_t = self.gaze_data[-1][0] # timestamp
-            while n<self.n_samples:
-                if self.gaze_data[-1][0] > last_t: # new  sample
-                    self.validation_data.append((self.calibration_points[point_index],
-                                                 self.get_current_gaze_position()))
-                    last_t  = self.gaze_data[-1][0]
-                    n += 1
-                # self.win.flip()
+            start = len(self.gaze_data)
+            deadline = time.perf_counter()+self.sample_timeout
+            clock.reset()
+            # the target is drawn every frame while samples are collected,
+            # as in wait_calibration_task.
+            while len(self.gaze_data) < start+self.n_samples:
+                if time.perf_counter() > deadline:
+                    warnings.warn('validation: only {} of {} samples were received at point {}.'.format(
+                        len(self.gaze_data)-start, self.n_samples, point_index+1))
+                    break
+                self.calibration_target_disc.draw()
+                self.calibration_target_dot.draw()
+                if self.update_progress is not None:
+                    self.update_progress(clock.getTime())
+                self.psychopy_event.getKeys()
+                self.win.flip()
+            samples = self.gaze_data[start:start+self.n_samples]
+            self.validation_samples[point_index,:len(samples)] = samples
+
+
+    def _convert_validation_data(self, validation_data):
+        """
+        Convert validation_data of older versions (list of tuples of
+        (target_position, (lx, ly, rx, ry)) in PsychoPy's coordinates)
+        to validation_targets and validation_samples.  Samples are grouped
+        by target in the order of appearance.  Timestamps and pupil sizes
+        are NaN.
+        """
+        
+        targets = []
+        groups = []
+        for target, gaze in validation_data:
+            target = tuple(target)
+            if target not in targets:
+                targets.append(target)
+                groups.append([])
+            groups[targets.index(target)].append(gaze)
+        
+        samples = np.full((len(targets), max(len(g) for g in groups), 9), np.nan)
+        for i, group in enumerate(groups):
+            gaze = np.array(group, dtype=float).reshape(-1, 4)
+            for xy, v in ((gaze[:,0:2], 4), (gaze[:,2:4], 8)):
+                tx, ty = self.get_tobii_pos((xy[:,0], xy[:,1]))
+                samples[i,:len(gaze),v-3] = tx
+                samples[i,:len(gaze),v-2] = ty
+                samples[i,:len(gaze),v] = ~np.isnan(xy).any(axis=1)
+        return np.array(targets, dtype=float), samples
 
 
     def set_custom_validation(self, func):
@@ -671,6 +930,107 @@ class tobii_controller:
         self.key_index_dict = default_key_index_dict.copy()
 
 
+    def save_calibration(self, filename, participant=None):
+        """
+        Save the calibration currently applied to the eyetracker.
+        Calibration data retrieved from the eyetracker are saved with
+        following information, so that the calibration can be reapplied by
+        :func:`~psychopy_tobii_controller.tobii_controller.load_calibration`
+        when the experiment is restarted.
+        
+        - participant
+        - serial number, model and address of the eyetracker
+        - date and time of saving
+        - resolution of the window
+        - mean accuracy, precision and data loss of the last validation
+          (if :func:`~psychopy_tobii_controller.tobii_controller.run_validation`
+          has been accepted)
+        
+        :param str filename: Name of calibration file.
+        :param str participant: Participant ID.  Default value is None.
+        """
+        
+        data = self.eyetracker.retrieve_calibration_data()
+        if data is None:
+            raise RuntimeError('No calibration is applied to the eyetracker.')
+        
+        validation = None
+        if getattr(self, 'validation_result', None) is not None:
+            validation = dict([(k, v) for k, v in self.validation_result.items() if k.startswith('mean_')])
+        
+        content = {'participant': participant,
+                   'serial_number': self.eyetracker.serial_number,
+                   'model': self.eyetracker.model,
+                   'address': self.eyetracker.address,
+                   'saved': datetime.datetime.now().isoformat(),
+                   'resolution': [int(v) for v in self.win.size],
+                   'validation': validation,
+                   'calibration_data': base64.b64encode(bytes(data)).decode('ascii')}
+        
+        # write to a temporary file first so that a crash does not leave
+        # a broken calibration file.
+        tmp_filename = filename+'.tmp'
+        with open(tmp_filename, 'w') as fp:
+            json.dump(content, fp, indent=1)
+        os.replace(tmp_filename, filename)
+
+
+    def load_calibration(self, filename, participant=None, max_age=None,
+            same_eyetracker=True):
+        """
+        Apply calibration saved by
+        :func:`~psychopy_tobii_controller.tobii_controller.save_calibration`.
+        Returned value is True if the calibration is applied.
+        If the calibration file does not exist or the saved calibration
+        does not satisfy the conditions, False is returned and
+        the reason is stored in self.calibration_file_status.
+        
+        *Example* ::
+        
+            if not controller.load_calibration('calib.json', participant='P01', max_age=3600):
+                controller.run_calibration(points)
+                controller.save_calibration('calib.json', participant='P01')
+        
+        :param str filename: Name of calibration file.
+        :param str participant: If not None, calibration saved for
+            other participants is rejected.  Default value is None.
+        :param max_age: If not None, calibration older than this value is
+            rejected.  Unit is second.  datetime.timedelta is also accepted.
+            Default value is None.
+        :param bool same_eyetracker: If True, calibration saved with
+            other eyetrackers is rejected.  Default value is True.
+        """
+        
+        try:
+            with open(filename, 'r') as fp:
+                content = json.load(fp)
+            saved = datetime.datetime.fromisoformat(content['saved'])
+            data = base64.b64decode(content['calibration_data'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.calibration_file_status = 'cannot read calibration file ({})'.format(e)
+            return False
+        
+        if participant is not None and content.get('participant') != participant:
+            self.calibration_file_status = 'participant does not match'
+            return False
+        
+        if same_eyetracker and content.get('serial_number') != self.eyetracker.serial_number:
+            self.calibration_file_status = 'eyetracker does not match'
+            return False
+        
+        if max_age is not None:
+            if not isinstance(max_age, datetime.timedelta):
+                max_age = datetime.timedelta(seconds=max_age)
+            if datetime.datetime.now()-saved > max_age:
+                self.calibration_file_status = 'calibration is too old'
+                return False
+        
+        self.eyetracker.apply_calibration_data(data)
+        self.calibration_file_status = 'applied'
+        self.calibration_file_info = dict([(k, v) for k, v in content.items() if k != 'calibration_data'])
+        return True
+
+
     def set_calibration_param(self, param_dict):
         """
         Set calibration parameters.
@@ -716,23 +1076,54 @@ class tobii_controller:
         return param_dict
 
 
-    def subscribe(self, wait=True, timeout=2.0):
+    def subscribe(self, wait=True, timeout=2.0, out_of_process=False):
         """
         Start recording. Note that data will be available hundreds
         of milliseconds after the request is sent to the eyetracker.
         Set wait=True to wait until data becomes available.
 
+        If out_of_process is True, gaze data are received by a child
+        process and passed through shared memory
+        (see :class:`~psychopy_tobii_controller.acquisition.acquisition_process`),
+        so that Tobii's callback and rendering do not compete for the GIL.
+        The child process connects to the eyetracker with its address.
+        Because the child process is spawned, the main part of the
+        experiment script must be protected by
+        ``if __name__ == '__main__':``.
+
         :param bool wait: If True, wait until 
             Default value is True.
         :param float timeout: If wait=True and failed to retrieve 
             gaze data within this limit, RuntimeError will be raised.
             Unit is second.
+        :param bool out_of_process: If True, gaze data are received in
+            a child process.  Python 3.8 or later is required.
+            Default value is False.
         """
         
-        self.gaze_data = []
-        self.event_data = []
+        if out_of_process:
+            # this raises RuntimeError before recording is started if
+            # the acquisition process is not available.
+            from .acquisition import acquisition_process
+            acquisition = acquisition_process(self)
+        
+        self.gaze_data = gaze_buffer()
+        self.event_data = event_buffer()
+        self.aoi.reset_counters()
+        self.aoi_hits = self.aoi.contains(np.nan, np.nan)
+        if self.gaze_filter is not None:
+            self.gaze_filter.reset()
+        self.filtered_gaze = None
+        self.pipeline.reset()
+        self.health.reset(self._get_nominal_rate())
         self.recording = True
-        self.eyetracker.subscribe_to(self.tobii_research.EYETRACKER_GAZE_DATA, self.on_gaze_data)
+        self.eyetracker.subscribe_to(self.tobii_research.EYETRACKER_TIME_SYNCHRONIZATION_DATA,
+                                     self.clock_sync.on_time_synchronization_data)
+        if out_of_process:
+            self.acquisition = acquisition
+            self.acquisition.start()
+        else:
+            self.eyetracker.subscribe_to(self.tobii_research.EYETRACKER_GAZE_DATA, self.on_gaze_data)
         if wait:
             start = time.perf_counter()
             while time.perf_counter()-start < timeout:
@@ -746,11 +1137,16 @@ class tobii_controller:
         Stop recording.
         """
         
-        self.eyetracker.unsubscribe_from(self.tobii_research.EYETRACKER_GAZE_DATA)
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+        else:
+            self.eyetracker.unsubscribe_from(self.tobii_research.EYETRACKER_GAZE_DATA)
+        self.eyetracker.unsubscribe_from(self.tobii_research.EYETRACKER_TIME_SYNCHRONIZATION_DATA)
         self.recording = False
         self.flush_data()
-        self.gaze_data = []
-        self.event_data = []
+        self.gaze_data = gaze_buffer()
+        self.event_data = event_buffer()
 
 
     def on_gaze_data(self, gaze_data):
@@ -770,7 +1166,125 @@ class tobii_controller:
         ry = gaze_data.right_eye.gaze_point.position_on_display_area[1]
         rp = gaze_data.right_eye.pupil.diameter
         rv = gaze_data.right_eye.gaze_point.validity
-        self.gaze_data.append((t,lx,ly,lp,lv,rx,ry,rp,rv))
+        record = (t,lx,ly,lp,lv,rx,ry,rp,rv)
+        self.gaze_data.append(record)
+        for hook in self._sample_hooks:
+            hook(record)
+
+
+    def add_sample_hook(self, func, batch_func=None):
+        """
+        Register a function called with every raw sample
+        (t, lx, ly, lp, lv, rx, ry, rp, rv) received from Tobii.
+        The function is called from Tobii's callback thread, so it must
+        return quickly.  Registering the same function twice has no effect.
+        
+        If batch_func is given, it is called instead of func when samples
+        are received in blocks (see subscribe(out_of_process=True)).
+        batch_func must have the same effect as calling func for each
+        sample in the block.
+        
+        :param func: Function that receives a tuple.
+        :param batch_func: Function that receives a numpy.ndarray of shape
+            (n, 9).  Default value is None.
+        """
+        
+        if func not in self._sample_hooks:
+            # replace the list and the dict so that the callback thread
+            # can use the old ones safely.
+            if batch_func is not None:
+                batch_hooks = dict(self._batch_hooks)
+                batch_hooks[func] = batch_func
+                self._batch_hooks = batch_hooks
+            self._sample_hooks = self._sample_hooks + [func]
+
+
+    def remove_sample_hook(self, func):
+        """
+        Remove a function registered by
+        :func:`~psychopy_tobii_controller.tobii_controller.add_sample_hook`.
+        
+        :param func: Registered function.
+        """
+        
+        self._sample_hooks = [f for f in self._sample_hooks if f != func]
+        if func in self._batch_hooks:
+            self._batch_hooks = {f:b for f, b in self._batch_hooks.items() if f != func}
+
+
+    def stream(self, interval=0.01, max_pending=None, max_batch=None):
+        """
+        Get an asynchronous iterator of batches of raw gaze samples for
+        asyncio applications.
+        See :class:`~psychopy_tobii_controller.aio.gaze_stream`.
+        
+        *Example* ::
+        
+            async def main():
+                controller.subscribe()
+                async for batch in controller.stream():
+                    print(len(batch), batch[-1])
+        
+        :param float interval: Minimum interval between wakeups of the
+            event loop (s).  Default value is 0.01.
+        :param int max_pending: Maximum number of unread samples.
+            If None, no sample is skipped.  Default value is None.
+        :param int max_batch: Maximum number of samples in a batch.
+            If None, all unread samples are returned.  Default value is None.
+        """
+        
+        from . import aio
+        return aio.gaze_stream(self, interval, max_pending, max_batch)
+
+
+    async def wait_fixation(self, duration=200.0, max_dispersion=None, aoi=None, timeout=None):
+        """
+        Wait until gaze is stable for duration (coroutine).
+        See :func:`~psychopy_tobii_controller.aio.wait_fixation`.
+        
+        *Example* ::
+        
+            pos = await controller.wait_fixation(300, aoi='fixation_point', timeout=5.0)
+        
+        :param float duration: Duration of fixation (ms).  Default value is 200.0.
+        :param float max_dispersion: Maximum standard deviation of gaze
+            position in PsychoPy's units.
+        :param aoi: Name of AOI.
+        :param float timeout: Timeout (s).  If None, wait forever.
+        """
+        
+        from . import aio
+        return await aio.wait_fixation(self, duration, max_dispersion, aoi, timeout)
+
+
+    def start_publisher(self, address=('127.0.0.1', 50000), family='udp', interval=0.005):
+        """
+        Start broadcasting raw gaze samples to other machines or
+        applications.  All samples are sent in batches.
+        Use :class:`~psychopy_tobii_controller.network.gaze_subscriber`
+        to receive them.
+        
+        :param address: Destination.  A tuple of (host, port) for 'udp' or
+            a path for 'unix'.  Default value is ('127.0.0.1', 50000).
+        :param str family: 'udp' or 'unix'.  Default value is 'udp'.
+        :param float interval: Interval of sending (s).  Default value is 0.005.
+        """
+        
+        self.stop_publisher()
+        from .network import gaze_publisher
+        self.publisher = gaze_publisher(self, address, family, interval)
+        self.publisher.start()
+
+
+    def stop_publisher(self):
+        """
+        Stop broadcasting started by
+        :func:`~psychopy_tobii_controller.tobii_controller.start_publisher`.
+        """
+        
+        if self.publisher is not None:
+            self.publisher.stop()
+            self.publisher = None
 
 
     def get_current_gaze_position(self):
@@ -778,14 +1292,462 @@ class tobii_controller:
         Get current (i.e. the latest) gaze position as a tuple of
         (left_x, left_y, right_x, right_y).
         Values are numpy.nan if Tobii fails to get gaze position.
+        If a gaze filter is set by
+        :func:`~psychopy_tobii_controller.tobii_controller.set_gaze_filter`,
+        the filtered position is returned.
         """
         
-        if len(self.gaze_data)==0:
+        if self.gaze_filter is not None:
+            gaze = self.filtered_gaze
+            if gaze is None:
+                return (np.nan, np.nan, np.nan, np.nan)
+            lxy = self.get_psychopy_pos(gaze[0:2])
+            rxy = self.get_psychopy_pos(gaze[2:4])
+            return (lxy[0],lxy[1],rxy[0],rxy[1])
+        
+        latest = self._get_latest_sample()
+        if latest is None:
             return (np.nan, np.nan, np.nan, np.nan)
         else:
-            lxy = self.get_psychopy_pos(self.gaze_data[-1][1:3])
-            rxy = self.get_psychopy_pos(self.gaze_data[-1][5:7])
+            lxy = self.get_psychopy_pos(latest[1:3])
+            rxy = self.get_psychopy_pos(latest[5:7])
+            return (lxy[0],lxy[1],rxy[0],rxy[1])
+
+
+    def _get_latest_sample(self):
+        """
+        Get the latest raw sample or None.  If gaze data are received
+        out of process, the sample is read directly from shared memory.
+        """
+        
+        if self.acquisition is not None:
+            latest = self.acquisition.latest()
+            if latest is not None:
+                return latest
+        if len(self.gaze_data)==0:
+            return None
+        return self.gaze_data[-1]
+
+
+    def set_gaze_filter(self, filter=None, **kwargs):
+        """
+        Set an online filter applied to gaze position.
+        
+        The filter runs in the sample path of Tobii's callback thread, so
+        :func:`~psychopy_tobii_controller.tobii_controller.get_current_gaze_position`
+        returns the filtered position without extra cost per frame.
+        Recorded data are not filtered.
+        
+        *Example* ::
+        
+            controller.set_gaze_filter('one_euro', min_cutoff=1.0, beta=1.0)
+        
+        :param filter: 'one_euro', 'exponential', 'kalman', an instance of
+            :class:`~psychopy_tobii_controller.filters.gaze_filter` or
+            None (disable filter).  Default value is None.
+        
+        Other keyword arguments are passed to the filter.  See
+        :mod:`psychopy_tobii_controller.filters`.
+        """
+        
+        if filter is None:
+            new_filter = None
+        elif isinstance(filter, gaze_filter):
+            new_filter = filter
+        else:
+            new_filter = make_filter(filter, **kwargs)
+        
+        self.remove_sample_hook(self.update_gaze_filter)
+        self.filtered_gaze = None
+        self.gaze_filter = new_filter
+        if new_filter is not None:
+            self.add_sample_hook(self.update_gaze_filter, self.update_gaze_filter_batch)
+
+
+    def update_gaze_filter(self, record):
+        """
+        Apply the gaze filter to a sample.
+        This is called from the sample path of Tobii's callback thread
+        while a gaze filter is set.
+        
+        Usually, users don't have to call this method.
+        
+        :param record: Raw sample (t, lx, ly, lp, lv, rx, ry, rp, rv).
+        """
+        
+        t, lx, ly, lp, lv, rx, ry, rp, rv = record
+        if not lv:
+            lx = ly = np.nan
+        if not rv:
+            rx = ry = np.nan
+        self.filtered_gaze = tuple(self.gaze_filter.update(t/1e6, (lx, ly, rx, ry)))
+
+
+    def update_gaze_filter_batch(self, samples):
+        """
+        Apply the gaze filter to a block of samples.  The result is the
+        same as calling
+        :func:`~psychopy_tobii_controller.tobii_controller.update_gaze_filter`
+        for each sample.
+        
+        Usually, users don't have to call this method.
+        
+        :param samples: numpy.ndarray of shape (n, 9).
+        """
+        
+        samples = np.asarray(samples, dtype=float)
+        if len(samples) == 0:
+            return
+        values = samples[:,[1,2,5,6]].copy()
+        values[samples[:,4]==0,:2] = np.nan
+        values[samples[:,8]==0,2:] = np.nan
+        self.filtered_gaze = tuple(self.gaze_filter.update_batch(samples[:,0]/1e6, values))
+
+
+    def get_gaze_window(self, duration, stat='mean'):
+        """
+        Get statistics of gaze position over the latest samples.
+        The window covers samples received within duration (ms) before
+        the latest sample.  Only valid samples of each eye are used.
+        Cost does not depend on the duration (timestamps are bisected and
+        running sums of the gaze buffer are used).
+        
+        - 'mean': mean position (left_x, left_y, right_x, right_y) in
+          PsychoPy's coordinates.
+        - 'std': standard deviation of position (left_x, left_y, right_x,
+          right_y) in PsychoPy's units.
+        - 'valid_ratio': proportion of valid samples (left, right).
+        - 'count': number of samples in the window.
+        
+        Values are numpy.nan if no valid sample is available.
+        
+        :param float duration: Length of the window (ms).
+        :param str stat: 'mean', 'std', 'valid_ratio' or 'count'.
+            Default value is 'mean'.
+        """
+        
+        if stat not in ('mean', 'std', 'valid_ratio', 'count'):
+            raise ValueError('stat must be mean, std, valid_ratio or count')
+        
+        if len(self.gaze_data)==0:
+            sums, n = np.zeros(gaze_buffer.n_sums), 0
+        else:
+            sums, n = self.gaze_data.get_window_sums(self.gaze_data[-1][0]-duration*1000.0)
+        if stat == 'count':
+            return n
+        if stat == 'valid_ratio':
+            if n == 0:
+                return (np.nan, np.nan)
+            return (sums[2]/n, sums[5]/n)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.array([sums[0]/sums[2], sums[1]/sums[2], sums[3]/sums[5], sums[4]/sums[5]])
+        lxy = self.get_psychopy_pos(mean[0:2])
+        rxy = self.get_psychopy_pos(mean[2:4])
+        if stat == 'mean':
             return (lxy[0],lxy[1],rxy[0],rxy[1])
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sq = np.array([sums[6]/sums[2], sums[7]/sums[2], sums[8]/sums[5], sums[9]/sums[5]])
+            std = np.sqrt(np.maximum(sq-mean**2, 0.0))
+        # displacement by std in PsychoPy's units
+        lxy_std = self.get_psychopy_pos(mean[0:2]+std[0:2])
+        rxy_std = self.get_psychopy_pos(mean[2:4]+std[2:4])
+        return (abs(lxy_std[0]-lxy[0]), abs(lxy_std[1]-lxy[1]),
+                abs(rxy_std[0]-rxy[0]), abs(rxy_std[1]-rxy[1]))
+
+
+    def get_next_flip_time(self):
+        """
+        Estimate the time of the next flip of the window from the time of
+        the last flip and the frame period.  Unit is second
+        (psychopy.core.getTime()).
+        """
+        
+        now = self.psychopy_core.getTime()
+        period = getattr(self.win, 'monitorFramePeriod', None) or 1.0/60
+        last = getattr(self.win, 'lastFrameT', None)
+        if last is None or last > now:
+            return now+period
+        return last + (np.floor((now-last)/period)+1)*period
+
+
+    def get_predicted_gaze_position(self, flip_time=None, display_latency=0.0):
+        """
+        Get gaze position predicted at the time when the next frame
+        appears on the screen, as a tuple of (left_x, left_y, right_x, right_y).
+        Values are numpy.nan if Tobii fails to get gaze position.
+        
+        Gaze position is extrapolated from the latest samples by
+        :class:`~psychopy_tobii_controller.prediction.gaze_predictor`
+        (tobii_controller.gaze_predictor).  Prediction horizon (ms) of
+        the last call is available as tobii_controller.gaze_predictor.horizon.
+        
+        :param float flip_time: Time of the next flip (psychopy.core.getTime()).
+            If None, it is estimated by
+            :func:`~psychopy_tobii_controller.tobii_controller.get_next_flip_time`.
+        :param float display_latency: Delay from flip to the update of the
+            screen (ms).  Default value is 0.0.
+        """
+        
+        if flip_time is None:
+            flip_time = self.get_next_flip_time()
+        t = self.clock_sync.map_timestamps(flip_time, 'psychopy', 'system') + display_latency*1000.0
+        samples = self.gaze_data[-self.gaze_predictor.n_samples:] if len(self.gaze_data) > 0 \
+            else np.empty((0,9))
+        gaze = self.gaze_predictor.predict(samples, float(t))
+        lxy = self.get_psychopy_pos(gaze[0:2])
+        rxy = self.get_psychopy_pos(gaze[2:4])
+        return (lxy[0],lxy[1],rxy[0],rxy[1])
+
+
+    def get_prediction_stats(self, horizon=None):
+        """
+        Measure error of gaze prediction by replaying samples recorded
+        in the current session.  Errors are in pixels.
+        See :func:`~psychopy_tobii_controller.prediction.gaze_predictor.evaluate`.
+        
+        :param float horizon: Prediction horizon (ms).  If None, horizon
+            of the last call of get_predicted_gaze_position is used.
+        """
+        
+        if horizon is None:
+            horizon = self.gaze_predictor.horizon
+        return self.gaze_predictor.evaluate(self.gaze_data.array(), horizon, self.win.size)
+
+
+    def get_gaze_filter_latency(self):
+        """
+        Get the current lag (ms) caused by the gaze filter.
+        See :attr:`psychopy_tobii_controller.filters.gaze_filter.latency`.
+        If no filter is set, 0.0 is returned.
+        """
+        
+        if self.gaze_filter is None:
+            return 0.0
+        return self.gaze_filter.latency
+
+
+    def _pix_pos(self, p):
+        """
+        Convert PsychoPy position to pixels from the center of the window.
+        """
+        
+        gp = self.get_tobii_pos(p)
+        return ((gp[0]-0.5)*self.win.size[0], (0.5-gp[1])*self.win.size[1])
+
+
+    def _enable_aoi(self):
+        self.add_sample_hook(self.update_aoi, self.update_aoi_batch)
+
+
+    def add_aoi_rect(self, name, pos, size):
+        """
+        Register a rectangular area of interest (AOI).
+        
+        AOIs are tested against every gaze sample received from Tobii
+        and dwell time of each AOI is accumulated during recording.
+        See :func:`~psychopy_tobii_controller.tobii_controller.get_current_aoi`
+        and :func:`~psychopy_tobii_controller.tobii_controller.get_aoi_counters`.
+        
+        :param name: Name of the AOI.
+        :param pos: Center of the rectangle (x, y) in PsychoPy's coordinates.
+        :param size: Size of the rectangle (width, height) in PsychoPy's units.
+        """
+        
+        p0 = self._pix_pos((pos[0]-size[0]/2.0, pos[1]-size[1]/2.0))
+        p1 = self._pix_pos((pos[0]+size[0]/2.0, pos[1]+size[1]/2.0))
+        self.aoi.add_rect(name, p0[0], p0[1], p1[0], p1[1])
+        self._enable_aoi()
+
+
+    def add_aoi_circle(self, name, pos, radius):
+        """
+        Register a circular area of interest (AOI).
+        See :func:`~psychopy_tobii_controller.tobii_controller.add_aoi_rect`.
+        
+        :param name: Name of the AOI.
+        :param pos: Center of the circle (x, y) in PsychoPy's coordinates.
+        :param float radius: Radius of the circle in PsychoPy's units.
+        """
+        
+        c = self._pix_pos(pos)
+        r = abs(self._pix_pos((pos[0]+radius, pos[1]))[0]-c[0])
+        self.aoi.add_circle(name, c[0], c[1], r)
+        self._enable_aoi()
+
+
+    def add_aoi_polygon(self, name, vertices):
+        """
+        Register a polygonal area of interest (AOI).
+        See :func:`~psychopy_tobii_controller.tobii_controller.add_aoi_rect`.
+        
+        :param name: Name of the AOI.
+        :param vertices: Sequence of vertices [(x1, y1), (x2, y2), ...]
+            in PsychoPy's coordinates.
+        """
+        
+        self.aoi.add_polygon(name, [self._pix_pos(v) for v in vertices])
+        self._enable_aoi()
+
+
+    def add_aoi_stim(self, name, stim):
+        """
+        Register the bounding box of a PsychoPy stimulus as an area of
+        interest (AOI).  Note that the AOI does not follow the stimulus
+        when the stimulus is moved later.
+        See :func:`~psychopy_tobii_controller.tobii_controller.add_aoi_rect`.
+        
+        :param name: Name of the AOI.
+        :param stim: PsychoPy visual stimulus (e.g. ImageStim, TextStim).
+        """
+        
+        try:
+            vertices = np.asarray(stim.verticesPix, dtype=float).reshape(-1,2)
+        except AttributeError:
+            raise ValueError('bounds of stimulus ({}) are not available.'.format(stim))
+        self.aoi.add_rect(name, vertices[:,0].min(), vertices[:,1].min(),
+                          vertices[:,0].max(), vertices[:,1].max())
+        self._enable_aoi()
+
+
+    def remove_aoi(self, name):
+        """
+        Remove an area of interest (AOI).
+        
+        :param name: Name of the AOI.
+        """
+        
+        self.aoi.remove(name)
+        self.aoi_hits = self.aoi.contains(np.nan, np.nan)
+
+
+    def clear_aoi(self):
+        """
+        Remove all areas of interest (AOIs).
+        """
+        
+        self.aoi.clear()
+        self.aoi_hits = self.aoi.contains(np.nan, np.nan)
+
+
+    def update_aoi(self, record):
+        """
+        Test AOIs against a gaze sample and update dwell time.
+        This is called from the sample path of Tobii's callback thread
+        while AOIs are registered.
+        
+        Usually, users don't have to call this method.
+        
+        :param record: Raw sample (t, lx, ly, lp, lv, rx, ry, rp, rv).
+        """
+        
+        t, lx, ly, lp, lv, rx, ry, rp, rv = record
+        if lv and rv:
+            x, y = (lx+rx)/2.0, (ly+ry)/2.0
+        elif lv:
+            x, y = lx, ly
+        elif rv:
+            x, y = rx, ry
+        else:
+            x = y = np.nan
+        self.aoi_hits = self.aoi.update(t/1000.0,
+            (x-0.5)*self.win.size[0], (0.5-y)*self.win.size[1])
+
+
+    def update_aoi_batch(self, samples):
+        """
+        Test AOIs against a block of samples and update dwell time.  The
+        result is the same as calling
+        :func:`~psychopy_tobii_controller.tobii_controller.update_aoi`
+        for each sample.
+        
+        Usually, users don't have to call this method.
+        
+        :param samples: numpy.ndarray of shape (n, 9).
+        """
+        
+        samples = np.asarray(samples, dtype=float)
+        if len(samples) == 0:
+            return
+        lv = samples[:,4] != 0
+        rv = samples[:,8] != 0
+        with np.errstate(invalid='ignore'):
+            x = np.where(lv & rv, (samples[:,1]+samples[:,5])/2.0,
+                         np.where(lv, samples[:,1], np.where(rv, samples[:,5], np.nan)))
+            y = np.where(lv & rv, (samples[:,2]+samples[:,6])/2.0,
+                         np.where(lv, samples[:,2], np.where(rv, samples[:,6], np.nan)))
+        self.aoi_hits = self.aoi.update_batch(samples[:,0]/1000.0,
+            (x-0.5)*self.win.size[0], (0.5-y)*self.win.size[1])
+
+
+    def get_current_aoi(self):
+        """
+        Get names of areas of interest (AOIs) that contain the current
+        (i.e. the latest) gaze position.  Gaze position is the average of
+        valid eyes.  Returned value is a list.
+        """
+        
+        return self.aoi.get_names(self.aoi_hits)
+
+
+    def get_aoi_dwell(self, name):
+        """
+        Get how long (ms) the gaze has stayed in an area of interest (AOI)
+        without leaving it.  If the current gaze position is not in the
+        AOI, 0.0 is returned.
+        
+        *Example* ::
+        
+            if controller.get_aoi_dwell('target') >= 300:
+                # gaze has stayed in the AOI for 300 ms.
+        
+        :param name: Name of the AOI.
+        """
+        
+        return self.aoi.get_current_dwell(name)
+
+
+    def get_aoi_counters(self):
+        """
+        Get dwell time (ms), number of samples and number of entries of
+        areas of interest (AOIs) since recording started.
+        Returned value is a dict object that maps name of AOI to a tuple
+        of (dwell_time, n_samples, n_entries).
+        """
+        
+        return self.aoi.get_counters()
+
+
+    def reset_aoi_counters(self):
+        """
+        Reset dwell time, number of samples and number of entries of
+        areas of interest (AOIs).  Counters are also reset when
+        recording is started.
+        """
+        
+        self.aoi.reset_counters()
+
+
+    def map_timestamps(self, t, src, dst):
+        """
+        Convert timestamps between Tobii's device clock ('device'),
+        Tobii's system clock ('system'), PsychoPy's clock ('psychopy')
+        and the clock of the data file ('session').
+        Conversion is based on linear fits of time synchronization data
+        received during recording.
+        See :func:`~psychopy_tobii_controller.clock.map_timestamps`.
+        
+        :param t: Timestamp(s).  Scalar or array-like.
+        :param str src: Name of clock of t.
+        :param str dst: Name of clock to which t is converted.
+        """
+        
+        if len(self.gaze_data) > 0:
+            session_start = self.gaze_data[0][0]
+        else:
+            session_start = None
+        return self.clock_sync.map_timestamps(t, src, dst, session_start)
 
 
     def get_current_pupil_size(self):
@@ -795,61 +1757,125 @@ class tobii_controller:
         Values are numpy.nan if Tobii fails to get pupil size.
         """
         
-        if len(self.gaze_data)==0:
+        latest = self._get_latest_sample()
+        if latest is None:
             return (None,None)
         else:
-            return (self.gaze_data[-1][3], #lp
-                    self.gaze_data[-1][7]) #rp
+            return (latest[3], #lp
+                    latest[7]) #rp
 
 
-    def open_datafile(self, filename, embed_events=False):
+    def open_datafile(self, filename, embed_events=False, compression='auto',
+            compresslevel=None, raw=False):
         """
         Open data file.
         
+        Data file can be compressed by gzip, bz2 or lzma.  Compressed data
+        files are read transparently by
+        :func:`~psychopy_tobii_controller.utility.load_data`.
+        
+        If raw is True, gaze positions are written in Tobii's display area
+        coordinates (0.0 to 1.0, origin at the top-left corner of the
+        screen) without conversion to PsychoPy's units.  Window size,
+        units and monitor geometry are written in the header so that
+        :func:`~psychopy_tobii_controller.utility.load_data` converts
+        positions to any units when they are loaded.
+        
         :param str filename: Name of data file to be opened.
         :param bool embed_events: If True, event data is 
             embeded in gaze data.  Otherwise, event data is 
             separately output after gaze data.
+        :param compression: 'gzip', 'bz2', 'lzma' or None (not compressed).
+            If 'auto', compression is selected from the extension of
+            filename ('.gz', '.bz2', '.xz' or '.lzma').
+            Default value is 'auto'.
+        :param int compresslevel: Compression level.  If None, default
+            level of the compression module is used.
+            Default value is None.
+        :param bool raw: If True, gaze positions are not converted to
+            PsychoPy's units.  Default value is False.
         """
         
         if self.datafile is not None:
             self.close_datafile()
         
         self.embed_events = embed_events
-        self.datafile = open(filename,'w')
-        self.datafile.write('Recording date:\t'+datetime.datetime.now().strftime('%Y/%m/%d')+'\n')
-        self.datafile.write('Recording time:\t'+datetime.datetime.now().strftime('%H:%M:%S')+'\n')
-        self.datafile.write('Recording resolution:\t%d x %d\n' % tuple(self.win.size))
+        self.raw_datafile = raw
+        self.datafile = open_text(filename, 'w', compression, compresslevel)
+        self.datafile_summaries = []
+        self.write_datafile_info(self.datafile, raw)
         if embed_events:
             self.datafile.write('Event recording mode:\tEmbedded\n\n')
         else:
             self.datafile.write('Event recording mode:\tSeparated\n\n')
 
 
-    def close_datafile(self):
+    def write_datafile_info(self, datafile, raw=False):
+        """
+        Write recording date and time, coordinate system and geometry of
+        the window and the monitor at the beginning of a data file.
+        These items are used to convert gaze positions when the data
+        file is loaded (see
+        :func:`~psychopy_tobii_controller.utility.convert_gaze_units`).
+        Usually, users don't have to call this method.
+        
+        :param datafile: File object.
+        :param bool raw: If True, gaze positions in the data file are
+            Tobii's display area coordinates.  Default value is False.
+        """
+        
+        datafile.write('Recording date:\t'+datetime.datetime.now().strftime('%Y/%m/%d')+'\n')
+        datafile.write('Recording time:\t'+datetime.datetime.now().strftime('%H:%M:%S')+'\n')
+        datafile.write('Recording resolution:\t%d x %d\n' % tuple(self.win.size))
+        datafile.write('Coordinate system:\t%s\n' % ('Raw' if raw else 'PsychoPy'))
+        datafile.write('Window units:\t%s\n' % self.win.units)
+        width, distance = self.get_screen_geometry()
+        datafile.write('Monitor width:\t%s\n' % width)
+        datafile.write('Viewing distance:\t%s\n' % distance)
+        try:
+            datafile.write('Monitor resolution:\t%d x %d\n' % tuple(self.win.monitor.getSizePix()))
+        except (AttributeError, TypeError):
+            pass
+
+
+    def close_datafile(self, qa_summary=False):
         """
         Write data to the data file and close the data file.
+        
+        :param bool qa_summary: If True, summaries of sessions (data loss,
+            sampling rate, jitter, gaps and number of events) are written
+            at the end of the data file, so that
+            :func:`~psychopy_tobii_controller.qa.summarize_file` and the
+            ptc-qa command do not have to read the data.
+            Default value is False.
         """
         
         if self.datafile != None:
             self.flush_data()
+            if qa_summary:
+                from .qa import write_summary
+                write_summary(self.datafile, self.datafile_summaries)
             self.datafile.close()
         
         self.datafile = None
 
 
-    def record_event(self,event):
+    def record_event(self, event, values=None):
         """
         Record events with timestamp.
+        This method can be called from any thread.
         
         Note: This method works only during recording.
         
         :param str event: Any string.
+        :param values: Sequence of numbers (e.g. trigger code) recorded
+            with the event.  They are output to the data file after the
+            event string.  Default value is None.
         """
         if not self.recording:
             return
         
-        self.event_data.append((self.tobii_research.get_system_time_stamp(), event))
+        self.event_data.append(self.tobii_research.get_system_time_stamp(), event, values)
 
 
     def flush_data(self):
@@ -869,7 +1895,10 @@ class tobii_controller:
         if self.recording:
             return
         
+        timestamp_start = self.gaze_data[0][0]
+        
         self.datafile.write('Session Start\n')
+        self.clock_sync.write_fit(self.datafile, timestamp_start)
         
         if self.embed_events:
             self.datafile.write('\t'.join(['TimeStamp',
@@ -899,52 +1928,78 @@ class tobii_controller:
 
         format_string = '%.1f\t%.4f\t%.4f\t%.4f\t%d\t%.4f\t%.4f\t%.4f\t%d\t%.4f\t%.4f'
         
-        timestamp_start = self.gaze_data[0][0]
-        num_output_events = 0
+        gaze = self.gaze_data.array()
+        output_data = self.convert_tobii_records(gaze, timestamp_start, self.raw_datafile)
+        
+        order = np.argsort(self.event_data.times(), kind='stable')
+        event_t = self.event_data.times()[order]
+        event_text = self.event_data.format_events(order)
         
         if self.embed_events:
-            for i in range(len(self.gaze_data)):
-                if num_output_events < len(self.event_data) and self.event_data[num_output_events][0] < self.gaze_data[i][0]:
-                    event_t = self.event_data[num_output_events][0]
-                    event_text = self.event_data[num_output_events][1]
-                    
-                    if i>0:
-                        output_data = self.convert_tobii_record(
-                            self.interpolate_gaze_data(self.gaze_data[i-1], self.gaze_data[i], event_t),
-                            timestamp_start)
-                    else:
-                        output_data = ((event_t-timestamp_start)/1000.0, np.nan, np.nan, np.nan, 0,
-                                       np.nan, np.nan, np.nan, 0, np.nan, np.nan)
-                    
-                    self.datafile.write(format_string % output_data)
-                    self.datafile.write('\t%s\n' % (event_text))
-
-                    num_output_events += 1
-                
-                self.datafile.write(format_string % self.convert_tobii_record(self.gaze_data[i], timestamp_start))
-                self.datafile.write('\t\n')
-
-            # flush remaining events
-            if num_output_events < len(self.event_data):
-                for e_i in range(num_output_events, len(self.event_data)):
-                    event_t = self.event_data[e_i][0]
-                    event_text = self.event_data[e_i][1]
-                    
-                    output_data = ((event_t-timestamp_start)/1000.0, np.nan, np.nan, np.nan, 0,
-                                   np.nan, np.nan, np.nan, 0, np.nan, np.nan)
-                    self.datafile.write(format_string % output_data)
-                    self.datafile.write('\t%s\n' % (event_text))
+            # index of the first sample recorded after each event
+            idx = np.searchsorted(gaze[:,0], event_t, side='right')
+            inside = (idx > 0) & (idx < len(gaze))
+            
+            event_data = np.full((len(event_t), 11), np.nan)
+            event_data[:,0] = (event_t-timestamp_start)/1000.0
+            event_data[:,[4,8]] = 0
+            if np.any(inside):
+                event_data[inside] = self.convert_tobii_records(
+                    self.interpolate_gaze_records(gaze[idx[inside]-1], gaze[idx[inside]], event_t[inside]),
+                    timestamp_start, self.raw_datafile)
+            
+            # event j is placed before sample idx[j] (and after preceding events)
+            n_rows = len(gaze)+len(event_t)
+            event_rows = idx+np.arange(len(event_t))
+            is_event = np.zeros(n_rows, dtype=bool)
+            is_event[event_rows] = True
+            rows = np.empty((n_rows, 11))
+            rows[is_event] = event_data
+            rows[~is_event] = output_data
+            
+            suffix = np.full(n_rows, '\t\n', dtype=object)
+            suffix[event_rows] = ['\t%s\n' % text for text in event_text]
+            self.datafile.write(''.join([format_string % tuple(row) + end
+                                         for row, end in zip(rows.tolist(), suffix)]))
         else:
-            for i in range(len(self.gaze_data)):
-                self.datafile.write(format_string % self.convert_tobii_record(self.gaze_data[i], timestamp_start))
-                self.datafile.write('\n')
+            self.datafile.write(''.join([format_string % tuple(row) + '\n'
+                                         for row in output_data.tolist()]))
             
             self.datafile.write('TimeStamp\tEvent\n')
-            for e in self.event_data:
-                self.datafile.write('%.1f\t%s\n' % ((e[0]-timestamp_start)/1000.0, e[1]))
+            for t, text in zip(event_t, event_text):
+                self.datafile.write('%.1f\t%s\n' % ((t-timestamp_start)/1000.0, text))
         
         self.datafile.write('Session End\n\n')
-        self.datafile.flush()
+        end_member(self.datafile)
+        
+        from .qa import session_summary, round_timestamps
+        summary = session_summary()
+        # timestamps are rounded as in the data file.
+        summary.add(round_timestamps(output_data[:,0]), output_data[:,4], output_data[:,8])
+        summary.n_events = len(event_t)
+        summary = summary.result()
+        summary['session'] = len(self.datafile_summaries)
+        summary['device'] = ''
+        self.datafile_summaries.append(summary)
+
+
+    def get_screen_geometry(self):
+        """
+        Get width of the screen (cm) and viewing distance (cm) from
+        the monitor profile of the PsychoPy Window object.
+        Returned value is a tuple of (width, distance).  If they are not
+        available, (None, None) is returned.
+        """
+        
+        monitor = self.win.monitor
+        try:
+            width = monitor.getWidth()
+            distance = monitor.getDistance()
+        except AttributeError:
+            return (None, None)
+        if not width or not distance:
+            return (None, None)
+        return (width, distance)
 
 
     def get_psychopy_pos(self, p):
@@ -990,7 +2045,7 @@ class tobii_controller:
             p_pix = (self.psychopy_unittools.cm2pix(p[0], self.win.monitor), self.psychopy_unittools.cm2pix(p[1], self.win.monitor))
             gp = (p_pix[0]/self.win.size[0]+0.5, p_pix[1]/self.win.size[1]+0.5)
         elif self.win.units == 'deg':
-            p_pix = (self.psychopy_unittools.deg2pix(p[0], self.win.monitor), self.psychopy_unittools.eg2pix(p[1], self.win.monitor))
+            p_pix = (self.psychopy_unittools.deg2pix(p[0], self.win.monitor), self.psychopy_unittools.deg2pix(p[1], self.win.monitor))
             gp = (p_pix[0]/self.win.size[0]+0.5, p_pix[1]/self.win.size[1]+0.5)
         elif self.win.units in ['degFlat', 'degFlatPos']:
             p_pix = (self.psychopy_unittools.deg2pix(np.array(p), self.win.monitor, correctFlat=True))
@@ -1026,9 +2081,77 @@ class tobii_controller:
                 rxy[0], rxy[1], record[7], record[8],
                 ave[0], ave[1])
 
+    def convert_tobii_records(self, records, start_time, raw=False):
+        """
+        Convert an array of tobii data to output style.
+        This is a vectorized version of
+        :func:`~psychopy_tobii_controller.tobii_controller.convert_tobii_record`.
+        Usually, users don't have to call this method.
+
+        :param records: numpy.ndarray of shape (n, 9) such as
+            self.gaze_data[start:end].
+        :param start_time: Tobii's timestamp when recording was started.
+        :param bool raw: If True, positions are not converted to
+            PsychoPy's units.  Default value is False.
+        """
+
+        records = np.asarray(records, dtype=float)
+        if raw:
+            lx, ly = records[:,1], records[:,2]
+            rx, ry = records[:,5], records[:,6]
+        else:
+            lx, ly = self.get_psychopy_pos((records[:,1], records[:,2]))
+            rx, ry = self.get_psychopy_pos((records[:,5], records[:,6]))
+        lv = records[:,4] != 0
+        rv = records[:,8] != 0
+
+        ave_x = np.where(lv & rv, (lx+rx)/2.0, np.where(lv, lx, np.where(rv, rx, np.nan)))
+        ave_y = np.where(lv & rv, (ly+ry)/2.0, np.where(lv, ly, np.where(rv, ry, np.nan)))
+
+        return np.column_stack(((records[:,0]-start_time)/1000.0,
+                                lx, ly, records[:,3], records[:,4],
+                                rx, ry, records[:,7], records[:,8],
+                                ave_x, ave_y))
+
+    def interpolate_gaze_records(self, records1, records2, t):
+        """
+        Interpolate gaze data between records1 and records2.
+        This is a vectorized version of
+        :func:`~psychopy_tobii_controller.tobii_controller.interpolate_gaze_data`.
+        Usually, users don't have to call this method.
+        
+        :param records1: numpy.ndarray of shape (n, 9).
+        :param records2: numpy.ndarray of shape (n, 9).
+        :param t: timestamps to calculate interpolation.
+        """
+        
+        t = np.asarray(t, dtype=float)
+        dt = records2[:,0]-records1[:,0]
+        w2 = np.divide(t-records1[:,0], dt, out=np.zeros(len(t)), where=dt!=0)
+        w1 = 1.0-w2
+        
+        result = np.empty(records1.shape)
+        result[:,0] = t
+        for cols, v in ((slice(1,4), 4), (slice(5,8), 8)):
+            valid1 = records1[:,v] != 0
+            valid2 = records2[:,v] != 0
+            both = valid1 & valid2
+            # use the valid one if the other is invalid
+            eye = np.where((valid2 & ~valid1)[:,np.newaxis], records2[:,cols], records1[:,cols])
+            eye[both] = w1[both,np.newaxis]*records1[both,cols] + w2[both,np.newaxis]*records2[both,cols]
+            result[:,cols] = eye
+            result[:,v] = np.where(valid1 | valid2, 1, 0)
+        
+        return result
+
     def interpolate_gaze_data(self, record1, record2, t):
         """
         Interpolate gaze data between record1 and record2.
+        Returned value is a tuple (t, lx, ly, lp, lv, rx, ry, rp, rv).
+        If one of the records is invalid for an eye, the other record is
+        used for the eye.  This is the same as
+        :func:`~psychopy_tobii_controller.tobii_controller.interpolate_gaze_records`
+        for a single pair of records.
         Usually, users don't have to call this method.
         
         :param record1: element of self.gaze_data.
@@ -1036,34 +2159,7 @@ class tobii_controller:
         :param t: timestamp to calculate interpolation.
         """
         
-        w1 = (record2[0]-t)/(record2[0]-record1[0])
-        w2 = (t-record1[0])/(record2[0]-record1[0])
-        
-        #left eye
-        if record1[4] == 0 and record2[4] == 0:
-            ldata = record1[1:5]
-        elif record1[4] == 0:
-            ldata = record2[1:5]
-        elif record2[4] == 0:
-            ldata = record1[1:5]
-        else:
-            ldata = (w1*record1[1] + w2*record2[1],
-                     w1*record1[2] + w2*record2[2],
-                     w1*record1[3] + w2*record2[3],
-                     1)
-
-        #right eye
-        if record1[8] == 0 and record2[8] == 0:
-            rdata = record1[5:9]
-        elif record1[4] == 0:
-            rdata = record2[5:9]
-        elif record2[4] == 0:
-            rdata = record1[5:9]
-        else:
-            rdata = (w1*record1[5] + w2*record2[5],
-                     w1*record1[6] + w2*record2[6],
-                     w1*record1[7] + w2*record2[7],
-                     1)
-
-        return (t,) + ldata + rdata
+        records1 = np.asarray(record1, dtype=float).reshape(1, 9)
+        records2 = np.asarray(record2, dtype=float).reshape(1, 9)
+        return tuple(self.interpolate_gaze_records(records1, records2, [t])[0].tolist())
         
\ No newline at end of file
@@ -0,0 +1,124 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import json
+import datetime
+import warnings
+
+default_cache_file = os.path.join(os.path.expanduser('~'),
+                                  '.psychopy_tobii_controller',
+                                  'eyetrackers.json')
+
+
+def load_eyetracker_cache(cache_file=None):
+    """
+    Load addresses of Tobii units found by the last search.
+    Returned value is a list of addresses.  If the cache file does not
+    exist or is broken, an empty list is returned.
+
+    :param str cache_file: Name of cache file.  If None, default
+        cache file in user's home directory is used.
+    """
+
+    if cache_file is None:
+        cache_file = default_cache_file
+
+    try:
+        with open(cache_file, 'r') as fp:
+            return list(json.load(fp)['addresses'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def save_eyetracker_cache(addresses, cache_file=None):
+    """
+    Save addresses of Tobii units.  The cache file is replaced
+    atomically.
+
+    :param addresses: List of addresses.
+    :param str cache_file: Name of cache file.  If None, default
+        cache file in user's home directory is used.
+    """
+
+    if cache_file is None:
+        cache_file = default_cache_file
+
+    # write to a temporary file first and replace the cache file so that
+    # other processes never read a partially written cache.  The name of
+    # the temporary file is unique to the process.
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, 'w') as fp:
+            json.dump({'addresses': list(addresses),
+                       'updated': datetime.datetime.now().isoformat()}, fp)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        warnings.warn('failed to write eyetracker cache ({})'.format(e))
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def connect_eyetracker(tobii_research, id=0, address=None, use_cache=True, cache_file=None):
+    """
+    Connect to a Tobii unit.
+
+    If address is given, the unit is connected directly.  Otherwise,
+    address of the unit is looked up in the cache file if use_cache is
+    True.  Searching Tobii units with tobii_research.find_all_eyetrackers()
+    is performed only if connection with these addresses fails.
+    The result of the search is saved to the cache file.
+    If address is given and the unit is not found by the search,
+    RuntimeError is raised.
+
+    Usually, users don't have to call this function.
+
+    :param tobii_research: tobii_research module.
+    :param int id: Index of Tobii unit in the result of the search.
+    :param str address: Address of Tobii unit (e.g. 'tet-tcp://172.28.195.1').
+    :param bool use_cache: If True, cache file is used.
+    :param str cache_file: Name of cache file.  If None, default
+        cache file in user's home directory is used.
+    """
+
+    requested_address = address
+    if address is None and use_cache:
+        addresses = load_eyetracker_cache(cache_file)
+        if 0 <= id < len(addresses):
+            address = addresses[id]
+
+    if address is not None:
+        try:
+            return tobii_research.EyeTracker(address)
+        except Exception:
+            pass
+
+    eyetrackers = tobii_research.find_all_eyetrackers()
+    if use_cache and len(eyetrackers) > 0:
+        save_eyetracker_cache([e.address for e in eyetrackers], cache_file)
+
+    if len(eyetrackers)==0:
+        raise RuntimeError('No Tobii eyetrackers')
+
+    if requested_address is not None:
+        for e in eyetrackers:
+            if e.address == requested_address:
+                return e
+        raise RuntimeError('Eyetracker {} is not found.'.format(requested_address))
+
+    try:
+        return eyetrackers[id]
+    except:
+        raise ValueError(
+            'Invalid eyetracker ID {}\n({} eyetrackers found)'.format(
+                id, len(eyetrackers)))
@@ -0,0 +1,327 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class gaze_filter:
+    """
+    Base class of online gaze filters.
+
+    A filter receives samples one by one and holds its state in
+    preallocated arrays, so the cost per sample is constant.  Each
+    channel (e.g. left x, left y, right x, right y) is filtered
+    independently.  If a value is NaN, output of the channel is NaN and
+    the channel restarts from the next valid value (i.e. the filter does
+    not smooth across blinks and data loss).
+
+    :attr:`gain` is the current weight of the new sample in the output
+    (1.0 means no smoothing).  :attr:`latency` is the delay (ms) of an
+    exponential moving average with the same gain, which is a measure of
+    the lag caused by the filter.
+    """
+
+    def __init__(self, n_channels=4):
+        """
+        :param int n_channels: Number of channels.  Default value is 4.
+        """
+
+        self.n_channels = n_channels
+        self.output = np.full(n_channels, np.nan)
+        self.gain = np.ones(n_channels)
+        self.interval = np.nan
+        self._last_t = None
+        self._valid = np.zeros(n_channels, dtype=bool)
+
+
+    def reset(self):
+        """
+        Clear the state of the filter.
+        """
+
+        self.output[:] = np.nan
+        self.gain[:] = 1.0
+        self.interval = np.nan
+        self._last_t = None
+        self._valid[:] = False
+
+
+    def update(self, t, values):
+        """
+        Filter a new sample.
+        Returned value is :attr:`output`, which is overwritten by the next
+        call (copy it if necessary).
+
+        :param float t: Timestamp (s).
+        :param values: Sequence of values of channels.
+        """
+
+        values = np.asarray(values, dtype=float)
+        if self._last_t is None or t <= self._last_t:
+            dt = np.nan
+        else:
+            dt = t-self._last_t
+            self.interval = dt
+        self._last_t = t
+
+        new = ~np.isnan(values)
+        # channels that start (again) from this sample
+        start = new & (~self._valid | np.isnan(dt))
+        cont = new & ~start
+        if cont.any():
+            self._update(dt, values, cont)
+        self.output[start] = values[start]
+        self.gain[start] = 1.0
+        self._start(values, start)
+        self.output[~new] = np.nan
+        self._valid[:] = new
+        return self.output
+
+
+    def update_batch(self, t, values):
+        """
+        Filter a block of samples.  The state of the filter is the same as
+        after calling :func:`update` for each sample.  Returned value is
+        :attr:`output` after the last sample.
+
+        The base class calls :func:`update` for each sample because the
+        gain of adaptive filters depends on the previous output.
+
+        :param t: Array-like of timestamps (s).
+        :param values: Array-like of shape (n_samples, n_channels).
+        """
+
+        for ti, v in zip(np.asarray(t, dtype=float), np.asarray(values, dtype=float)):
+            self.update(ti, v)
+        return self.output
+
+
+    def _start(self, values, mask):
+        pass
+
+
+    def _update(self, dt, values, mask):
+        raise NotImplementedError
+
+
+    @property
+    def latency(self):
+        """
+        Lag (ms) of an exponential moving average with the current gain,
+        averaged over channels that have valid output.
+        """
+
+        gain = self.gain[self._valid]
+        if len(gain) == 0 or np.isnan(self.interval):
+            return np.nan
+        return float(np.mean((1.0-gain)/gain)*self.interval*1000.0)
+
+
+class exponential_filter(gaze_filter):
+    """
+    Exponential moving average.  The gain is constant.
+    """
+
+    def __init__(self, alpha=0.3, n_channels=4):
+        """
+        :param float alpha: Weight of the new sample (0 < alpha <= 1).
+            Default value is 0.3.
+        :param int n_channels: Number of channels.  Default value is 4.
+        """
+
+        if not 0 < alpha <= 1:
+            raise ValueError('alpha must be in (0, 1].')
+        gaze_filter.__init__(self, n_channels)
+        self.alpha = alpha
+
+
+    def _update(self, dt, values, mask):
+        self.output[mask] += self.alpha*(values[mask]-self.output[mask])
+        self.gain[mask] = self.alpha
+
+
+    def update_batch(self, t, values):
+        """
+        Filter a block of samples at once (vectorized).
+        See :func:`gaze_filter.update_batch`.
+        """
+
+        t = np.asarray(t, dtype=float)
+        values = np.asarray(values, dtype=float).reshape(len(t), self.n_channels)
+        n = len(t)
+        if n == 0:
+            return self.output
+        prev_t = np.concatenate(([np.nan if self._last_t is None else self._last_t], t[:-1]))
+        with np.errstate(invalid='ignore'):
+            continuous = t > prev_t
+        if continuous.any():
+            self.interval = (t-prev_t)[continuous][-1]
+        self._last_t = t[-1]
+
+        new = ~np.isnan(values)
+        prev_valid = np.vstack((self._valid[np.newaxis,:], new[:-1]))
+        start = new & (~prev_valid | ~continuous[:,np.newaxis])
+        index = np.arange(n)[:,np.newaxis]
+        # samples after the last start of each channel are averaged.
+        # Weights of old samples decay, so only the final output is
+        # calculated.
+        last_start = np.where(start, index, -1).max(axis=0)
+        decay = 1.0-self.alpha
+        weights = np.where(index > last_start, self.alpha*decay**(n-1-index), 0.0)
+        total = np.sum(weights*np.where(new, values, 0.0), axis=0)
+        channels = np.arange(self.n_channels)
+        first = np.where(last_start >= 0,
+                         values[np.maximum(last_start, 0), channels]*decay**(n-1-last_start),
+                         self.output*decay**n)
+        valid = new[-1]
+        self.output[:] = np.where(valid, first+total, np.nan)
+        last_valid = np.where(new, index, -1).max(axis=0)
+        received = last_valid >= 0
+        self.gain[received] = np.where(last_start[received] == last_valid[received], 1.0, self.alpha)
+        self._valid[:] = valid
+        return self.output
+
+
+class one_euro_filter(gaze_filter):
+    """
+    1 Euro filter (Casiez, Roussel and Vogel, 2012).
+
+    The cutoff frequency increases with speed, so that jitter is removed
+    during fixations while lag is small during saccades.  Speed is measured
+    in the units of the input per second (e.g. Tobii's display area
+    coordinates, where 1.0 is the width or height of the screen).
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=1.0, d_cutoff=1.0, n_channels=4):
+        """
+        :param float min_cutoff: Cutoff frequency (Hz) at zero speed.
+            Default value is 1.0.
+        :param float beta: Increase of cutoff frequency per unit speed.
+            Default value is 1.0.
+        :param float d_cutoff: Cutoff frequency (Hz) for speed.
+            Default value is 1.0.
+        :param int n_channels: Number of channels.  Default value is 4.
+        """
+
+        gaze_filter.__init__(self, n_channels)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.speed = np.zeros(n_channels)
+
+
+    def reset(self):
+        gaze_filter.reset(self)
+        self.speed[:] = 0.0
+
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0/(2*np.pi*cutoff)
+        return 1.0/(1.0+tau/dt)
+
+
+    def _start(self, values, mask):
+        self.speed[mask] = 0.0
+
+
+    def _update(self, dt, values, mask):
+        x = values[mask]
+        prev = self.output[mask]
+        speed = self.speed[mask]
+        speed += self._alpha(self.d_cutoff, dt)*((x-prev)/dt-speed)
+        alpha = self._alpha(self.min_cutoff+self.beta*np.abs(speed), dt)
+        self.output[mask] = prev + alpha*(x-prev)
+        self.speed[mask] = speed
+        self.gain[mask] = alpha
+
+
+class kalman_filter(gaze_filter):
+    """
+    Kalman filter with a constant velocity model.
+
+    Each channel has a state of (position, velocity).  Acceleration is
+    modeled as white noise with spectral density process_noise, and
+    measurements have variance measurement_noise.  Because velocity is
+    estimated, actual lag during smooth motion is smaller than
+    :attr:`latency`.
+    """
+
+    def __init__(self, process_noise=10.0, measurement_noise=1e-4, n_channels=4):
+        """
+        :param float process_noise: Spectral density of acceleration
+            ((units/s^2)^2/Hz).  Default value is 10.0.
+        :param float measurement_noise: Variance of measurement noise
+            (units^2).  Default value is 1e-4 (SD = 1% of the screen).
+        :param int n_channels: Number of channels.  Default value is 4.
+        """
+
+        gaze_filter.__init__(self, n_channels)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.velocity = np.zeros(n_channels)
+        # covariance (pp, pv, vv) of each channel
+        self.covariance = np.zeros((3, n_channels))
+
+
+    def reset(self):
+        gaze_filter.reset(self)
+        self.velocity[:] = 0.0
+        self.covariance[:] = 0.0
+
+
+    def _start(self, values, mask):
+        self.velocity[mask] = 0.0
+        self.covariance[0,mask] = self.measurement_noise
+        self.covariance[1,mask] = 0.0
+        self.covariance[2,mask] = self.measurement_noise*1e4
+
+
+    def _update(self, dt, values, mask):
+        q = self.process_noise
+        pp, pv, vv = self.covariance[:,mask]
+        x = self.output[mask]
+        v = self.velocity[mask]
+
+        # predict
+        x = x + v*dt
+        pp = pp + 2*dt*pv + dt*dt*vv + q*dt**3/3
+        pv = pv + dt*vv + q*dt**2/2
+        vv = vv + q*dt
+
+        # correct
+        s = pp + self.measurement_noise
+        k_p = pp/s
+        k_v = pv/s
+        residual = values[mask]-x
+        self.output[mask] = x + k_p*residual
+        self.velocity[mask] = v + k_v*residual
+        self.covariance[0,mask] = (1-k_p)*pp
+        self.covariance[1,mask] = (1-k_p)*pv
+        self.covariance[2,mask] = vv - k_v*pv
+        self.gain[mask] = k_p
+
+
+filter_types = {'exponential': exponential_filter,
+                'one_euro': one_euro_filter,
+                'kalman': kalman_filter}
+
+
+def make_filter(name, **kwargs):
+    """
+    Create a gaze filter by name ('exponential', 'one_euro' or 'kalman').
+    Keyword arguments are passed to the filter.
+
+    :param str name: Name of filter.
+    """
+
+    if name not in filter_types:
+        raise ValueError('filter ({}) is not supported.'.format(name))
+    return filter_types[name](**kwargs)
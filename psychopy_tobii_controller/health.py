@@ -0,0 +1,311 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import math
+import collections
+import warnings
+import numpy as np
+
+sampling_status = collections.namedtuple('sampling_status', (
+    'samples', 'elapsed', 'nominal_rate', 'rate', 'mean_rate', 'late', 'dropped',
+    'discontinuities', 'loss_streak', 'longest_loss_streak', 'valid_ratio'))
+sampling_status.__doc__ = """
+Status of sampling returned by :attr:`sampling_monitor.status`.
+
+- samples: number of received samples.
+- elapsed: time from the first to the latest sample (ms).
+- nominal_rate: sampling rate reported by the eyetracker (Hz).
+- rate: recent effective sampling rate (Hz).
+- mean_rate: effective sampling rate since the start (Hz).
+- late: number of inter-sample intervals longer than tolerance.
+- dropped: estimated number of dropped samples.
+- discontinuities: number of timestamps that go backward or jump
+  more than the discontinuity threshold.
+- loss_streak: time since the last sample where at least one eye is
+  valid (ms).  0.0 if the latest sample is valid.
+- longest_loss_streak: the longest loss_streak (ms).
+- valid_ratio: proportion of samples where at least one eye is valid.
+"""
+
+threshold_names = ('rate', 'dropped', 'late', 'discontinuities', 'loss_streak')
+
+
+class sampling_monitor:
+    """
+    Online monitor of sampling health.
+
+    Every sample is processed in constant time in the sample path and only
+    a few counters are updated, so :attr:`status` can be polled every
+    frame.  Inter-sample intervals longer than (1+late_tolerance) times
+    the nominal interval are counted as late, and the number of missing
+    samples in such intervals is added to dropped.  Intervals that are
+    not positive or longer than discontinuity (ms) are counted as
+    discontinuities and are not used for the other statistics.
+
+    Blocks of samples can be processed at once by :func:`update_batch`.
+
+    Callbacks can be registered by :func:`set_threshold`.  They are
+    called from Tobii's callback thread, so they must return quickly.
+    """
+
+    def __init__(self, nominal_rate=None, late_tolerance=0.5, discontinuity=100.0,
+                 window=1.0):
+        """
+        :param float nominal_rate: Nominal sampling rate (Hz).  If None,
+            late intervals are detected with the running mean interval.
+            Usually, this is set by the controller.
+        :param float late_tolerance: Tolerance of intervals relative to
+            the nominal interval.  Default value is 0.5.
+        :param float discontinuity: Interval (ms) regarded as a
+            discontinuity of timestamps.  Default value is 100.0.
+        :param float window: Time constant (s) of exponential weighting
+            of the recent rate.  Default value is 1.0.
+        """
+
+        self.late_tolerance = late_tolerance
+        self.discontinuity = discontinuity
+        self.window = window
+        self._thresholds = {}
+        self.reset(nominal_rate)
+
+
+    def reset(self, nominal_rate=None):
+        """
+        Clear counters.  Thresholds are kept.
+
+        :param float nominal_rate: Nominal sampling rate (Hz).
+            If None, the current value is kept.
+        """
+
+        if nominal_rate is not None or not hasattr(self, 'nominal_rate'):
+            self.nominal_rate = nominal_rate
+        self.samples = 0
+        self.valid_samples = 0
+        self.late = 0
+        self.dropped = 0
+        self.discontinuities = 0
+        self.longest_loss_streak = 0.0
+        self.interval = float('nan')
+        self._first_t = None
+        self._last_t = None
+        self._last_valid_t = None
+        self._elapsed = 0.0
+        self._intervals = 0
+        # exponentially weighted number of recent samples
+        self._recent = 0.0
+        for threshold in self._thresholds.values():
+            threshold[2] = False
+
+
+    def set_threshold(self, name, value, callback):
+        """
+        Register a callback called when a value crosses a threshold.
+        The callback is called once with (name, status) when the condition
+        becomes true, and is called again only after the condition has
+        become false.
+
+        - 'rate': recent rate falls below value (Hz).
+        - 'dropped', 'late', 'discontinuities': the count reaches value.
+        - 'loss_streak': loss streak reaches value (ms).
+
+        :param str name: Name of the value.
+        :param float value: Threshold.  If None, the callback is removed.
+        :param callback: Function that receives name and
+            :class:`sampling_status`.
+        """
+
+        if name not in threshold_names:
+            raise ValueError('threshold ({}) is not supported.'.format(name))
+        thresholds = dict(self._thresholds)
+        if value is None:
+            thresholds.pop(name, None)
+        else:
+            thresholds[name] = [value, callback, False]
+        # replace the dict so that the callback thread can iterate the old one.
+        self._thresholds = thresholds
+
+
+    def update(self, record):
+        """
+        Process a raw sample (t, lx, ly, lp, lv, rx, ry, rp, rv).
+        This is registered as a sample hook of the controller.
+
+        :param record: Raw sample.
+        """
+
+        self.add(record[0], record[4], record[8])
+
+
+    def update_batch(self, samples):
+        """
+        Process a block of raw samples at once.  The result is the same as
+        calling :func:`update` for each sample except that threshold
+        callbacks are tested only at the end of the block.  This is used
+        when samples are received in blocks (see
+        :class:`~psychopy_tobii_controller.acquisition.acquisition_process`).
+
+        :param samples: numpy.ndarray of shape (n, 9).
+        """
+
+        samples = np.asarray(samples, dtype=float)
+        n = len(samples)
+        if n == 0:
+            return
+        t = samples[:,0]
+        valid = (samples[:,4] != 0) | (samples[:,8] != 0)
+
+        if self._last_t is None:
+            self._first_t = float(t[0])
+            dt = np.diff(t)/1000.0
+        else:
+            dt = np.diff(t, prepend=self._last_t)/1000.0
+        self.samples += n
+        if len(dt) > 0:
+            self.interval = float(dt[-1])
+            discontinuity = (dt <= 0) | (dt > self.discontinuity)
+            self.discontinuities += int(np.count_nonzero(discontinuity))
+            dt = dt[~discontinuity]
+        if len(dt) > 0:
+            elapsed = np.cumsum(dt)
+            total = elapsed[-1]
+            tau = self.window*1000.0
+            # closed form of the recursive update in add()
+            self._recent = self._recent*math.exp(-total/tau) + \
+                float(np.exp(-(total-elapsed)/tau).sum())
+            if self.nominal_rate:
+                nominal = 1000.0/self.nominal_rate
+            else:
+                nominal = (self._elapsed+elapsed)/(self._intervals+np.arange(1, len(dt)+1))
+            late = dt > nominal*(1.0+self.late_tolerance)
+            if self.nominal_rate:
+                missing = dt[late]/nominal
+            else:
+                missing = dt[late]/nominal[late]
+            self.late += int(np.count_nonzero(late))
+            self.dropped += int(np.maximum((missing+0.5).astype(int)-1, 0).sum())
+            self._elapsed += float(total)
+            self._intervals += len(dt)
+        self._last_t = float(t[-1])
+
+        n_valid = int(np.count_nonzero(valid))
+        if n_valid < n:
+            # time of the last valid sample before each sample
+            last_valid = np.maximum.accumulate(np.where(valid, np.arange(n), -1))
+            start = self._first_t if self._last_valid_t is None else self._last_valid_t
+            start = np.where(last_valid >= 0, t[np.maximum(last_valid, 0)], start)
+            streak = float(((t-start)[~valid]).max())/1000.0
+            if streak > self.longest_loss_streak:
+                self.longest_loss_streak = streak
+        if n_valid > 0:
+            self.valid_samples += n_valid
+            self._last_valid_t = float(t[valid][-1])
+
+        if self._thresholds:
+            self._check_thresholds()
+
+
+    def add(self, t, lv, rv):
+        """
+        Process a timestamp and validity of a sample.
+
+        :param t: Tobii's system timestamp (us).
+        :param lv: Validity of the left eye.
+        :param rv: Validity of the right eye.
+        """
+
+        last = self._last_t
+        self.samples += 1
+        if last is None:
+            self._first_t = t
+        else:
+            dt = (t-last)/1000.0
+            self.interval = dt
+            if dt <= 0 or dt > self.discontinuity:
+                self.discontinuities += 1
+            else:
+                self._elapsed += dt
+                self._intervals += 1
+                self._recent = self._recent*math.exp(-dt/(self.window*1000.0)) + 1.0
+                nominal = 1000.0/self.nominal_rate if self.nominal_rate else self._elapsed/self._intervals
+                if dt > nominal*(1.0+self.late_tolerance):
+                    self.late += 1
+                    self.dropped += max(int(dt/nominal+0.5)-1, 0)
+        self._last_t = t
+
+        if lv or rv:
+            self.valid_samples += 1
+            self._last_valid_t = t
+        else:
+            streak = self._loss_streak(t)
+            if streak > self.longest_loss_streak:
+                self.longest_loss_streak = streak
+
+        if self._thresholds:
+            self._check_thresholds()
+
+
+    def _recent_rate(self):
+        if self._elapsed <= 0:
+            return float('nan')
+        tau = self.window*1000.0
+        return self._recent/(tau*(1.0-math.exp(-self._elapsed/tau)))*1000.0
+
+
+    def _loss_streak(self, t):
+        if self._last_valid_t == t:
+            return 0.0
+        start = self._first_t if self._last_valid_t is None else self._last_valid_t
+        return (t-start)/1000.0
+
+
+    def _check_thresholds(self):
+        values = None
+        for name, threshold in self._thresholds.items():
+            value, callback, active = threshold
+            if name == 'rate':
+                if self._elapsed < self.window*1000.0:
+                    continue
+                condition = self._recent_rate() < value
+            elif name == 'loss_streak':
+                condition = self._loss_streak(self._last_t) >= value
+            else:
+                condition = getattr(self, name) >= value
+            if condition and not active:
+                threshold[2] = True
+                if values is None:
+                    values = self.status
+                try:
+                    callback(name, values)
+                except Exception as e:
+                    warnings.warn('threshold callback ({}) raised an exception: {!r}'.format(name, e))
+            elif not condition and active:
+                threshold[2] = False
+
+
+    @property
+    def status(self):
+        """
+        Current :class:`sampling_status`.
+        """
+
+        n = self.samples
+        elapsed = 0.0 if n == 0 else (self._last_t-self._first_t)/1000.0
+        return sampling_status(
+            samples=n,
+            elapsed=elapsed,
+            nominal_rate=self.nominal_rate,
+            rate=self._recent_rate(),
+            mean_rate=self._intervals/self._elapsed*1000.0 if self._elapsed > 0 else float('nan'),
+            late=self.late,
+            dropped=self.dropped,
+            discontinuities=self.discontinuities,
+            loss_streak=0.0 if n == 0 else self._loss_streak(self._last_t),
+            longest_loss_streak=self.longest_loss_streak,
+            valid_ratio=self.valid_samples/n if n > 0 else float('nan'))
@@ -0,0 +1,294 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import numpy as np
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.session import eye_columns
+
+# columns of raw Tobii samples (t, lx, ly, lp, lv, rx, ry, rp, rv)
+raw_eye_columns = {'L': (1, 2, 4), 'R': (5, 6, 8), 'LR': None}
+
+
+def gaussian_filter(image, sigma):
+    """
+    Smooth a 2D array with a Gaussian kernel.
+    The kernel is separable, so the array is filtered along each axis
+    by FFT.  Outside of the array is treated as zero.
+
+    :param numpy.ndarray image: 2D array.
+    :param sigma: Standard deviation of the kernel in bins.  A tuple of
+        (horizontal, vertical) or a scalar.
+    """
+
+    image = np.asarray(image, dtype=float)
+    if np.isscalar(sigma):
+        sigma = (sigma, sigma)
+
+    for axis, s in ((1, sigma[0]), (0, sigma[1])):
+        if s <= 0:
+            continue
+        radius = int(np.ceil(4*s))
+        kernel = np.exp(-0.5*(np.arange(-radius, radius+1)/s)**2)
+        kernel /= kernel.sum()
+        length = image.shape[axis]
+        n = length+2*radius
+        kernel_f = np.fft.rfft(kernel, n)
+        image_f = np.fft.rfft(image, n, axis=axis)
+        shape = [1, 1]
+        shape[axis] = -1
+        image = np.fft.irfft(image_f*kernel_f.reshape(shape), n, axis=axis)
+        image = np.take(image, np.arange(radius, radius+length), axis=axis)
+
+    return image
+
+
+def compute_heatmap(data, extent, bins, sigma=0.0, data_type='sample', eye='LR',
+                    normalize=True):
+    """
+    Calculate a heatmap (attention map) from gaze data or fixations.
+    Returned value is a numpy.ndarray of shape (bins[1], bins[0]).
+    The first row corresponds to the bottom of extent (use origin='lower'
+    with matplotlib.pyplot.imshow).
+
+    *Example* ::
+
+        gaze_data, event_data = load_data('datafile.txt')
+        # 1920x1080 screen, 'height' units
+        heatmap = compute_heatmap(gaze_data[0], (-0.889, 0.889, -0.5, 0.5),
+                                  (1920, 1080), sigma=0.02)
+
+    :param numpy.ndarray data:
+        Gaze data (single session) or fixations returned by
+        :func:`~psychopy_tobii_controller.utility.detect_fixation_vt` or
+        :func:`~psychopy_tobii_controller.utility.detect_fixation_dt`.
+    :param extent:
+        Region of the heatmap (xmin, xmax, ymin, ymax) in the units of
+        the data file.
+    :param bins:
+        Number of bins (horizontal, vertical).  Pass the size of the
+        screen in pixels to make the heatmap at screen resolution.
+    :param float sigma:
+        Standard deviation of the Gaussian kernel in the units of the
+        data file.  Default value is 0.0 (not smoothed).
+    :param str data_type:
+        'sample' or 'fixation'.  Fixations are weighted by their duration.
+    :param str eye:
+        Specify which eye is used if data_type is 'sample'.
+        Allowed value is 'L', 'R', or 'LR'.
+    :param bool normalize:
+        If True, the heatmap is scaled so that the sum is 1.0.
+        Default value is True.
+    """
+
+    data = np.asarray(data, dtype=float)
+    if data_type == 'sample':
+        x, y = _select_points(data, eye, eye_columns)
+        weights = None
+    elif data_type == 'fixation':
+        data = data.reshape(-1,4)
+        x, y = data[:,FixX], data[:,FixY]
+        weights = data[:,1]
+    else:
+        raise ValueError('data_type must be sample or fixation')
+
+    heatmap = bin_points(x, y, extent, bins, weights)
+    bin_size = ((extent[1]-extent[0])/bins[0], (extent[3]-extent[2])/bins[1])
+    if sigma > 0:
+        # remove round-off errors of FFT
+        heatmap = np.maximum(gaussian_filter(heatmap, (sigma/bin_size[0], sigma/bin_size[1])), 0.0)
+    if normalize:
+        total = heatmap.sum()
+        if total > 0:
+            heatmap /= total
+    return heatmap
+
+
+def _select_points(data, eye, columns):
+    """
+    Get gaze positions (x, y) of an eye.  Positions of invalid samples
+    are NaN.
+
+    :param numpy.ndarray data: 2D array of samples.
+    :param str eye: 'L', 'R' or 'LR'.
+    :param dict columns: Column indices (x, y, validity) of each eye.
+        If validity is None, positions are used as they are.  If the item
+        of 'LR' is None, the mean of valid eyes is calculated.
+    """
+
+    if eye not in ('L', 'R', 'LR'):
+        raise ValueError('eye must be L, R, or LR')
+
+    def select(e):
+        cx, cy, cv = columns[e]
+        x, y = data[:,cx], data[:,cy]
+        if cv is None:
+            return x, y, ~np.isnan(x)
+        with np.errstate(invalid='ignore'):
+            valid = (data[:,cv] != 0) & ~np.isnan(x)
+        return np.where(valid, x, np.nan), np.where(valid, y, np.nan), valid
+
+    if columns[eye] is not None:
+        return select(eye)[:2]
+    lx, ly, lv = select('L')
+    rx, ry, rv = select('R')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = lv.astype(int)+rv.astype(int)
+        x = (np.where(lv, lx, 0.0)+np.where(rv, rx, 0.0))/n
+        y = (np.where(lv, ly, 0.0)+np.where(rv, ry, 0.0))/n
+    return x, y
+
+
+def _bin_index(x, y, extent, bins):
+    """
+    Get flat indices of bins that contain points.
+    Returned value is a tuple of (indices, valid) where valid is a boolean
+    array that indicates points inside of extent.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(invalid='ignore'):
+        ix = np.floor((x-extent[0])/(extent[1]-extent[0])*bins[0])
+        iy = np.floor((y-extent[2])/(extent[3]-extent[2])*bins[1])
+        # points on the upper/right edge go into the last bin
+        ix[x == extent[1]] = bins[0]-1
+        iy[y == extent[3]] = bins[1]-1
+        valid = (ix >= 0) & (ix < bins[0]) & (iy >= 0) & (iy < bins[1])
+    return iy[valid].astype(int)*bins[0] + ix[valid].astype(int), valid
+
+
+def bin_points(x, y, extent, bins, weights=None):
+    """
+    Count points in a 2D grid.  Points with NaN and points outside of
+    extent are ignored.
+    Returned value is a numpy.ndarray of shape (bins[1], bins[0]).
+
+    :param x: Array-like of horizontal positions.
+    :param y: Array-like of vertical positions.
+    :param extent: Region of the grid (xmin, xmax, ymin, ymax).
+    :param bins: Number of bins (horizontal, vertical).
+    :param weights: Array-like of weights of points.  If None, each
+        point is counted as 1.
+    """
+
+    index, valid = _bin_index(x, y, extent, bins)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[valid]
+    counts = np.bincount(index, weights=weights, minlength=bins[0]*bins[1])
+    return counts.reshape(bins[1], bins[0]).astype(float)
+
+
+class heatmap_accumulator:
+    """
+    Heatmap updated incrementally from the live gaze stream.
+
+    Samples are binned in Tobii's display area coordinates, so the cost
+    per sample is constant and independent of the size of the heatmap.
+    Smoothing is applied only when the heatmap is requested.
+    :attr:`n_samples` is the number of binned samples (invalid samples
+    and samples outside of the display area are not counted).
+
+    *Example* ::
+
+        accumulator = heatmap_accumulator((64, 36))
+        while recording:
+            accumulator.update(controller.gaze_data)
+            ...
+        heatmap = accumulator.get_heatmap(sigma=1.5)
+    """
+
+    def __init__(self, bins=(64, 36), eye='LR'):
+        """
+        :param bins: Number of bins (horizontal, vertical).
+            Default value is (64, 36).
+        :param str eye: Specify which eye is used.
+            Allowed value is 'L', 'R', or 'LR'.
+        """
+
+        if eye not in ('L', 'R', 'LR'):
+            raise ValueError('eye must be L, R, or LR')
+        self.bins = (int(bins[0]), int(bins[1]))
+        self.eye = eye
+        self.reset()
+
+
+    def reset(self):
+        """
+        Clear the heatmap.
+        """
+
+        self.counts = np.zeros(self.bins[0]*self.bins[1])
+        self.n_samples = 0
+        self._buffer = None
+        self._cursor = 0
+
+
+    def add_samples(self, samples):
+        """
+        Add raw Tobii samples.
+
+        :param samples: numpy.ndarray of shape (n, 9) that holds
+            (t, lx, ly, lp, lv, rx, ry, rp, rv).
+        """
+
+        samples = np.asarray(samples, dtype=float).reshape(-1, 9)
+        if len(samples) == 0:
+            return
+        x, y = _select_points(samples, self.eye, raw_eye_columns)
+        # display area: origin at top-left.  heatmap: first row is bottom.
+        index, valid = _bin_index(x, 1.0-y, (0.0, 1.0, 0.0, 1.0), self.bins)
+        np.add.at(self.counts, index, 1.0)
+        self.n_samples += len(index)
+
+
+    def update(self, buffer):
+        """
+        Add samples received after the last call.
+
+        :param buffer: :class:`~psychopy_tobii_controller.buffer.gaze_buffer`
+            object (e.g. tobii_controller.gaze_data).  If a different
+            buffer is passed (e.g. recording is restarted), all samples
+            in the buffer are added.
+        """
+
+        if buffer is not self._buffer:
+            self._buffer = buffer
+            self._cursor = 0
+        samples, self._cursor = buffer.get_since(self._cursor)
+        self.add_samples(samples)
+
+
+    def get_heatmap(self, sigma=0.0, scale='peak'):
+        """
+        Get the heatmap as a numpy.ndarray of shape (bins[1], bins[0]).
+        The first row corresponds to the bottom of the screen.
+
+        :param float sigma: Standard deviation of the Gaussian kernel
+            in bins.  Default value is 0.0 (not smoothed).
+        :param str scale: 'peak' (the maximum value is scaled to 1.0,
+            e.g. for display), 'sum' (the sum is scaled to 1.0 as
+            :func:`compute_heatmap` with normalize=True) or None
+            (number of samples).  Default value is 'peak'.
+        """
+
+        if scale not in ('peak', 'sum', None):
+            raise ValueError('scale must be peak, sum or None')
+
+        heatmap = self.counts.reshape(self.bins[1], self.bins[0])
+        if sigma > 0:
+            heatmap = np.maximum(gaussian_filter(heatmap, sigma), 0.0)
+        else:
+            heatmap = heatmap.copy()
+        if scale is not None:
+            total = heatmap.max() if scale == 'peak' else heatmap.sum()
+            if total > 0:
+                heatmap /= total
+        return heatmap
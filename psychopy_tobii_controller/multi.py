@@ -0,0 +1,395 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import threading
+import warnings
+import numpy as np
+
+from .core import tobii_controller
+from .buffer import event_buffer
+from .discovery import connect_eyetracker, save_eyetracker_cache
+from .compression import open_text, end_member
+
+
+class tobii_multi_controller:
+    """
+    Controller for recording from several Tobii eyetrackers at once
+    (e.g. dual-participant experiments).
+
+    A :class:`~psychopy_tobii_controller.tobii_controller` is created for
+    each eyetracker, so that every device has its own sample buffer and
+    calibration.  Timestamps of all devices are Tobii's system timestamps,
+    i.e. they share the clock of this computer.  During recording, a
+    single writer thread merges samples of all devices in the order of
+    timestamp and writes them to one data file.  An additional column
+    'Device' holds the index of the eyetracker in self.controllers.
+    """
+
+    def __init__(self, win, ids=None, addresses=None, use_cache=True, flush_interval=0.5,
+                 max_delay=2.0):
+        """
+        Initialize tobii_multi_controller object.
+
+        :param win: PsychoPy Window object.
+        :param ids: List of ID of Tobii units to connect with.
+            If None, all Tobii units found are used.
+            Default value is None.
+        :param addresses: List of address of Tobii units to connect with.
+            If this is given, ids is ignored.
+            Default value is None.
+        :param bool use_cache: If True, cached addresses of Tobii units
+            are used.  See :class:`~psychopy_tobii_controller.tobii_controller`.
+            Default value is True.
+        :param float flush_interval: Interval of writing data to the
+            data file during recording.  Unit is second.
+            Default value is 0.5.
+        :param float max_delay: Samples are written to the data file
+            when they are older than this limit even if an eyetracker
+            stops sending data, so that memory usage of the writer is
+            bounded.  Samples that the eyetracker sends after this limit
+            are written as they arrive (i.e. they may be out of order).
+            Unit is second.  Default value is 2.0.
+        """
+        import tobii_research
+        self.tobii_research = tobii_research
+
+        if addresses is not None:
+            eyetrackers = [connect_eyetracker(tobii_research, address=a, use_cache=use_cache)
+                           for a in addresses]
+        elif ids is not None:
+            eyetrackers = [connect_eyetracker(tobii_research, id=i, use_cache=use_cache)
+                           for i in ids]
+        else:
+            eyetrackers = tobii_research.find_all_eyetrackers()
+            if len(eyetrackers)==0:
+                raise RuntimeError('No Tobii eyetrackers')
+            if use_cache:
+                save_eyetracker_cache([e.address for e in eyetrackers])
+
+        self.win = win
+        self.controllers = [tobii_controller(win, id=i, eyetracker=e) for i, e in enumerate(eyetrackers)]
+        self.flush_interval = flush_interval
+        self.max_delay = max_delay
+        self.datafile = None
+        self.raw_datafile = False
+        self.datafile_summaries = []
+        self.recording = False
+        self.event_data = event_buffer()
+        self._writer = None
+        self._stop_writer = threading.Event()
+
+
+    def __len__(self):
+        return len(self.controllers)
+
+
+    def show_status(self, device=0, text_color='white', enable_mouse=False):
+        """
+        Draw status of an eyetracker on the screen.
+
+        :param int device: Index of the eyetracker.
+        :param text_color: Color of message text. Default value is 'white'
+        :param bool enable_mouse: If True, mouse operation is enabled.
+            Default value is False.
+        """
+
+        self.controllers[device].show_status(text_color=text_color,
+                                             enable_mouse=enable_mouse)
+
+
+    def run_calibration(self, device, calibration_points, **kwargs):
+        """
+        Run calibration of an eyetracker.
+        Keyword arguments are passed to
+        :func:`~psychopy_tobii_controller.tobii_controller.run_calibration`.
+
+        :param int device: Index of the eyetracker.
+        :param calibration_points: List of position of calibration points.
+        """
+
+        return self.controllers[device].run_calibration(calibration_points, **kwargs)
+
+
+    def run_validation(self, device, calibration_points, **kwargs):
+        """
+        Run validation of an eyetracker.
+        Keyword arguments are passed to
+        :func:`~psychopy_tobii_controller.tobii_controller.run_validation`.
+
+        :param int device: Index of the eyetracker.
+        :param calibration_points: List of position of validation points.
+        """
+
+        return self.controllers[device].run_validation(calibration_points, **kwargs)
+
+
+    def open_datafile(self, filename, compression='auto', compresslevel=None, raw=False):
+        """
+        Open data file.  Event data is always output separately
+        after gaze data.
+
+        :param str filename: Name of data file to be opened.
+        :param compression: 'gzip', 'bz2', 'lzma' or None (not compressed).
+            If 'auto', compression is selected from the extension of
+            filename.  See
+            :func:`~psychopy_tobii_controller.tobii_controller.open_datafile`.
+        :param int compresslevel: Compression level.  If None, default
+            level of the compression module is used.
+        :param bool raw: If True, gaze positions are recorded in Tobii's
+            display area coordinates.  See
+            :func:`~psychopy_tobii_controller.tobii_controller.open_datafile`.
+            Default value is False.
+        """
+
+        if self.datafile is not None:
+            self.close_datafile()
+
+        self.raw_datafile = raw
+        self.datafile = open_text(filename, 'w', compression, compresslevel)
+        self.datafile_summaries = []
+        self.controllers[0].write_datafile_info(self.datafile, raw)
+        self.datafile.write('Eyetrackers:\t%d\n' % len(self.controllers))
+        for i, c in enumerate(self.controllers):
+            self.datafile.write('Eyetracker %d:\t%s\t%s\n' % (
+                i, c.eyetracker.serial_number, c.eyetracker.address))
+        self.datafile.write('Event recording mode:\tSeparated\n\n')
+
+
+    def close_datafile(self, qa_summary=False):
+        """
+        Close the data file.
+
+        :param bool qa_summary: If True, summaries of sessions are written
+            at the end of the data file.  See
+            :func:`~psychopy_tobii_controller.tobii_controller.close_datafile`.
+            Default value is False.
+        """
+
+        if self.recording:
+            self.unsubscribe()
+
+        if self.datafile is not None:
+            if qa_summary:
+                from .qa import write_summary
+                write_summary(self.datafile, self.datafile_summaries)
+            self.datafile.close()
+
+        self.datafile = None
+
+
+    def subscribe(self, wait=True, timeout=2.0):
+        """
+        Start recording from all eyetrackers.
+
+        :param bool wait: If True, wait until all eyetrackers send data.
+            Default value is True.
+        :param float timeout: If wait=True and failed to retrieve
+            gaze data within this limit, RuntimeError will be raised.
+            Unit is second.
+        """
+
+        self.event_data = event_buffer()
+        self._start_time = self.tobii_research.get_system_time_stamp()
+        self._cursors = [0]*len(self.controllers)
+        self._pending = [[] for c in self.controllers]
+        self._summaries = {}
+
+        # all eyetrackers are subscribed before the session is started
+        # so that a failure does not leave an incomplete session.
+        try:
+            for c in self.controllers:
+                c.subscribe(wait=wait, timeout=timeout)
+        except Exception:
+            for c in self.controllers:
+                if c.recording:
+                    self._unsubscribe_controller(c)
+            raise
+        # gaze buffers are replaced when the controllers are unsubscribed,
+        # so the writer keeps the buffers of this session.
+        self._buffers = [c.gaze_data for c in self.controllers]
+
+        if self.datafile is not None:
+            self._write_session_header()
+        else:
+            warnings.warn('data file is not set.')
+        self.recording = True
+
+        if self.datafile is not None:
+            self._stop_writer.clear()
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
+
+
+    def unsubscribe(self):
+        """
+        Stop recording from all eyetrackers and write remaining data.
+        """
+
+        for c in self.controllers:
+            self._unsubscribe_controller(c)
+        self.recording = False
+
+        if self._writer is not None:
+            self._stop_writer.set()
+            self._writer.join()
+            self._writer = None
+            self._write_session_footer()
+
+        self._buffers = []
+        self._pending = []
+        self.event_data = event_buffer()
+
+
+    def _unsubscribe_controller(self, c):
+        # the controllers don't have data files; data are written by
+        # this class.
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'data file is not set')
+            c.unsubscribe()
+
+
+    def record_event(self, event, values=None):
+        """
+        Record events with timestamp.
+        This method can be called from any thread.
+
+        Note: This method works only during recording.
+
+        :param str event: Any string.
+        :param values: Sequence of numbers recorded with the event.
+            Default value is None.
+        """
+        if not self.recording:
+            return
+
+        self.event_data.append(self.tobii_research.get_system_time_stamp(), event, values)
+
+
+    def get_current_gaze_position(self, device):
+        """
+        Get current (i.e. the latest) gaze position of an eyetracker.
+        See :func:`~psychopy_tobii_controller.tobii_controller.get_current_gaze_position`.
+
+        :param int device: Index of the eyetracker.
+        """
+
+        return self.controllers[device].get_current_gaze_position()
+
+
+    def get_current_pupil_size(self, device):
+        """
+        Get current (i.e. the latest) pupil size of an eyetracker.
+        See :func:`~psychopy_tobii_controller.tobii_controller.get_current_pupil_size`.
+
+        :param int device: Index of the eyetracker.
+        """
+
+        return self.controllers[device].get_current_pupil_size()
+
+
+    def _writer_loop(self):
+        while not self._stop_writer.wait(self.flush_interval):
+            self._write_pending(final=False)
+        self._write_pending(final=True)
+
+
+    def _write_pending(self, final):
+        """
+        Write samples that are received from all eyetrackers.
+        Samples later than the latest sample of the slowest eyetracker
+        are kept until the next call so that the output is sorted by
+        timestamp.  Samples older than max_delay are always written.
+        """
+
+        for i, c in enumerate(self.controllers):
+            new_data, self._cursors[i] = self._buffers[i].get_since(self._cursors[i])
+            if len(new_data) > 0:
+                block = np.empty((len(new_data),12))
+                block[:,:11] = c.convert_tobii_records(new_data, self._start_time, self.raw_datafile)
+                block[:,11] = i
+                self._pending[i].append(block)
+
+        if final:
+            limit = np.inf
+        else:
+            # timestamps in the data file are in milliseconds.
+            now = (self.tobii_research.get_system_time_stamp()-self._start_time)/1000.0
+            limit = now-self.max_delay*1000.0
+            if min([len(p) for p in self._pending]) > 0:
+                limit = max(limit, min([p[-1][-1,0] for p in self._pending]))
+
+        blocks = []
+        for i in range(len(self._pending)):
+            if len(self._pending[i]) == 0:
+                blocks.append(np.empty((0,12)))
+                continue
+            pending = np.vstack(self._pending[i])
+            n = np.searchsorted(pending[:,0], limit, side='right')
+            blocks.append(pending[:n])
+            self._pending[i] = [pending[n:]] if n < len(pending) else []
+
+        output = np.vstack(blocks)
+        if len(output) == 0:
+            return
+        self._add_to_summaries(blocks)
+        output = output[np.argsort(output[:,0], kind='stable')]
+        np.savetxt(self.datafile, output, delimiter='\t',
+                   fmt=['%.1f','%.4f','%.4f','%.4f','%d','%.4f','%.4f','%.4f','%d','%.4f','%.4f','%d'])
+        self.datafile.flush()
+
+
+    def _add_to_summaries(self, blocks):
+        from .qa import session_summary, round_timestamps
+        for i, block in enumerate(blocks):
+            if len(block) == 0:
+                continue
+            device = str(i)
+            if device not in self._summaries:
+                self._summaries[device] = session_summary()
+            # timestamps are rounded as in the data file.
+            self._summaries[device].add(round_timestamps(block[:,0]), block[:,4], block[:,8])
+
+
+    def _write_session_header(self):
+        self.datafile.write('Session Start\n')
+        self.datafile.write('\t'.join(['TimeStamp',
+                                       'GazePointXLeft',
+                                       'GazePointYLeft',
+                                       'PupilLeft',
+                                       'ValidityLeft',
+                                       'GazePointXRight',
+                                       'GazePointYRight',
+                                       'PupilRight',
+                                       'ValidityRight',
+                                       'GazePointX',
+                                       'GazePointY',
+                                       'Device'])+'\n')
+
+
+    def _write_session_footer(self):
+        # the fit is written at the end of the session so that time
+        # synchronization data received during the session are used.
+        self.controllers[0].clock_sync.write_fit(self.datafile, self._start_time)
+        self.datafile.write('TimeStamp\tEvent\n')
+        order = np.argsort(self.event_data.times(), kind='stable')
+        for t, text in zip(self.event_data.times()[order], self.event_data.format_events(order)):
+            self.datafile.write('%.1f\t%s\n' % ((t-self._start_time)/1000.0, text))
+        self.datafile.write('Session End\n\n')
+        end_member(self.datafile)
+
+        if self._summaries:
+            session = len(set([s['session'] for s in self.datafile_summaries]))
+            for device in sorted(self._summaries):
+                self._summaries[device].n_events = len(order)
+                summary = self._summaries[device].result()
+                summary['session'] = session
+                summary['device'] = device
+                self.datafile_summaries.append(summary)
+        self._summaries = {}
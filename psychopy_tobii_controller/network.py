@@ -0,0 +1,285 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import socket
+import struct
+import threading
+import numpy as np
+
+from .buffer import gaze_buffer
+
+# magic, version, sequence number, number of samples, send time (system timestamp)
+header_format = struct.Struct('<4sHIHq')
+magic = b'PTGZ'
+protocol_version = 1
+
+sample_dtype = np.dtype([('t', '<i8'),
+                         ('lx', '<f4'), ('ly', '<f4'), ('lp', '<f4'),
+                         ('rx', '<f4'), ('ry', '<f4'), ('rp', '<f4'),
+                         ('lv', 'u1'), ('rv', 'u1')])
+
+# keep datagrams smaller than a typical MTU
+default_max_samples = (1400-header_format.size)//sample_dtype.itemsize
+
+
+def _make_socket(family):
+    if family == 'udp':
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    elif family == 'unix':
+        return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    raise ValueError('family must be udp or unix')
+
+
+def pack_samples(samples, sequence, send_time):
+    """
+    Pack raw samples into a datagram.
+
+    :param samples: numpy.ndarray of shape (n, 9) that holds
+        (t, lx, ly, lp, lv, rx, ry, rp, rv).
+    :param int sequence: Sequence number of the datagram.
+    :param int send_time: Tobii's system timestamp when the datagram is sent.
+    """
+
+    packed = np.empty(len(samples), dtype=sample_dtype)
+    packed['t'] = samples[:,0]
+    for name, col in (('lx',1), ('ly',2), ('lp',3), ('lv',4),
+                      ('rx',5), ('ry',6), ('rp',7), ('rv',8)):
+        packed[name] = samples[:,col]
+    return header_format.pack(magic, protocol_version, sequence & 0xffffffff,
+                              len(samples), int(send_time)) + packed.tobytes()
+
+
+def unpack_samples(datagram):
+    """
+    Unpack a datagram made by
+    :func:`~psychopy_tobii_controller.network.pack_samples`.
+    Returned value is a tuple of (sequence, send_time, samples) where
+    samples is a numpy.ndarray of shape (n, 9).
+    ValueError is raised if the datagram is broken.
+
+    :param bytes datagram: Received datagram.
+    """
+
+    if len(datagram) < header_format.size:
+        raise ValueError('datagram is too short.')
+    m, version, sequence, n, send_time = header_format.unpack_from(datagram)
+    if m != magic or version != protocol_version:
+        raise ValueError('unknown datagram.')
+    if len(datagram) != header_format.size + n*sample_dtype.itemsize:
+        raise ValueError('datagram is broken.')
+    packed = np.frombuffer(datagram, dtype=sample_dtype, count=n, offset=header_format.size)
+    samples = np.empty((n, 9))
+    for name, col in (('t',0), ('lx',1), ('ly',2), ('lp',3), ('lv',4),
+                      ('rx',5), ('ry',6), ('rp',7), ('rv',8)):
+        samples[:,col] = packed[name]
+    return sequence, send_time, samples
+
+
+class gaze_publisher:
+    """
+    Broadcast raw gaze samples over UDP or a local (Unix domain) socket.
+
+    A worker thread reads new samples from the gaze buffer of the
+    controller every interval and sends them in datagrams with sequence
+    numbers and send times.  Every sample is sent (samples are not
+    decimated), and the number of datagrams per second is about 1/interval
+    regardless of the sampling rate.
+
+    Floating point values are sent as float32 and timestamps as int64
+    (Tobii's system timestamp in microseconds).
+    """
+
+    def __init__(self, controller, address=('127.0.0.1', 50000), family='udp',
+                 interval=0.005, max_samples=default_max_samples):
+        """
+        :param controller: :class:`~psychopy_tobii_controller.tobii_controller` object.
+        :param address: Destination.  A tuple of (host, port) for 'udp' or
+            a path for 'unix'.  Default value is ('127.0.0.1', 50000).
+        :param str family: 'udp' or 'unix'.  Default value is 'udp'.
+        :param float interval: Interval of sending (s).  Default value is 0.005.
+        :param int max_samples: Maximum number of samples in a datagram.
+        """
+
+        self.controller = controller
+        self.address = address
+        self.interval = interval
+        self.max_samples = max_samples
+        self.sequence = 0
+        self.sent_samples = 0
+        self._socket = _make_socket(family)
+        self._buffer = None
+        self._cursor = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Send remaining samples, stop the worker thread and close the socket.
+        """
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._socket.close()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.send_new_samples()
+        self.send_new_samples()
+
+
+    def send_new_samples(self):
+        """
+        Send samples received after the last call.
+        Usually, users don't have to call this method.
+        """
+
+        buffer = self.controller.gaze_data
+        if buffer is not self._buffer:
+            self._buffer = buffer
+            self._cursor = 0
+        samples, self._cursor = buffer.get_since(self._cursor)
+        if len(samples) == 0:
+            return
+        send_time = self.controller.tobii_research.get_system_time_stamp()
+        for i in range(0, len(samples), self.max_samples):
+            datagram = pack_samples(samples[i:i+self.max_samples], self.sequence, send_time)
+            try:
+                self._socket.sendto(datagram, self.address)
+            except OSError:
+                # nobody is listening (e.g. local socket is not bound yet)
+                pass
+            self.sequence += 1
+        self.sent_samples += len(samples)
+
+
+class gaze_subscriber:
+    """
+    Receive raw gaze samples sent by
+    :class:`~psychopy_tobii_controller.network.gaze_publisher`.
+
+    Received samples are stored in :attr:`gaze_data`
+    (:class:`~psychopy_tobii_controller.buffer.gaze_buffer`), so they can
+    be read in the same way as tobii_controller.gaze_data.
+    Lost datagrams are detected from gaps of sequence numbers and counted
+    in :attr:`lost`.  Datagrams that arrive after a newer one (reordered
+    or duplicated) are counted in :attr:`reordered` and their samples are
+    not stored, so that samples in :attr:`gaze_data` are in time order.
+    A reordered datagram has been counted in lost when the gap was found.
+
+    *Example* ::
+
+        subscriber = gaze_subscriber(('0.0.0.0', 50000))
+        subscriber.start()
+        ...
+        samples, cursor = subscriber.gaze_data.get_since(cursor)
+    """
+
+    def __init__(self, address=('0.0.0.0', 50000), family='udp'):
+        """
+        :param address: Address to bind.  A tuple of (host, port) for 'udp'
+            or a path for 'unix'.  Default value is ('0.0.0.0', 50000).
+        :param str family: 'udp' or 'unix'.  Default value is 'udp'.
+        """
+
+        self.address = address
+        self.gaze_data = gaze_buffer()
+        self.lost = 0
+        self.reordered = 0
+        self.received = 0
+        self.last_send_time = None
+        self._last_sequence = None
+        self._socket = _make_socket(family)
+        if family == 'udp':
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self._socket.bind(address)
+        self._socket.settimeout(0.1)
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def receive(self, timeout=None):
+        """
+        Receive one datagram and store samples.
+        Returned value is a numpy.ndarray of received samples (n, 9), or
+        None if timeout expires.  Samples of a reordered datagram are
+        returned but are not stored.
+
+        :param float timeout: Timeout (s).  If None, wait forever.
+        """
+
+        self._socket.settimeout(timeout)
+        try:
+            datagram = self._socket.recv(65536)
+        except socket.timeout:
+            return None
+        try:
+            sequence, send_time, samples = unpack_samples(datagram)
+        except ValueError:
+            return None
+        self.received += 1
+        if self._last_sequence is not None:
+            # sequence numbers are 32 bit and wrap around.
+            step = (sequence-self._last_sequence) & 0xffffffff
+            if step == 0 or step >= 0x80000000:
+                self.reordered += 1
+                return samples
+            self.lost += step-1
+        self._last_sequence = sequence
+        self.last_send_time = send_time
+        self.gaze_data.extend(samples)
+        return samples
+
+
+    def start(self):
+        """
+        Start a thread that receives datagrams in background.
+        """
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.receive(0.1)
+            except OSError:
+                break
+
+
+    def stop(self):
+        """
+        Stop the background thread and close the socket.
+        """
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._socket.close()
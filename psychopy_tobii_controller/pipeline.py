@@ -0,0 +1,315 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import time
+import threading
+import warnings
+
+SAMPLE = 'sample'
+BATCH = 'batch'
+
+
+class processing_stage:
+    """
+    Base class of stages of :class:`gaze_pipeline`.
+
+    A stage with mode SAMPLE is called in the sample path (Tobii's
+    callback thread) with every raw sample as a tuple of
+    (t, lx, ly, lp, lv, rx, ry, rp, rv), so it must return quickly.
+    A stage with mode BATCH is called by a worker thread with blocks of
+    new samples as read-only numpy.ndarray views of shape (n, 9).
+
+    Override :func:`process` (and :func:`reset` if the stage has state).
+    """
+
+    mode = SAMPLE
+
+    def __init__(self, name=None, mode=None):
+        """
+        :param str name: Name of the stage.  If None, the class name is used.
+        :param str mode: SAMPLE ('sample') or BATCH ('batch').  If None,
+            the default mode of the class is used.
+        """
+
+        self.name = type(self).__name__ if name is None else name
+        if mode is not None:
+            self.mode = mode
+        if self.mode not in (SAMPLE, BATCH):
+            raise ValueError('mode must be sample or batch')
+
+
+    def process(self, data):
+        """
+        Process a sample (SAMPLE) or a block of samples (BATCH).
+        """
+
+        raise NotImplementedError
+
+
+    def reset(self):
+        """
+        Called when recording is started.
+        """
+
+        pass
+
+
+class function_stage(processing_stage):
+    """
+    Stage that calls a function.
+
+    *Example* ::
+
+        controller.pipeline.add(function_stage(detector.update, BATCH, 'saccades'))
+    """
+
+    def __init__(self, func, mode=SAMPLE, name=None):
+        """
+        :param func: Function that receives a sample or a block of samples.
+        :param str mode: SAMPLE or BATCH.  Default value is SAMPLE.
+        :param str name: Name of the stage.  If None, name of the function
+            is used.
+        """
+
+        processing_stage.__init__(self, getattr(func, '__name__', None) if name is None else name, mode)
+        self.func = func
+
+
+    def process(self, data):
+        return self.func(data)
+
+
+class _stage_stats:
+    __slots__ = ('calls', 'samples', 'total', 'max', 'errors', 'last_error')
+
+    def __init__(self):
+        self.calls = 0
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.last_error = None
+
+
+class gaze_pipeline:
+    """
+    Chain of processing stages applied to the live gaze stream.
+
+    Stages with mode SAMPLE run in order in Tobii's callback thread right
+    after the sample is stored.  Stages with mode BATCH run in order in
+    a worker thread every interval with all samples received since the
+    last run.  Expensive processing (e.g. event detection, publishing)
+    should be BATCH stages so that the sample path stays short.
+
+    Time spent in each stage is measured and reported by
+    :func:`get_stats`.  An exception raised by a stage is counted and
+    does not stop other stages or the recording.
+
+    Stages can be added and removed while recording.  The list of stages
+    is replaced (not modified) so that running threads are not affected.
+    """
+
+    def __init__(self, controller, interval=0.01):
+        """
+        :param controller: :class:`~psychopy_tobii_controller.tobii_controller` object.
+        :param float interval: Interval of BATCH stages (s).
+            Default value is 0.01.
+        """
+
+        self.controller = controller
+        self.interval = interval
+        self._sample_stages = []
+        self._batch_stages = []
+        self._stats = {}
+        self._buffer = None
+        self._cursor = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+
+    @property
+    def stages(self):
+        """
+        List of registered stages (SAMPLE stages first).
+        """
+
+        return self._sample_stages + self._batch_stages
+
+
+    def add(self, stage, index=None):
+        """
+        Register a stage.  A callable is wrapped by
+        :class:`function_stage` as a SAMPLE stage.
+
+        :param stage: :class:`processing_stage` object or a function.
+        :param int index: Position of the stage among stages of the same
+            mode.  If None, the stage is appended.
+        """
+
+        if not isinstance(stage, processing_stage):
+            stage = function_stage(stage)
+        with self._lock:
+            if stage.name in [s.name for s in self.stages]:
+                raise ValueError('stage ({}) is already registered.'.format(stage.name))
+            self._stats[stage.name] = _stage_stats()
+            if stage.mode == SAMPLE:
+                stages = list(self._sample_stages)
+                stages.insert(len(stages) if index is None else index, stage)
+                self._sample_stages = stages
+                self.controller.add_sample_hook(self._on_sample)
+            else:
+                stages = list(self._batch_stages)
+                stages.insert(len(stages) if index is None else index, stage)
+                self._batch_stages = stages
+                self._start_worker()
+        return stage
+
+
+    def remove(self, stage):
+        """
+        Remove a stage.
+
+        :param stage: Name of the stage or :class:`processing_stage` object.
+        """
+
+        name = stage if isinstance(stage, str) else stage.name
+        with self._lock:
+            self._sample_stages = [s for s in self._sample_stages if s.name != name]
+            self._batch_stages = [s for s in self._batch_stages if s.name != name]
+            self._stats.pop(name, None)
+            if not self._sample_stages:
+                self.controller.remove_sample_hook(self._on_sample)
+        if not self._batch_stages:
+            self._stop_worker()
+
+
+    def clear(self):
+        """
+        Remove all stages.
+        """
+
+        for stage in self.stages:
+            self.remove(stage)
+
+
+    def reset(self):
+        """
+        Reset stages and statistics.  This is called when recording is started.
+        """
+
+        for stage in self.stages:
+            stage.reset()
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        """
+        Reset statistics of stages.
+        """
+
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = _stage_stats()
+
+
+    def _run_stage(self, stage, data, n):
+        stats = self._stats.get(stage.name)
+        start = time.perf_counter()
+        try:
+            stage.process(data)
+        except Exception as e:
+            if stats is not None:
+                if stats.errors == 0:
+                    warnings.warn('stage ({}) raised an exception: {!r}'.format(stage.name, e))
+                stats.errors += 1
+                stats.last_error = e
+        elapsed = time.perf_counter()-start
+        if stats is not None:
+            stats.calls += 1
+            stats.samples += n
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+
+
+    def _on_sample(self, record):
+        # called from Tobii's callback thread
+        for stage in self._sample_stages:
+            self._run_stage(stage, record, 1)
+
+
+    def _start_worker(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def _stop_worker(self):
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.update()
+
+
+    def update(self):
+        """
+        Pass samples received after the last call to BATCH stages.
+        Usually, users don't have to call this method.
+        """
+
+        buffer = self.controller.gaze_data
+        if buffer is not self._buffer:
+            self._buffer = buffer
+            self._cursor = 0
+        block, self._cursor = buffer.get_since(self._cursor)
+        if len(block) == 0:
+            return
+        block.flags.writeable = False
+        for stage in self._batch_stages:
+            self._run_stage(stage, block, len(block))
+
+
+    def get_stats(self):
+        """
+        Get cost of stages.  Returned value is a list of dict objects
+        in the order of :attr:`stages` with following items.
+
+        - 'name', 'mode': name and mode of the stage.
+        - 'calls': number of calls.
+        - 'samples': number of processed samples.
+        - 'total': total time spent in the stage (ms).
+        - 'per_sample': mean time per sample (us).
+        - 'max': maximum time of a call (ms).
+        - 'errors': number of exceptions.
+        """
+
+        result = []
+        for stage in self.stages:
+            stats = self._stats.get(stage.name)
+            if stats is None:
+                continue
+            result.append({'name': stage.name, 'mode': stage.mode,
+                           'calls': stats.calls, 'samples': stats.samples,
+                           'total': stats.total*1000.0,
+                           'per_sample': stats.total/stats.samples*1e6 if stats.samples > 0 else float('nan'),
+                           'max': stats.max*1000.0,
+                           'errors': stats.errors})
+        return result
@@ -0,0 +1,212 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import warnings
+import numpy as np
+
+channel_columns = (1, 2, 5, 6)
+validity_columns = (4, 4, 8, 8)
+
+
+def _channels(samples):
+    """
+    Get (lx, ly, rx, ry) of raw samples.  Invalid values are NaN.
+    """
+
+    samples = np.asarray(samples, dtype=float)
+    xy = samples[:,channel_columns].copy()
+    xy[samples[:,validity_columns] == 0] = np.nan
+    return xy
+
+
+class gaze_predictor:
+    """
+    Latency-compensated gaze prediction.
+
+    Gaze position at a future time (e.g. the next flip) is extrapolated
+    from the latest samples.  Velocity of each eye is estimated by linear
+    regression over valid samples among the last n_samples samples.
+
+    - If the speed is below saccade_threshold (fixation model), the mean
+      position of the valid samples is used.
+    - Otherwise (ballistic model), gaze is assumed to keep moving with a
+      velocity that decays exponentially with time constant decay, so
+      the extrapolated displacement is bounded by velocity*decay.
+
+    Positions are in Tobii's display area coordinates and velocity is in
+    display area units per second.
+    """
+
+    def __init__(self, n_samples=6, saccade_threshold=1.0, decay=0.02):
+        """
+        :param int n_samples: Number of samples used for estimation.
+            Default value is 6 (10 ms at 600 Hz).
+        :param float saccade_threshold: Speed (display area units/s) above
+            which the ballistic model is used.  Default value is 1.0
+            (about 30 deg/s on a typical screen).
+        :param float decay: Time constant of velocity decay (s) in the
+            ballistic model.  Default value is 0.02.
+        """
+
+        if n_samples < 2:
+            raise ValueError('n_samples must be 2 or larger.')
+        self.n_samples = int(n_samples)
+        self.saccade_threshold = saccade_threshold
+        self.decay = decay
+        self.horizon = np.nan
+        self.saccade = (False, False)
+
+
+    def _predict(self, t, xy, horizon):
+        """
+        Vectorized prediction.
+
+        :param t: (n, k) timestamps (s) of windows.
+        :param xy: (n, k, 4) positions of windows.
+        :param horizon: (n,) time from the last sample of each window (s).
+        Returned value is a tuple of ((n, 4) positions, (n, 2) saccade flags).
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            # invalid samples are excluded from the fit by zero weights
+            valid = ~np.isnan(xy)
+            n_valid = valid.sum(axis=1)
+            t = t[:,:,np.newaxis]
+            t_mean = np.sum(t*valid, axis=1)/n_valid
+            mean = np.sum(np.where(valid, xy, 0.0), axis=1)/n_valid
+            tc = (t-t_mean[:,np.newaxis,:])*valid
+            xc = np.where(valid, xy-mean[:,np.newaxis,:], 0.0)
+            velocity = np.sum(tc*xc, axis=1)/np.sum(tc**2, axis=1)
+            velocity[n_valid < 2] = np.nan
+            speed = np.hypot(velocity[:,0::2], velocity[:,1::2])
+            saccade = speed > self.saccade_threshold
+
+            # fitted position at the last sample
+            h = np.asarray(horizon, dtype=float)[:,np.newaxis]
+            last = mean + velocity*(t[:,-1,:]-t_mean)
+            ballistic = last + velocity*self.decay*(1-np.exp(-h/self.decay))
+            prediction = np.where(np.repeat(saccade, 2, axis=1), ballistic, mean)
+        return prediction, saccade
+
+
+    def predict(self, samples, t):
+        """
+        Predict gaze position at time t.
+        Returned value is a tuple of (lx, ly, rx, ry).  Velocity is
+        estimated from valid samples only.  If the eye is valid in less
+        than two of the last n_samples samples, the mean position of
+        valid samples in the window (i.e. the valid sample) or, if there
+        is no valid sample in the window, the last valid sample is used
+        without extrapolation.  Values are NaN if the eye is not valid in
+        any sample.
+        :attr:`horizon` (ms) and :attr:`saccade` (left, right) are updated.
+
+        :param samples: Raw samples (t, lx, ly, lp, lv, rx, ry, rp, rv).
+            The last n_samples samples are used for estimation.
+        :param float t: Target time (Tobii's system timestamp).
+        """
+
+        samples = np.asarray(samples, dtype=float)
+        if len(samples) == 0:
+            self.horizon = np.nan
+            self.saccade = (False, False)
+            return (np.nan, np.nan, np.nan, np.nan)
+        window = samples[-self.n_samples:]
+        ts = window[:,0]/1e6
+        horizon = t/1e6-ts[-1]
+        prediction, saccade = self._predict(ts[np.newaxis,:], _channels(window)[np.newaxis,:,:],
+                                            np.array([horizon]))
+        prediction = prediction[0]
+        for ch in range(0, 4, 2):
+            if np.isnan(prediction[ch]) and len(samples) > len(window):
+                valid = np.flatnonzero(samples[:-len(window),validity_columns[ch]] != 0)
+                if len(valid) > 0:
+                    prediction[ch:ch+2] = samples[valid[-1],channel_columns[ch:ch+2]]
+        self.horizon = horizon*1000.0
+        self.saccade = (bool(saccade[0,0]), bool(saccade[0,1]))
+        return tuple(prediction.tolist())
+
+
+    def evaluate(self, samples, horizon, screen_size=None):
+        """
+        Replay recorded samples and measure error of prediction.
+        For every sample, gaze position after horizon is predicted from
+        the sample and preceding samples, and is compared with the
+        recorded (linearly interpolated) position.
+        Returned value is a dict object with following items.
+
+        - 'horizon': horizon (ms).
+        - 'n': number of predictions that were compared.
+        - 'mean', 'median', 'p95': mean, median and 95th percentile of
+          error of prediction.
+        - 'baseline_mean', 'baseline_median', 'baseline_p95': the same
+          values when the latest sample is used without prediction.
+        - 'saccade_ratio': proportion of predictions by the ballistic model.
+
+        :param samples: Raw samples (t, lx, ly, lp, lv, rx, ry, rp, rv)
+            (e.g. tobii_controller.gaze_data.array()).
+        :param float horizon: Prediction horizon (ms).
+        :param screen_size: Size of screen (width, height) in pixels.
+            If given, errors are in pixels.  Otherwise, errors are in
+            display area units.
+        """
+
+        samples = np.asarray(samples, dtype=float)
+        k = self.n_samples
+        result = {'horizon': float(horizon), 'n': 0}
+        names = ('mean', 'median', 'p95', 'baseline_mean', 'baseline_median', 'baseline_p95')
+        for name in names:
+            result[name] = np.nan
+        result['saccade_ratio'] = np.nan
+        if len(samples) < k:
+            return result
+
+        t = samples[:,0]/1e6
+        xy = _channels(samples)
+        windows_t = np.lib.stride_tricks.sliding_window_view(t, k)
+        windows_xy = np.lib.stride_tricks.sliding_window_view(xy, k, axis=0).transpose(0,2,1)
+        h = horizon/1000.0
+        prediction, saccade = self._predict(windows_t, windows_xy, np.full(len(windows_t), h))
+        last = xy[k-1:]
+        target = t[k-1:]+h
+
+        # recorded position at target time
+        actual = np.full(prediction.shape, np.nan)
+        for ch in range(4):
+            valid = ~np.isnan(xy[:,ch])
+            if valid.sum() < 2:
+                continue
+            actual[:,ch] = np.interp(target, t[valid], xy[valid,ch], left=np.nan, right=np.nan)
+            # do not interpolate across data loss
+            idx = np.searchsorted(t, target)
+            idx = np.clip(idx, 1, len(t)-1)
+            actual[np.isnan(xy[idx,ch]) | np.isnan(xy[idx-1,ch]), ch] = np.nan
+
+        scale = np.ones(4) if screen_size is None else \
+            np.array([screen_size[0], screen_size[1], screen_size[0], screen_size[1]], dtype=float)
+        d = (prediction-actual)*scale
+        error = np.concatenate((np.hypot(d[:,0], d[:,1]), np.hypot(d[:,2], d[:,3])))
+        d = (last-actual)*scale
+        baseline = np.concatenate((np.hypot(d[:,0], d[:,1]), np.hypot(d[:,2], d[:,3])))
+        compared = ~np.isnan(error) & ~np.isnan(baseline)
+        if not compared.any():
+            return result
+        error = error[compared]
+        baseline = baseline[compared]
+        result['n'] = int(compared.sum())
+        result['mean'] = float(error.mean())
+        result['median'] = float(np.median(error))
+        result['p95'] = float(np.percentile(error, 95))
+        result['baseline_mean'] = float(baseline.mean())
+        result['baseline_median'] = float(np.median(baseline))
+        result['baseline_p95'] = float(np.percentile(baseline, 95))
+        result['saccade_ratio'] = float(np.concatenate((saccade[:,0], saccade[:,1]))[compared].mean())
+        return result
@@ -0,0 +1,468 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+"""
+Quality check of psychopy_tobii_controller's data files.
+
+Each data file is read once with constant memory and summarized per
+session.  Run as a console command to summarize data files in
+directories with a process pool ::
+
+    ptc-qa data_dir -o summary.csv
+    python -m psychopy_tobii_controller.qa data_dir --format json
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import sys
+import glob
+import json
+import argparse
+import numpy as np
+
+from psychopy_tobii_controller.compression import open_text, detect_compression
+
+summary_names = ('session', 'device', 'samples', 'duration', 'rate',
+                 'interval_mean', 'interval_sd', 'max_interval', 'longest_gap',
+                 'data_loss', 'data_loss_left', 'data_loss_right', 'events')
+
+summary_start = 'QA Summary Start'
+summary_end = 'QA Summary End'
+
+default_patterns = ('*.tsv', '*.tsv.*', '*.txt', '*.txt.*')
+
+chunk_size = 8192
+
+
+def round_timestamps(t):
+    """
+    Round timestamps (ms) in the same way as they are written to data
+    files ('%.1f'), so that summaries made while recording agree with
+    summaries made from the data file.
+    Usually, users don't have to call this function.
+
+    :param t: Array-like of timestamps.
+    """
+
+    t = np.asarray(t, dtype=float)
+    rounded = np.round(t, 1)
+    # numpy.round() and '%.1f' differ only near ties.
+    tie = np.abs(t*10-np.floor(t*10)-0.5) < 1e-6
+    if tie.any():
+        rounded[tie] = [float('%.1f' % v) for v in t[tie]]
+    return rounded
+
+
+class session_summary:
+    """
+    Accumulate statistics of a session from chunks of samples.
+
+    Following items are reported by :func:`result`.
+
+    - 'samples': number of samples.
+    - 'duration': time from the first to the last sample (ms).
+    - 'rate': effective sampling rate (Hz).
+    - 'interval_mean', 'interval_sd': mean and standard deviation
+      (jitter) of inter-sample intervals (ms).
+    - 'max_interval': the longest inter-sample interval (ms).
+    - 'longest_gap': the longest time between two samples where at
+      least one eye is valid (ms).  This includes both dropped samples and
+      runs of invalid samples (e.g. blinks).
+    - 'data_loss', 'data_loss_left', 'data_loss_right': percentage of
+      samples where both eyes, the left eye and the right eye are invalid.
+    - 'events': number of events.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.n_lost = 0
+        self.n_lost_left = 0
+        self.n_lost_right = 0
+        self.n_events = 0
+        self.first_t = None
+        self.last_t = None
+        self.last_valid_t = None
+        self.interval_sum = 0.0
+        self.interval_sumsq = 0.0
+        self.max_interval = np.nan
+        self.longest_gap = np.nan
+
+
+    def add(self, t, lv, rv):
+        """
+        Add a chunk of samples.
+
+        :param t: Array-like of timestamps (ms).
+        :param lv: Array-like of validity of the left eye.
+        :param rv: Array-like of validity of the right eye.
+        """
+
+        t = np.asarray(t, dtype=float)
+        if len(t) == 0:
+            return
+        lv = np.asarray(lv) != 0
+        rv = np.asarray(rv) != 0
+        valid = lv | rv
+
+        if self.first_t is None:
+            self.first_t = t[0]
+            intervals = np.diff(t)
+        else:
+            intervals = np.diff(t, prepend=self.last_t)
+        if len(intervals) > 0:
+            self.interval_sum += intervals.sum()
+            self.interval_sumsq += np.dot(intervals, intervals)
+            self.max_interval = np.fmax(self.max_interval, intervals.max())
+        self.last_t = t[-1]
+
+        tv = t[valid]
+        if len(tv) > 0:
+            gaps = np.diff(tv) if self.last_valid_t is None else np.diff(tv, prepend=self.last_valid_t)
+            if len(gaps) > 0:
+                self.longest_gap = np.fmax(self.longest_gap, gaps.max())
+            self.last_valid_t = tv[-1]
+
+        self.n += len(t)
+        self.n_lost += int(np.count_nonzero(~valid))
+        self.n_lost_left += int(np.count_nonzero(~lv))
+        self.n_lost_right += int(np.count_nonzero(~rv))
+
+
+    def result(self):
+        """
+        Get the summary as a dict object.
+        """
+
+        result = {'samples': self.n, 'events': self.n_events}
+        n_intervals = self.n-1
+        if n_intervals > 0:
+            duration = self.last_t-self.first_t
+            mean = self.interval_sum/n_intervals
+            result['duration'] = float(duration)
+            result['rate'] = float(n_intervals/duration*1000.0) if duration > 0 else np.nan
+            result['interval_mean'] = float(mean)
+            result['interval_sd'] = float(np.sqrt(max(self.interval_sumsq/n_intervals-mean*mean, 0.0)))
+        else:
+            for name in ('duration', 'rate', 'interval_mean', 'interval_sd'):
+                result[name] = np.nan
+        result['max_interval'] = float(self.max_interval)
+        result['longest_gap'] = float(self.longest_gap)
+        for name, n in (('data_loss', self.n_lost), ('data_loss_left', self.n_lost_left),
+                        ('data_loss_right', self.n_lost_right)):
+            result[name] = 100.0*n/self.n if self.n > 0 else np.nan
+        return result
+
+
+def write_summary(fp, summaries):
+    """
+    Write summaries of sessions to a data file.
+    Usually, users don't have to call this function.
+
+    :param fp: File object.
+    :param summaries: List of dict objects (see :func:`summarize_file`).
+    """
+
+    fp.write(summary_start+'\n')
+    fp.write('\t'.join(summary_names)+'\n')
+    for summary in summaries:
+        fp.write('\t'.join([str(summary.get(name, '')) for name in summary_names])+'\n')
+    fp.write(summary_end+'\n\n')
+
+
+def _parse_summary_lines(lines):
+    summaries = None
+    columns = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == summary_start:
+            summaries = []
+            columns = None
+        elif summaries is None:
+            continue
+        elif line == summary_end:
+            return summaries
+        elif columns is None:
+            columns = line.split('\t')
+        else:
+            summary = {}
+            for name, value in zip(columns, line.split('\t')):
+                if name == 'device':
+                    summary[name] = value
+                elif name in ('session', 'samples', 'events'):
+                    summary[name] = int(value)
+                else:
+                    summary[name] = float(value)
+            summaries.append(summary)
+    return None
+
+
+def read_summary(filename, tail_size=65536):
+    """
+    Read summaries written by
+    :func:`~psychopy_tobii_controller.tobii_controller.close_datafile`.
+    Returned value is a list of dict objects, or None if the data file
+    does not have summaries.  Only the end of the file is read if the
+    file is not compressed.
+
+    :param str filename: Name of data file.
+    :param int tail_size: Number of bytes read from the end of the file.
+    """
+
+    if detect_compression(filename) is None:
+        with open(filename, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell()
+            while True:
+                fp.seek(max(size-tail_size, 0))
+                tail = fp.read().decode('utf-8', errors='replace')
+                # enlarge the tail if summaries are longer than tail_size.
+                if summary_start in tail or summary_end not in tail or tail_size >= size:
+                    break
+                tail_size *= 4
+        if summary_start not in tail:
+            return None
+        return _parse_summary_lines(tail[tail.rindex(summary_start):].splitlines())
+
+    fp = open_text(filename, 'r')
+    try:
+        return _parse_summary_lines(fp)
+    finally:
+        fp.close()
+
+
+def summarize_file(filename, use_summary=True):
+    """
+    Summarize sessions in a data file.  The file is read line by line and
+    samples are processed in chunks, so memory usage does not depend on
+    the size of the file.
+    Returned value is a list of dict objects (one per session and device)
+    with items described in :class:`session_summary` and 'session'
+    (index of the session in the lists returned by
+    :func:`~psychopy_tobii_controller.utility.load_data`) and 'device'
+    (device number for :class:`~psychopy_tobii_controller.tobii_multi_controller`,
+    otherwise an empty string).
+
+    :param str filename: Name of data file.
+    :param bool use_summary: If True and the data file has summaries
+        written when the file was closed, they are returned without
+        reading the data.  Default value is True.
+    """
+
+    if use_summary:
+        summaries = read_summary(filename)
+        if summaries is not None:
+            return summaries
+
+    summaries = []
+    event_mode = ''
+    status = 'none'
+    session = 0
+    accumulators = {}
+    chunks = {}
+    n_events = 0
+
+    def flush(device):
+        chunk = chunks[device]
+        if len(chunk) > 0:
+            chunk = np.array(chunk, dtype=float)
+            accumulators[device].add(chunk[:,0], chunk[:,1], chunk[:,2])
+            chunks[device] = []
+
+    fp = open_text(filename, 'r')
+    try:
+        for processed_lines, line in enumerate(fp, 1):
+            items = line.rstrip().split('\t')
+
+            if items[0] == 'Event recording mode:':
+                event_mode = items[1]
+
+            elif items[0] == 'Session Start':
+                accumulators = {}
+                chunks = {}
+                n_events = 0
+                status = 'none'
+
+            elif items[0] == 'Clock sync:':
+                pass
+
+            elif items[0] in ('Validation Start', summary_start):
+                status = 'skip'
+
+            elif items[0] in ('Validation End', summary_end):
+                status = 'none'
+
+            elif items[0] == 'Session End':
+                for device in sorted(accumulators):
+                    flush(device)
+                    accumulators[device].n_events = n_events
+                    summary = accumulators[device].result()
+                    summary['session'] = session
+                    summary['device'] = device
+                    summaries.append(summary)
+                if accumulators:
+                    session += 1
+                accumulators = {}
+                status = 'none'
+
+            elif len(items) == 2 and items[0] == 'TimeStamp' and items[1] == 'Event':
+                status = 'event'
+
+            elif items[0] == 'TimeStamp':
+                status = 'data'
+
+            elif status == 'data' and items[0] != '':
+                if event_mode == 'Embedded' and len(items) >= 12:
+                    n_events += 1
+                    continue
+                if len(items) < 11:
+                    raise ValueError('Invalid data format in line {}'.format(processed_lines))
+                device = items[11] if len(items) >= 12 else ''
+                if device not in accumulators:
+                    accumulators[device] = session_summary()
+                    chunks[device] = []
+                chunks[device].append((float(items[0]), float(items[4]), float(items[8])))
+                if len(chunks[device]) >= chunk_size:
+                    flush(device)
+
+            elif status == 'event' and items[0] != '':
+                n_events += 1
+    finally:
+        fp.close()
+
+    return summaries
+
+
+def _summarize_file_safe(args):
+    filename, use_summary = args
+    try:
+        return filename, summarize_file(filename, use_summary), None
+    except Exception as e:
+        return filename, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def find_datafiles(paths, patterns=default_patterns, recursive=False):
+    """
+    Find data files.  Returned value is a sorted list of file names.
+
+    :param paths: List of files and directories.
+    :param patterns: Patterns of file names in directories.
+    :param bool recursive: If True, subdirectories are searched.
+    """
+
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in patterns:
+                if recursive:
+                    files.update(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+                else:
+                    files.update(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.add(path)
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+def summarize_files(filenames, use_summary=True, processes=None):
+    """
+    Summarize data files with a process pool.
+    Returned value is a list of dict objects with 'file' and 'error'
+    in addition to the items returned by :func:`summarize_file`.
+    A file that cannot be read has a row with the error message.
+
+    :param filenames: List of data files.
+    :param bool use_summary: See :func:`summarize_file`.
+    :param int processes: Number of processes.  If None, the number of
+        CPUs is used.  If 1, files are processed in this process.
+    """
+
+    args = [(f, use_summary) for f in filenames]
+    if processes == 1 or len(args) <= 1:
+        results = map(_summarize_file_safe, args)
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(processes)
+        results = executor.map(_summarize_file_safe, args)
+
+    rows = []
+    try:
+        for filename, summaries, error in results:
+            if error is not None:
+                rows.append({'file': filename, 'error': error})
+            for summary in summaries:
+                row = {'file': filename, 'error': ''}
+                row.update(summary)
+                rows.append(row)
+    finally:
+        if processes != 1 and len(args) > 1:
+            executor.shutdown()
+    return rows
+
+
+def write_table(rows, fp, format='csv'):
+    """
+    Write rows returned by :func:`summarize_files`.
+
+    :param rows: List of dict objects.
+    :param fp: File object.
+    :param str format: 'csv' or 'json'.
+    """
+
+    if format == 'json':
+        def convert(value):
+            return None if isinstance(value, float) and np.isnan(value) else value
+        json.dump([{k: convert(v) for k, v in row.items()} for row in rows], fp, indent=1)
+        fp.write('\n')
+    elif format == 'csv':
+        import csv
+        writer = csv.DictWriter(fp, ('file',)+summary_names+('error',), restval='',
+                                lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: ('%.6g' % v if isinstance(v, float) else v) for k, v in row.items()})
+    else:
+        raise ValueError('format must be csv or json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='ptc-qa',
+        description="Summarize data loss, sampling rate, jitter, gaps and events "
+                    "of psychopy_tobii_controller's data files.")
+    parser.add_argument('paths', nargs='+', help='data files or directories')
+    parser.add_argument('-o', '--output', help='output file (default: standard output)')
+    parser.add_argument('-f', '--format', choices=('csv', 'json'),
+                        help='output format (default: from extension of output, or csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('-p', '--pattern', action='append',
+                        help='pattern of data files in directories (default: %s)' % ' '.join(default_patterns))
+    parser.add_argument('-r', '--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--recompute', action='store_true',
+                        help='ignore summaries written in data files')
+    args = parser.parse_args(argv)
+
+    format = args.format
+    if format is None:
+        format = 'json' if args.output is not None and args.output.endswith('.json') else 'csv'
+
+    files = find_datafiles(args.paths, args.pattern or default_patterns, args.recursive)
+    if len(files) == 0:
+        parser.error('no data file is found.')
+    rows = summarize_files(files, not args.recompute, args.jobs)
+
+    if args.output is None:
+        write_table(rows, sys.stdout, format)
+    else:
+        with open(args.output, 'w', newline='') as fp:
+            write_table(rows, fp, format)
+    return 1 if any(row['error'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
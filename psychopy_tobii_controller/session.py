@@ -0,0 +1,228 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import numpy as np
+
+from psychopy_tobii_controller.constants import *
+
+column_names = ('TimeStamp', 'GazePointXLeft', 'GazePointYLeft', 'PupilLeft', 'ValidityLeft',
+                'GazePointXRight', 'GazePointYRight', 'PupilRight', 'ValidityRight',
+                'GazePointX', 'GazePointY', 'Device')
+
+eye_columns = {'L': (GazePointXLeft, GazePointYLeft, ValidityLeft),
+               'R': (GazePointXRight, GazePointYRight, ValidityRight),
+               'LR': (GazePointX, GazePointY, None)}
+
+
+class gaze_session:
+    """
+    Gaze data of a session with named columns, metadata and cached
+    derived channels.
+
+    Columns are returned as views of the data (not copies), e.g.
+    session['GazePointXLeft'] or session.t.  Other keys are passed to
+    the underlying numpy.ndarray, so session[:,0] works as before and
+    functions in :mod:`~psychopy_tobii_controller.utility` accept a
+    gaze_session wherever gaze data of a single session is expected.
+
+    Derived channels (validity masks, sample-to-sample displacement,
+    velocity, data in other units) are calculated when they are requested
+    for the first time and are cached.  Cached arrays are read-only.
+    The data must not be modified after the session is made.
+
+    *Example* ::
+
+        sessions = load_sessions('datafile.tsv')
+        s = sessions[0]
+        fixations = detect_fixation_vt(s.convert('pix'), max_velocity=20)
+        speed = s.convert('deg').velocity('LR')
+    """
+
+    def __init__(self, data, events=None, info=None):
+        """
+        :param numpy.ndarray data: Gaze data (single session) returned by
+            :func:`~psychopy_tobii_controller.utility.load_data`.
+        :param list events: Event data of the session.
+        :param dict info: Information of the session returned by
+            :func:`~psychopy_tobii_controller.utility.load_session_info`.
+        """
+
+        self.data = np.asarray(data, dtype=float)
+        self.events = [] if events is None else events
+        self.info = {} if info is None else info
+        self._cache = {}
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or np.dtype(dtype) == self.data.dtype:
+            return self.data
+        return self.data.astype(dtype)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in column_names[:self.data.shape[1]]:
+                raise KeyError(key)
+            return self.data[:,column_names.index(key)]
+        return self.data[key]
+
+
+    @property
+    def t(self):
+        """
+        Timestamps (ms).
+        """
+
+        return self.data[:,TimeStamp]
+
+
+    def cached(self, key, func):
+        """
+        Get a derived value.  func() is called only for the first request
+        of key, and the result is returned for later requests.  Arrays are
+        made read-only.  Usually, users don't have to call this method.
+
+        :param key: Hashable key.
+        :param func: Function without arguments.
+        """
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        value = func()
+        for v in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+        self._cache[key] = value
+        return value
+
+
+    def clear_cache(self):
+        """
+        Remove cached values.
+        """
+
+        self._cache = {}
+
+
+    def get_xy(self, eye='LR'):
+        """
+        Get gaze positions as a tuple of (x, y) views.
+
+        :param str eye: 'L', 'R' or 'LR' (average of eyes).
+        """
+
+        if eye not in eye_columns:
+            raise ValueError('eye must be L, R, or LR')
+        x, y, v = eye_columns[eye]
+        return self.data[:,x], self.data[:,y]
+
+
+    def valid(self, eye='LR'):
+        """
+        Get a boolean mask of samples with valid gaze position (cached).
+
+        :param str eye: 'L', 'R', 'LR' (at least one eye is valid) or
+            'both' (both eyes are valid).
+        """
+
+        def compute():
+            if eye in ('L', 'R'):
+                x, y, v = eye_columns[eye]
+                return (self.data[:,v] != 0) & ~np.isnan(self.data[:,x]) & ~np.isnan(self.data[:,y])
+            elif eye == 'LR':
+                return self.valid('L') | self.valid('R')
+            elif eye == 'both':
+                return self.valid('L') & self.valid('R')
+            raise ValueError('eye must be L, R, LR or both')
+        return self.cached(('valid', eye), compute)
+
+
+    def displacement(self, eye='LR'):
+        """
+        Get distance between successive gaze positions (cached).
+        The length is len(session)-1.
+
+        :param str eye: 'L', 'R' or 'LR'.
+        """
+
+        def compute():
+            x, y = self.get_xy(eye)
+            return np.hypot(np.diff(x), np.diff(y))
+        return self.cached(('displacement', eye), compute)
+
+
+    def velocity(self, eye='LR'):
+        """
+        Get gaze velocity (units of the data per second) between successive
+        samples (cached).  The length is len(session)-1.
+
+        :param str eye: 'L', 'R' or 'LR'.
+        """
+
+        def compute():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return self.displacement(eye)/np.diff(self.t)*1000.0
+        return self.cached(('velocity', eye), compute)
+
+
+    def convert(self, units):
+        """
+        Get the session in other units (cached).  Returned value is a
+        gaze_session that shares events with this session.
+        See :func:`~psychopy_tobii_controller.utility.convert_gaze_units`.
+
+        :param str units: 'raw', 'pix', 'norm', 'height', 'cm', 'deg',
+            'degFlat', 'degFlatPos' or 'psychopy'.
+        """
+
+        from psychopy_tobii_controller.utility import convert_gaze_units
+
+        def compute():
+            info = dict(self.info)
+            info['Data units'] = info.get('Window units') if units == 'psychopy' else units
+            session = gaze_session(convert_gaze_units(self.data, self.info, units),
+                                   self.events, info)
+            session.data.flags.writeable = False
+            return session
+        return self.cached(('convert', units), compute)
+
+
+def load_sessions(filename, units=None):
+    """
+    Load psychopy_tobii_controller's data file as a list of
+    :class:`gaze_session` objects with events and information of the
+    sessions.
+
+    :param str filename: Name of data file.
+    :param str units: Units of gaze positions.  If None, positions are
+        not converted.  Default value is None.
+    """
+
+    from psychopy_tobii_controller.utility import iter_sessions, load_session_info
+
+    sessions = []
+    info = load_session_info(filename)
+    for i, (data, events) in enumerate(iter_sessions(filename, units)):
+        session_info = dict(info[i]) if i < len(info) else {}
+        if units is not None:
+            session_info['Data units'] = session_info.get('Window units') if units == 'psychopy' else units
+        sessions.append(gaze_session(data, events, session_info))
+    return sessions
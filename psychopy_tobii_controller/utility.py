@@ -10,10 +10,15 @@ from __future__ import absolute_import
 
 import numpy as np
 import sys
+import warnings
 
 from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.clock import map_timestamps
+from psychopy_tobii_controller.compression import open_text
+from psychopy_tobii_controller.validation import metric_names as validation_metric_names
+from psychopy_tobii_controller.session import gaze_session, eye_columns
 
-def load_data(filename):
+def load_data(filename, units=None):
     """
     Load psychopy_tobii_controller's data file.
     This function returns two lists. The first list contains
@@ -37,31 +42,79 @@ def load_data(filename):
     9. GazePointX
     10. GazePointY
     
+    Data recorded by :class:`~psychopy_tobii_controller.tobii_multi_controller`
+    has an additional column.
+    
+    11. Device
+    
     Event data of each session is stored as a list.
     
     [[timestamp1, event_string_1],
      [timestamp2, event_string_2],
      ...]
     
+    If numeric values are recorded with an event, they follow the
+    event string (e.g. [timestamp3, event_string_3, value1, value2]).
+    
+    Data files compressed by gzip, bz2 or lzma are decompressed
+    transparently.  Use :func:`~psychopy_tobii_controller.utility.iter_sessions`
+    to process sessions one by one without loading all sessions.
+    
+    Gaze positions are returned in the coordinate system of the data file
+    (PsychoPy's units of the window, or Tobii's display area coordinates
+    if the file was recorded with open_datafile(raw=True)) unless units
+    is specified.  See :func:`~psychopy_tobii_controller.utility.convert_gaze_units`.
+    
     *Example* ::
     
         gaze_data, event_data = load_data('datafile.txt')
+        gaze_data, event_data = load_data('datafile.txt', units='pix')
     
     :param str filename:
         name of data file.
-    :
+    :param str units:
+        Units of gaze positions.  If None, positions are not converted.
+        Default value is None.
     """
 
-    status = 'none'
-    event_mode = ''
     data = []
     event = []
+
+    for trial_data, trial_event in iter_sessions(filename, units):
+        data.append(trial_data)
+        event.append(trial_event)
+
+    return data, event
+
+
+def iter_sessions(filename, units=None):
+    """
+    Iterate over sessions in psychopy_tobii_controller's data file.
+    Each item is a tuple of gaze data and event data of a session.
+    See :func:`~psychopy_tobii_controller.utility.load_data` for
+    the format of gaze data and event data.
+    
+    *Example* ::
+    
+        for gaze_data, event_data in iter_sessions('datafile.tsv.gz'):
+            print(gaze_data.shape)
+    
+    :param str filename:
+        name of data file.
+    :param str units:
+        Units of gaze positions.  If None, positions are not converted.
+        Default value is None.
+    """
+
+    status = 'none'
+    event_mode = ''
+    header = {}
     trial_data = []
     trial_event = []
 
     processed_lines = 0
 
-    fp = open(filename, 'r')
+    fp = open_text(filename, 'r')
 
     for line in fp:
         processed_lines += 1
@@ -71,7 +124,7 @@ def load_data(filename):
             pass
 
         elif items[0][:9] == 'Recording':
-            pass
+            header[items[0].rstrip(':')] = '\t'.join(items[1:])
 
         elif items[0] == 'Event recording mode:':
             event_mode = items[1]
@@ -80,10 +133,23 @@ def load_data(filename):
             trial_data = []
             trial_event = []
 
+        elif items[0] == 'Clock sync:':
+            # see load_session_info().  tobii_multi_controller writes
+            # these lines after gaze data.
+            pass
+
+        elif items[0] == 'Validation Start':
+            status = 'validation'
+
+        elif items[0] == 'Validation End':
+            status = 'none'
+
         elif items[0] == 'Session End':
             if len(trial_data) > 0:
-                data.append(np.array(trial_data))
-                event.append(trial_event)
+                trial_data = np.array(trial_data)
+                if units is not None:
+                    trial_data = convert_gaze_units(trial_data, header, units)
+                yield trial_data, trial_event
             
             status = 'none'
         
@@ -91,7 +157,10 @@ def load_data(filename):
             if status != 'event': status = 'event' 
 
         elif items[0] == 'TimeStamp':
-            if status != data: status = 'data'
+            if status != 'data': status = 'data'
+
+        elif status == 'none' and items[0][-1:] == ':':
+            header[items[0][:-1]] = '\t'.join(items[1:])
 
         else: # data
             if status=='data':
@@ -101,16 +170,240 @@ def load_data(filename):
                 elif event_mode == 'Embedded':
                     if len(items)==11:
                         trial_data.append(list(map(float, items)))
-                    elif len(items)==12:
-                        trial_event.append([float(items[0]), items[-1]])
+                    elif len(items)>=12:
+                        trial_event.append([float(items[0]), items[11]] + list(map(float, items[12:])))
                     else:
+                        fp.close()
                         raise ValueError('Invalid data format in line {}'.format(processed_lines))
                 else:
+                    fp.close()
                     raise ValueError('Invalid event mode')
             elif status=='event':  # Separated mode only
-                trial_event.append([float(items[0]), items[-1]])
+                trial_event.append([float(items[0]), items[1]] + list(map(float, items[2:])))
 
-    return data, event
+    fp.close()
+
+
+def load_session_info(filename):
+    """
+    Load information of recording sessions from psychopy_tobii_controller's
+    data file.  This function returns a list of dict objects.  Each dict
+    object corresponds to the session of the same index in the lists
+    returned by :func:`~psychopy_tobii_controller.utility.load_data`.
+    
+    Items of the file header such as 'Recording date' are stored as
+    strings.  Parameters of clock synchronization are stored in
+    'clock_sync', which can be passed to
+    :func:`~psychopy_tobii_controller.utility.map_timestamps`.
+    
+    *Example* ::
+    
+        gaze_data, event_data = load_data('datafile.txt')
+        info = load_session_info('datafile.txt')
+        
+        # convert timestamps of the first session to PsychoPy's clock.
+        t = map_timestamps(gaze_data[0][:,TimeStamp], 'session', 'psychopy',
+                           info[0]['clock_sync'])
+    
+    :param str filename:
+        name of data file.
+    """
+
+    header = {}
+    sessions = []
+    current = None
+    has_data = False
+
+    fp = open_text(filename, 'r')
+
+    for line in fp:
+        items = line.rstrip('\n').split('\t')
+
+        if items[0] == 'Session Start':
+            current = dict(header)
+            current['clock_sync'] = {}
+            has_data = False
+
+        elif items[0] == 'Session End':
+            if current is not None and has_data:
+                sessions.append(current)
+            current = None
+
+        elif items[0] == 'Clock sync:':
+            if current is not None:
+                current['clock_sync'][items[1]] = tuple(map(float, items[2:5]))
+
+        elif items[0][-1:] == ':':
+            if current is None:
+                header[items[0][:-1]] = '\t'.join(items[1:])
+            else:
+                current[items[0][:-1]] = '\t'.join(items[1:])
+
+        elif current is not None and items[0] not in ('', 'TimeStamp'):
+            has_data = True
+
+    fp.close()
+
+    return sessions
+
+
+def _position_to_pix(x, y, units, size, width, distance):
+    if units == 'raw':
+        return (x-0.5)*size[0], (0.5-y)*size[1]
+    elif units == 'pix':
+        return x, y
+    elif units == 'norm':
+        return x*size[0]/2.0, y*size[1]/2.0
+    elif units == 'height':
+        return x*size[1], y*size[1]
+    if width is None or distance is None:
+        raise ValueError('monitor geometry is required to convert {}.'.format(units))
+    cm_per_pix = width/size[0]
+    if units == 'cm':
+        return x/cm_per_pix, y/cm_per_pix
+    elif units == 'deg':
+        # same as psychopy.tools.monitorunittools
+        return x*distance*0.017455/cm_per_pix, y*distance*0.017455/cm_per_pix
+    elif units in ('degFlat', 'degFlatPos'):
+        return np.tan(np.radians(x))*distance/cm_per_pix, np.tan(np.radians(y))*distance/cm_per_pix
+    raise ValueError('unit ({}) is not supported.'.format(units))
+
+
+def _pix_to_position(x, y, units, size, width, distance):
+    if units == 'raw':
+        return x/size[0]+0.5, 0.5-y/size[1]
+    elif units == 'pix':
+        return x, y
+    elif units == 'norm':
+        return x/(size[0]/2.0), y/(size[1]/2.0)
+    elif units == 'height':
+        return x/size[1], y/size[1]
+    if width is None or distance is None:
+        raise ValueError('monitor geometry is required to convert {}.'.format(units))
+    cm_per_pix = width/size[0]
+    if units == 'cm':
+        return x*cm_per_pix, y*cm_per_pix
+    elif units == 'deg':
+        return x*cm_per_pix/(distance*0.017455), y*cm_per_pix/(distance*0.017455)
+    elif units in ('degFlat', 'degFlatPos'):
+        return np.degrees(np.arctan(x*cm_per_pix/distance)), np.degrees(np.arctan(y*cm_per_pix/distance))
+    raise ValueError('unit ({}) is not supported.'.format(units))
+
+
+def convert_gaze_units(data, info, units):
+    """
+    Convert gaze positions of a session to other units.
+    Positions of both eyes are converted at once (vectorized) and the
+    average of eyes is recalculated.  Returned value is a new array.
+    
+    Allowed units are 'raw' (Tobii's display area coordinates), 'pix',
+    'norm', 'height', 'cm', 'deg', 'degFlat', 'degFlatPos' and 'psychopy'
+    (units of the window when the data was recorded).  'cm' and 'deg' units
+    require monitor geometry in the data file.  If info has 'Data units',
+    data are assumed to be in these units (e.g. data already converted).
+    
+    *Example* ::
+    
+        gaze_data, event_data = load_data('datafile.txt')
+        info = load_session_info('datafile.txt')
+        pix_data = convert_gaze_units(gaze_data[0], info[0], 'pix')
+    
+    :param numpy.ndarray data:
+        Gaze data (single session).
+    :param dict info:
+        Information of the session returned by
+        :func:`~psychopy_tobii_controller.utility.load_session_info`.
+    :param str units:
+        Units of converted positions.
+    """
+    
+    if 'Recording resolution' not in info or 'Window units' not in info:
+        raise ValueError('data file does not have information for conversion.')
+    size = tuple(float(v) for v in info['Recording resolution'].split('x'))
+    window_units = info['Window units']
+    src = info.get('Data units')
+    if src is None:
+        src = 'raw' if info.get('Coordinate system') == 'Raw' else window_units
+    dst = window_units if units == 'psychopy' else units
+    
+    def geometry(name):
+        try:
+            return float(info[name])
+        except (KeyError, ValueError):
+            return None
+    width = geometry('Monitor width')
+    distance = geometry('Viewing distance')
+    if width is not None and 'Monitor resolution' in info:
+        # PsychoPy converts pixels to cm with the resolution of the monitor.
+        width *= size[0]/float(info['Monitor resolution'].split('x')[0])
+    
+    data = np.array(data, dtype=float)
+    if src == dst:
+        return data
+    for x, y in ((GazePointXLeft, GazePointYLeft), (GazePointXRight, GazePointYRight)):
+        px, py = _position_to_pix(data[:,x], data[:,y], src, size, width, distance)
+        data[:,x], data[:,y] = _pix_to_position(px, py, dst, size, width, distance)
+    
+    lv = data[:,ValidityLeft] != 0
+    rv = data[:,ValidityRight] != 0
+    for ave, left, right in ((GazePointX, GazePointXLeft, GazePointXRight),
+                             (GazePointY, GazePointYLeft, GazePointYRight)):
+        data[:,ave] = np.where(lv & rv, (data[:,left]+data[:,right])/2.0,
+                               np.where(lv, data[:,left], np.where(rv, data[:,right], np.nan)))
+    return data
+
+
+def load_validation_results(filename):
+    """
+    Load results of validation written by
+    :func:`~psychopy_tobii_controller.tobii_controller.run_validation`.
+    This function returns a list of dict objects in the order of
+    validation.  Each dict object has 'points' (position of targets
+    in PsychoPy's coordinates) and items returned by
+    :func:`~psychopy_tobii_controller.validation.compute_validation_metrics`.
+    
+    *Example* ::
+    
+        results = load_validation_results('datafile.txt')
+        print(results[-1]['mean_accuracy_L'], results[-1]['mean_accuracy_R'])
+    
+    :param str filename:
+        name of data file.
+    """
+
+    results = []
+    rows = None
+
+    fp = open_text(filename, 'r')
+
+    for line in fp:
+        items = line.rstrip('\n').split('\t')
+
+        if items[0] == 'Validation Start':
+            rows = []
+
+        elif items[0] == 'Validation End':
+            rows = None
+
+        elif rows is None or items[0] == 'Point':
+            pass
+
+        elif items[0] == 'Mean':
+            rows = np.array(rows, dtype=float).reshape(-1, 3+2*len(validation_metric_names))
+            result = {'points': rows[:,1:3]}
+            for i, name in enumerate(validation_metric_names):
+                result[name+'_L'] = rows[:,3+2*i]
+                result[name+'_R'] = rows[:,4+2*i]
+                result['mean_'+name+'_L'] = float(items[3+2*i])
+                result['mean_'+name+'_R'] = float(items[4+2*i])
+            results.append(result)
+
+        else:
+            rows.append(list(map(float, items)))
+
+    fp.close()
+
+    return results
 
 
 def moving_average(data, n=3):
@@ -238,6 +531,19 @@ def interpolate_gaze_data(data, t):
     return np.array(result)
 
 
+def _get_xy(data, eye):
+    """
+    Get (x, y) of gaze data or a gaze_session.
+    """
+    
+    if isinstance(data, gaze_session):
+        return data.get_xy(eye)
+    if eye not in eye_columns:
+        raise ValueError('eye must be L, R, or LR')
+    x, y, v = eye_columns[eye]
+    return data[:,x], data[:,y]
+
+
 def detect_fixation_vt(data, max_velocity=100, min_duration=100, eye='LR'):
     """
     Detect fixations using velocity-threshold method.
@@ -259,19 +565,12 @@ def detect_fixation_vt(data, max_velocity=100, min_duration=100, eye='LR'):
         Specify which eye is used.  Allowed value is 'L', 'R', or 'LR'.
         Each corresponds to left eye, right eye and avrage of eyes.
     """
-    if eye=='L':
-        x = data[:,GazePointXLeft]
-        y = data[:,GazePointYLeft]
-    elif eye=='R':
-        x = data[:,GazePointXRight]
-        y = data[:,GazePointYRight]
-    elif eye=='LR':
-        x = data[:,GazePointX]
-        y = data[:,GazePointY]
-    else:
-        raise ValueError('eye must be L, R, or LR')
+    x, y = _get_xy(data, eye)
     
-    vg = np.sqrt(np.diff(x)**2+np.diff(y)**2)
+    if isinstance(data, gaze_session):
+        vg = data.displacement(eye)
+    else:
+        vg = np.sqrt(np.diff(x)**2+np.diff(y)**2)
     vt = np.diff(data[:,0])
     
     on_fix = False
@@ -312,17 +611,7 @@ def detect_fixation_dt(data, max_dispersion=50, min_duration=100, eye='LR'):
     :param float min_duration:
         Fixation shorter than this value is rejected. Unit is milliseconds.
     """
-    if eye=='L':
-        x = data[:,GazePointXLeft]
-        y = data[:,GazePointYLeft]
-    elif eye=='R':
-        x = data[:,GazePointXRight]
-        y = data[:,GazePointYRight]
-    elif eye=='LR':
-        x = data[:,GazePointX]
-        y = data[:,GazePointY]
-    else:
-        raise ValueError('eye must be L, R, or LR')
+    x, y = _get_xy(data, eye)
 
     current_candidate = np.empty((0,2))
     candidates = []
@@ -355,3 +644,443 @@ def detect_fixation_dt(data, max_dispersion=50, min_duration=100, eye='LR'):
     
     return np.array(fixations)
 
+
+
+def compute_aoi_metrics(data, aois, data_type='fixation', eye='LR', start_time=None):
+    """
+    Calculate dwell time, first fixation latency, number of fixations and
+    transitions between areas of interest (AOIs).
+    Returned value is a dict object with following items.
+    
+    - 'names': list of names of AOIs.
+    - 'dwell_time': total duration of fixations in each AOI (ms).
+    - 'fixation_count': number of fixations in each AOI.
+    - 'first_fixation_latency': onset of the first fixation in each AOI
+      relative to start_time (ms).  NaN if the AOI is not fixated.
+    - 'first_fixation_duration': duration of the first fixation in each
+      AOI (ms).  NaN if the AOI is not fixated.
+    - 'transitions': tuple of numpy.ndarray (from, to, count), i.e. the
+      transition matrix in coordinate format.  A transition is counted
+      for every pair of AOIs containing two successive fixations.
+      Refixations in the same AOI are counted on the diagonal.
+    
+    Values of AOIs are numpy.ndarray in the order of names.
+    If AOIs overlap, a fixation is counted for all AOIs containing it.
+    
+    *Example* ::
+    
+        from psychopy_tobii_controller.aoi import aoi_set
+        
+        gaze_data, event_data = load_data('datafile.txt')
+        fixations = detect_fixation_dt(gaze_data[0])
+        aois = aoi_set()
+        aois.add_rect('left', -0.5, -0.1, -0.3, 0.1)
+        aois.add_circle('right', 0.4, 0.0, 0.1)
+        metrics = compute_aoi_metrics(fixations, aois)
+    
+    :param numpy.ndarray data:
+        Fixations returned by
+        :func:`~psychopy_tobii_controller.utility.detect_fixation_vt` or
+        :func:`~psychopy_tobii_controller.utility.detect_fixation_dt`,
+        or gaze data (single session, numpy.ndarray or
+        :class:`~psychopy_tobii_controller.session.gaze_session`).
+    :param aois:
+        :class:`~psychopy_tobii_controller.aoi.aoi_set` object.
+        Positions of AOIs must be in the units of the data file.
+    :param str data_type:
+        'fixation' or 'sample'.  If 'sample', each sample is treated as a
+        fixation which lasts until the next sample.
+    :param str eye:
+        Specify which eye is used if data_type is 'sample'.
+        Allowed value is 'L', 'R', or 'LR'.
+    :param float start_time:
+        Origin of first fixation latency (ms).  If None, onset of the
+        first fixation (or sample) is used.
+    """
+    
+    if data_type == 'fixation':
+        data = np.asarray(data, dtype=float).reshape(-1,4)
+        onset = data[:,0]
+        duration = data[:,1]
+        x = data[:,FixX]
+        y = data[:,FixY]
+    elif data_type == 'sample':
+        # cached columns of a gaze_session are used by _get_xy.
+        if not isinstance(data, gaze_session):
+            data = np.asarray(data, dtype=float)
+        x, y = _get_xy(data, eye)
+        onset = data[:,TimeStamp]
+        duration = np.diff(onset)
+        duration = np.append(duration, np.median(duration) if len(duration) > 0 else 0.0)
+    else:
+        raise ValueError('data_type must be fixation or sample')
+    
+    if start_time is None:
+        start_time = onset[0] if len(onset) > 0 else 0.0
+    
+    n_aois = len(aois)
+    fix, aoi = aois.contains_points(x, y)
+    
+    dwell_time = np.bincount(aoi, weights=duration[fix], minlength=n_aois)
+    fixation_count = np.bincount(aoi, minlength=n_aois)
+    
+    # fix is sorted in ascending order, so the first hit of each AOI
+    # is the first fixation in the AOI.
+    first_fixation_latency = np.full(n_aois, np.nan)
+    first_fixation_duration = np.full(n_aois, np.nan)
+    order = np.lexsort((fix, aoi))
+    first_aoi, first = np.unique(aoi[order], return_index=True)
+    first_fixation_latency[first_aoi] = onset[fix[order][first]] - start_time
+    first_fixation_duration[first_aoi] = duration[fix[order][first]]
+    
+    # join hits of fixation i with hits of fixation i+1
+    next_start = np.searchsorted(fix, fix+1, side='left')
+    next_end = np.searchsorted(fix, fix+1, side='right')
+    n_next = next_end-next_start
+    src = np.repeat(np.arange(len(fix)), n_next)
+    dst = np.arange(len(src)) - np.repeat(np.cumsum(n_next)-n_next, n_next) + np.repeat(next_start, n_next)
+    pairs, counts = np.unique(aoi[src]*n_aois + aoi[dst], return_counts=True)
+    
+    return {'names': list(aois.names),
+            'dwell_time': dwell_time,
+            'fixation_count': fixation_count,
+            'first_fixation_latency': first_fixation_latency,
+            'first_fixation_duration': first_fixation_duration,
+            'transitions': (pairs//n_aois if n_aois > 0 else pairs,
+                            pairs%n_aois if n_aois > 0 else pairs,
+                            counts)}
+
+
+def _find_runs(mask):
+    """
+    Find runs of True in a boolean array.
+    Returned value is a tuple of (starts, ends).  ends are exclusive.
+    """
+    
+    diff = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.nonzero(diff == 1)[0], np.nonzero(diff == -1)[0]
+
+
+def _expand_runs(t, starts, ends, before, after):
+    """
+    Mark samples within [t[start]-before, t[end-1]+after] of each run.
+    """
+    
+    lo = np.searchsorted(t, t[starts]-before, side='left')
+    hi = np.searchsorted(t, t[ends-1]+after, side='right')
+    marks = np.zeros(len(t)+1, dtype=int)
+    np.add.at(marks, lo, 1)
+    np.add.at(marks, hi, -1)
+    return np.cumsum(marks[:-1]) > 0
+
+
+def _pupil_columns(eye):
+    if eye=='L':
+        return PupilLeft, ValidityLeft
+    elif eye=='R':
+        return PupilRight, ValidityRight
+    else:
+        raise ValueError('eye must be L or R')
+
+
+def detect_pupil_artifacts(data, eye='L', n_mad=16.0):
+    """
+    Detect samples in which pupil size is not available or changes
+    too fast.
+    Returned value is a boolean numpy.ndarray (True: artifact).
+    
+    Dilation speed of each sample is the larger of absolute changes of
+    pupil size per millisecond from the previous and to the next samples.
+    Samples whose dilation speed exceeds median + n_mad*MAD (median
+    absolute deviation) are treated as artifacts.
+    
+    :param numpy.ndarray data:
+        Gaze data (single session).
+    :param str eye:
+        Specify which eye is used.  Allowed value is 'L' or 'R'.
+    :param float n_mad:
+        Threshold of dilation speed.  If None, dilation speed is not
+        tested.  Default value is 16.0.
+    """
+    
+    if isinstance(data, gaze_session):
+        return data.cached(('pupil_artifacts', eye, n_mad),
+                           lambda: detect_pupil_artifacts(data.data, eye, n_mad))
+    
+    pupil_col, validity_col = _pupil_columns(eye)
+    t = data[:,TimeStamp]
+    p = data[:,pupil_col]
+    invalid = (data[:,validity_col] == 0) | np.isnan(p)
+    
+    if n_mad is not None and len(p) > 1:
+        p = np.where(invalid, np.nan, p)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            speed = np.abs(np.diff(p)/np.diff(t))
+        speed = np.fmax(np.concatenate(([np.nan], speed)), np.concatenate((speed, [np.nan])))
+        if not np.all(np.isnan(speed)):
+            median = np.nanmedian(speed)
+            mad = np.nanmedian(np.abs(speed-median))
+            with np.errstate(invalid='ignore'):
+                invalid |= speed > median + n_mad*mad
+    
+    return invalid
+
+
+def detect_blinks(data, eye='L', min_duration=50, max_duration=500, n_mad=16.0):
+    """
+    Detect blinks from runs of artifacts (invalid samples and samples with
+    too fast pupil change).  See
+    :func:`~psychopy_tobii_controller.utility.detect_pupil_artifacts`.
+    Returned value is a numpy.ndarray with following 2 columns.
+    
+    0. Onset time (the first artifact sample)
+    1. Duration (from the first to the last artifact sample)
+    
+    :param numpy.ndarray data:
+        Gaze data (single session).
+    :param str eye:
+        Specify which eye is used.  Allowed value is 'L' or 'R'.
+    :param float min_duration:
+        Runs shorter than this value are rejected. Unit is milliseconds.
+    :param float max_duration:
+        Runs longer than this value are rejected (e.g. looking away).
+        If None, long runs are not rejected.  Unit is milliseconds.
+    :param float n_mad:
+        Threshold of dilation speed.  See detect_pupil_artifacts.
+    """
+    
+    t = data[:,TimeStamp]
+    starts, ends = _find_runs(detect_pupil_artifacts(data, eye, n_mad))
+    onset = t[starts]
+    duration = t[ends-1]-onset
+    keep = duration >= min_duration
+    if max_duration is not None:
+        keep &= duration <= max_duration
+    return np.column_stack((onset[keep], duration[keep]))
+
+
+def lowpass_filter(x, cutoff, rate):
+    """
+    Apply zero-phase Gaussian low-pass filter.  NaN values are ignored
+    (normalized convolution) and remain NaN.
+    
+    :param numpy.ndarray x: 1D array.
+    :param float cutoff: Cutoff frequency (Hz), at which the gain
+        is 1/sqrt(2).
+    :param float rate: Sampling rate (Hz).
+    """
+    
+    sigma = np.sqrt(np.log(2))/(2*np.pi*cutoff)*rate
+    radius = max(int(np.ceil(4*sigma)), 1)
+    kernel = np.exp(-0.5*(np.arange(-radius, radius+1)/sigma)**2)
+    valid = ~np.isnan(x)
+    num = np.convolve(np.where(valid, x, 0.0), kernel, mode='same')
+    den = np.convolve(valid.astype(float), kernel, mode='same')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid, num/den, np.nan)
+
+
+def preprocess_pupil(data, eye='LR', n_mad=16.0, padding=(50, 100), max_gap=None,
+                     cutoff=None, baseline=None, baseline_mode='subtract'):
+    """
+    Clean pupil size data.
+    Returned value is a numpy.ndarray of pupil size of each sample.
+    
+    1. Artifacts are detected by
+       :func:`~psychopy_tobii_controller.utility.detect_pupil_artifacts`.
+    2. Runs of artifacts are extended by padding (blink onset and
+       offset affect pupil size).
+    3. Removed samples are linearly interpolated.  Gaps longer than
+       max_gap are left as NaN.
+    4. If eye is 'LR', left and right pupils are averaged.  If one of
+       them is not available, the other is used.
+    5. Optionally, low-pass filter and baseline correction are applied.
+    
+    All steps are array operations whose memory use is proportional to
+    the number of samples.
+    
+    :param numpy.ndarray data:
+        Gaze data (single session).
+    :param str eye:
+        Specify which eye is used.  Allowed value is 'L', 'R', or 'LR'.
+    :param float n_mad:
+        Threshold of dilation speed.  See detect_pupil_artifacts.
+    :param padding:
+        Time removed before and after runs of artifacts (before, after).
+        Unit is milliseconds.  Default value is (50, 100).
+    :param float max_gap:
+        Maximum duration of interpolated gaps.  If None, all gaps are
+        interpolated.  Unit is milliseconds.
+    :param float cutoff:
+        Cutoff frequency of low-pass filter (Hz).  If None, low-pass
+        filter is not applied.
+    :param baseline:
+        Time range (start, end) of baseline in milliseconds.  If None,
+        baseline correction is not applied.
+    :param str baseline_mode:
+        'subtract' (pupil - baseline) or 'divide' (pupil / baseline).
+    """
+    
+    if eye=='LR':
+        left = preprocess_pupil(data, 'L', n_mad, padding, max_gap, cutoff)
+        right = preprocess_pupil(data, 'R', n_mad, padding, max_gap, cutoff)
+        pupil = np.where(np.isnan(left), right, np.where(np.isnan(right), left, (left+right)/2))
+    else:
+        pupil_col, validity_col = _pupil_columns(eye)
+        t = data[:,TimeStamp]
+        pupil = data[:,pupil_col].astype(float)
+        
+        starts, ends = _find_runs(detect_pupil_artifacts(data, eye, n_mad))
+        removed = _expand_runs(t, starts, ends, padding[0], padding[1])
+        pupil[removed] = np.nan
+        
+        valid = ~removed
+        if valid.any():
+            pupil[removed] = np.interp(t[removed], t[valid], pupil[valid])
+            if max_gap is not None:
+                starts, ends = _find_runs(removed)
+                # gap between the surrounding valid samples
+                gap = t[np.minimum(ends, len(t)-1)] - t[np.maximum(starts-1, 0)]
+                gap[(starts == 0) | (ends == len(t))] = np.inf
+                long_gap = np.zeros(len(t)+1, dtype=int)
+                np.add.at(long_gap, starts[gap > max_gap], 1)
+                np.add.at(long_gap, ends[gap > max_gap], -1)
+                pupil[np.cumsum(long_gap[:-1]) > 0] = np.nan
+        
+        if cutoff is not None and len(t) > 1:
+            pupil = lowpass_filter(pupil, cutoff, 1000.0/np.median(np.diff(t)))
+    
+    if baseline is not None:
+        t = data[:,TimeStamp]
+        in_baseline = (baseline[0] <= t) & (t <= baseline[1])
+        value = np.nanmean(pupil[in_baseline]) if in_baseline.any() else np.nan
+        if baseline_mode == 'subtract':
+            pupil = pupil - value
+        elif baseline_mode == 'divide':
+            pupil = pupil / value
+        else:
+            raise ValueError('baseline_mode must be subtract or divide')
+    
+    return pupil
+
+
+def epoch(data, events, label_filter=None, tmin=-200.0, tmax=1000.0, rate=None,
+          columns=None, baseline=None):
+    """
+    Cut gaze data around events into a 3-D array.
+    Returned value is a tuple of (epochs, times, selected_events).
+    
+    - epochs: numpy.ndarray of shape (n_events, n_times, n_columns).
+      Values at times outside of the recorded data are NaN.
+    - times: numpy.ndarray of time relative to events (ms).
+    - selected_events: list of events used to make epochs.
+    
+    If rate is given, timestamps, gaze positions and pupil sizes are
+    linearly interpolated at times, and other columns (e.g. validity)
+    take the value of the nearest sample.  Otherwise, recorded samples
+    are used as they are (the first sample of each epoch is the first
+    sample at or after event time + tmin) and times are nominal values
+    calculated from the median sampling interval.
+    
+    *Example* ::
+    
+        gaze_data, event_data = load_data('datafile.txt')
+        epochs, times, events = epoch(gaze_data[0], event_data[0], 'stim_onset',
+                                      -200, 1000, rate=500,
+                                      columns=[GazePointX, GazePointY],
+                                      baseline=(-200, 0))
+    
+    :param numpy.ndarray data:
+        Gaze data (single session).
+    :param events:
+        Event data (single session).
+    :param label_filter:
+        Event string, list of event strings or a function that receives
+        an event string and returns True if the event is used.
+        If None, all events are used.
+    :param float tmin:
+        Start of epochs relative to events (ms).
+    :param float tmax:
+        End of epochs relative to events (ms).  Not included.
+    :param float rate:
+        Sampling rate of epochs (Hz).  If None, recorded samples are used.
+    :param columns:
+        Columns of gaze data included in epochs.  If None, all columns
+        are included.
+    :param baseline:
+        Time range (start, end) relative to events (ms).  Mean value in
+        this range is subtracted from each epoch and column of gaze
+        positions and pupil sizes.  Other columns are not changed.
+        ValueError is raised if no time point is in this range.
+        If None, baseline correction is not applied.
+    """
+    
+    data = np.asarray(data, dtype=float)
+    t = data[:,TimeStamp]
+    column_indices = np.arange(data.shape[1])
+    if columns is not None:
+        data = data[:,columns]
+        column_indices = column_indices[columns]
+    continuous = np.isin(column_indices, (GazePointXLeft, GazePointYLeft, PupilLeft,
+                                          GazePointXRight, GazePointYRight, PupilRight,
+                                          GazePointX, GazePointY))
+    
+    if label_filter is None:
+        selected = list(events)
+    elif callable(label_filter):
+        selected = [e for e in events if label_filter(e[EventText])]
+    else:
+        if isinstance(label_filter, str):
+            label_filter = [label_filter]
+        labels = np.array([e[EventText] for e in events], dtype=object)
+        selected = [events[i] for i in np.nonzero(np.isin(labels, list(label_filter)))[0]]
+    event_t = np.array([e[EventTime] for e in selected], dtype=float)
+    
+    n_columns = data.shape[1]
+    if len(t) == 0:
+        times = np.arange(tmin, tmax, 1000.0/rate) if rate is not None else np.empty(0)
+        epochs = np.full((len(event_t), len(times), n_columns), np.nan)
+    elif rate is not None:
+        times = np.arange(tmin, tmax, 1000.0/rate)
+        target = event_t[:,np.newaxis] + times
+        i1 = np.clip(np.searchsorted(t, target, side='right'), 1, len(t)-1) if len(t) > 1 \
+            else np.zeros(target.shape, dtype=int)
+        i0 = np.maximum(i1-1, 0)
+        dt = t[i1]-t[i0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w = np.where(dt > 0, (target-t[i0])/dt, 0.0)[...,np.newaxis]
+        epochs = data[i0]*(1-w) + data[i1]*w
+        # validity etc. are not interpolated
+        nearest = np.where(w[...,0] < 0.5, i0, i1)
+        discrete = ~continuous
+        discrete[column_indices == TimeStamp] = False
+        epochs[...,discrete] = data[nearest][...,discrete]
+        epochs[(target < t[0]) | (target > t[-1])] = np.nan
+    else:
+        interval = np.median(np.diff(t)) if len(t) > 1 else 1.0
+        n_times = max(int(round((tmax-tmin)/interval)), 0)
+        times = tmin + np.arange(n_times)*interval
+        start = np.searchsorted(t, event_t+tmin, side='left')
+        # windows that start before the beginning of data begin with
+        # as many NaN rows as nominal samples before the first sample.
+        before = event_t+tmin < t[0]
+        n_before = np.clip(np.round((t[0]-(event_t+tmin))/interval), 0, n_times).astype(int)
+        start = np.where(before, n_times-n_before, n_times+start)
+        # windows beyond the end of data are filled with NaN rows
+        padding = np.full((n_times, n_columns), np.nan)
+        padded = np.vstack((padding, data, padding))
+        windows = np.lib.stride_tricks.sliding_window_view(padded, n_times, axis=0)
+        epochs = windows[start].transpose(0,2,1).copy()
+    
+    if baseline is not None:
+        in_baseline = (baseline[0] <= times) & (times <= baseline[1])
+        if len(times) > 0 and not in_baseline.any():
+            raise ValueError('baseline ({}, {}) does not overlap epochs ({}, {}).'.format(
+                baseline[0], baseline[1], times[0], times[-1]))
+        if in_baseline.any() and continuous.any():
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                epochs[...,continuous] -= np.nanmean(epochs[:,in_baseline][...,continuous],
+                                                     axis=1, keepdims=True)
+    
+    return epochs, times, selected
@@ -0,0 +1,133 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+from __future__ import division
+from __future__ import absolute_import
+
+import warnings
+import numpy as np
+
+metric_names = ('accuracy', 'precision_rms', 'precision_sd', 'data_loss')
+
+column_names = ['Point', 'X', 'Y',
+                'AccuracyLeft', 'AccuracyRight',
+                'PrecisionRMSLeft', 'PrecisionRMSRight',
+                'PrecisionSDLeft', 'PrecisionSDRight',
+                'DataLossLeft', 'DataLossRight']
+
+
+def _direction(xy, screen_size, screen_width, distance):
+    """
+    Convert positions in Tobii's display area coordinates to unit vectors
+    from the eye (assumed to be in front of the center of the screen).
+    """
+
+    cm_per_pix = screen_width/screen_size[0]
+    x = (xy[...,0]-0.5)*screen_size[0]*cm_per_pix
+    y = (0.5-xy[...,1])*screen_size[1]*cm_per_pix
+    v = np.stack((x, y, np.full(x.shape, float(distance))), axis=-1)
+    return v/np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def _angle(u, v):
+    """
+    Angle (deg) between unit vectors.
+    """
+
+    return np.degrees(np.arccos(np.clip(np.sum(u*v, axis=-1), -1.0, 1.0)))
+
+
+def compute_validation_metrics(targets, samples, screen_size, screen_width, distance):
+    """
+    Calculate accuracy, precision and data loss of validation data.
+    Returned value is a dict object with following items.
+
+    - 'accuracy_L', 'accuracy_R': mean angular offset between target and
+      gaze position at each target (deg).
+    - 'precision_rms_L', 'precision_rms_R': root mean square of angular
+      distances between successive samples at each target (deg).
+    - 'precision_sd_L', 'precision_sd_R': root mean square of angular
+      distances between samples and their centroid at each target (deg).
+    - 'data_loss_L', 'data_loss_R': proportion of invalid samples at each
+      target.
+    - 'mean_accuracy_L', 'mean_accuracy_R', ... : average of above values
+      across targets.
+
+    Per-target values are numpy.ndarray of shape (n_targets,).
+    Angles are NaN if screen_width or distance is not available.
+
+    :param targets: Array-like of shape (n_targets, 2) that holds target
+        positions in Tobii's display area coordinates.
+    :param samples: numpy.ndarray of shape (n_targets, n_samples, 9) that
+        holds raw Tobii samples (t, lx, ly, lp, lv, rx, ry, rp, rv)
+        recorded at each target.
+    :param screen_size: Size of screen (width, height) in pixels.
+    :param float screen_width: Width of screen in cm.
+    :param float distance: Viewing distance in cm.
+    """
+
+    targets = np.asarray(targets, dtype=float).reshape(-1,2)
+    samples = np.asarray(samples, dtype=float)
+    has_geometry = screen_width is not None and distance is not None
+
+    result = {}
+    if has_geometry:
+        target_dir = _direction(targets, screen_size, screen_width, distance)[:,np.newaxis,:]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for eye, cols in (('L', (1,2,4)), ('R', (5,6,8))):
+            xy = samples[:,:,cols[0]:cols[1]+1]
+            valid = (samples[:,:,cols[2]] != 0) & ~np.isnan(xy).any(axis=-1)
+            n_valid = valid.sum(axis=1)
+            result['data_loss_'+eye] = 1.0-n_valid/samples.shape[1]
+
+            if has_geometry:
+                gaze_dir = _direction(xy, screen_size, screen_width, distance)
+                gaze_dir[~valid] = np.nan
+
+                offset = _angle(gaze_dir, target_dir)
+                result['accuracy_'+eye] = np.nanmean(offset, axis=1)
+
+                s2s = _angle(gaze_dir[:,1:], gaze_dir[:,:-1])
+                result['precision_rms_'+eye] = np.sqrt(np.nanmean(s2s**2, axis=1))
+
+                centroid = np.nanmean(gaze_dir, axis=1, keepdims=True)
+                centroid /= np.linalg.norm(centroid, axis=-1, keepdims=True)
+                dev = _angle(gaze_dir, centroid)
+                result['precision_sd_'+eye] = np.sqrt(np.nanmean(dev**2, axis=1))
+            else:
+                for name in metric_names[:3]:
+                    result[name+'_'+eye] = np.full(len(targets), np.nan)
+
+            for name in metric_names:
+                result['mean_'+name+'_'+eye] = float(np.nanmean(result[name+'_'+eye])) \
+                    if len(targets) > 0 else np.nan
+
+    return result
+
+
+def write_validation_metrics(fp, points, result):
+    """
+    Write result of :func:`~psychopy_tobii_controller.validation.compute_validation_metrics`
+    to a data file.  Usually, users don't have to call this function.
+
+    :param fp: File object.
+    :param points: Array-like of shape (n_targets, 2) that holds target
+        positions in PsychoPy's coordinates.
+    :param dict result: Dict object returned by compute_validation_metrics.
+    """
+
+    fp.write('Validation Start\n')
+    fp.write('\t'.join(column_names)+'\n')
+    for i, p in enumerate(points):
+        values = [result[name+'_'+eye][i] for name in metric_names for eye in 'LR']
+        fp.write('%d\t%.4f\t%.4f\t' % (i+1, p[0], p[1]) + '\t'.join(['%.4f' % v for v in values]) + '\n')
+    values = [result['mean_'+name+'_'+eye] for name in metric_names for eye in 'LR']
+    fp.write('Mean\t\t\t' + '\t'.join(['%.4f' % v for v in values]) + '\n')
+    fp.write('Validation End\n\n')
+    fp.flush()
@@ -26,6 +26,9 @@ from psychopy_tobii_controller import tobii_controller
 # 2) Collecting calibration samples by calling self.collect_calibration_data(p)
 #    during the participant is fixating a calibration point.  p is the position 
 #    of the calibration point in the coordinates (i.e. PsychoPy coordinates).
+#    self.collect_calibration_data_async(p) does the same task in background.
+#    Pass the returned value to self.wait_calibration_task() to keep
+#    drawing stimuli while calibration samples are collected.
 # 
 # In the following example, five-point calibration is performed.
 # Experimenter presses keypad 1-5 to select calibration point on which 
@@ -72,8 +75,12 @@ def custom_calibration(self):
                 # only if the current calibration point is included 
                 # in self.retry_points.
                 if current_point_index in self.retry_points:
-                    # Call collect_calibration_data() to do this task.
-                    self.collect_calibration_data(self.calibration_points[current_point_index])
+                    # Call collect_calibration_data_async() to do this task.
+                    # Calibration target is kept on the screen until
+                    # data collection finishes.
+                    self.wait_calibration_task(
+                        self.collect_calibration_data_async(self.calibration_points[current_point_index]),
+                        [dot, disc])
                     # Hide calibration target.
                     current_point_index = -1
             elif key == 'return':
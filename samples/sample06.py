@@ -31,11 +31,21 @@ if ret == 'abort':
     sys.exit()
 
 # run validation
+# Monitor profile must have screen width and viewing distance to calculate
+# accuracy and precision in degrees of visual angle.
 ret = controller.run_validation(
         [(-0.4,0.4), (0.4,0.4) , (0.0,0.0), (-0.4,-0.4), (0.4,-0.4)],
         target_shift = 0.08
     )
 
+# Result of validation is stored in controller.validation_result.
+# The result is also written to the data file when it is accepted.
+# Use psychopy_tobii_controller.utility.load_validation_results() to read it.
+if ret == 'accept':
+    print('Accuracy (deg): L={:.2f} R={:.2f}'.format(
+        controller.validation_result['mean_accuracy_L'],
+        controller.validation_result['mean_accuracy_R']))
+
 
 marker = psychopy.visual.Rect(win,size=(0.01,0.01))
 
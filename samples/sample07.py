@@ -0,0 +1,51 @@
+import psychopy.visual
+import psychopy.event
+import sys
+import numpy as np
+
+from psychopy_tobii_controller import tobii_multi_controller
+
+win = psychopy.visual.Window(units='height', monitor='default', fullscr=True)
+
+# Initialize tobii_multi_controller.
+# ids is a list of ID of Tobii units.  If omitted, all Tobii units are used.
+controller = tobii_multi_controller(win, ids=[0, 1])
+
+# Gaze data of all eyetrackers are written to one data file.
+# The last column of gaze data ('Device') is the index of the eyetracker.
+controller.open_datafile('test.tsv')
+
+# Each eyetracker has its own calibration.
+for device in range(len(controller)):
+    controller.show_status(device)
+    ret = controller.run_calibration(device,
+            [(-0.4,0.4), (0.4,0.4) , (0.0,0.0), (-0.4,-0.4), (0.4,-0.4)],
+        )
+    if ret == 'abort':
+        win.close()
+        sys.exit()
+
+markers = [psychopy.visual.Rect(win, size=(0.01,0.01), lineColor=c) for c in ('white', 'yellow')]
+
+# Start recording from all eyetrackers.
+controller.subscribe()
+
+waitkey = True
+while waitkey:
+    for device in range(len(controller)):
+        currentGazePosition = controller.get_current_gaze_position(device)
+        if not np.nan in currentGazePosition:
+            markers[device].setPos(currentGazePosition[0:2])
+            markers[device].draw()
+    keys = psychopy.event.getKeys()
+    if 'space' in keys:
+        waitkey=False
+    elif len(keys)>=1:
+        controller.record_event(keys[0])
+    
+    win.flip()
+
+controller.unsubscribe()
+controller.close_datafile()
+
+win.close()
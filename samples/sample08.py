@@ -0,0 +1,53 @@
+import psychopy.visual
+import psychopy.event
+import sys
+import numpy as np
+
+from psychopy_tobii_controller import tobii_controller
+
+participant = 'P01'
+calibration_file = 'calibration_{}.json'.format(participant)
+calibration_points = [(-0.4,0.4), (0.4,0.4) , (0.0,0.0), (-0.4,-0.4), (0.4,-0.4)]
+
+win = psychopy.visual.Window(units='height', monitor='default', fullscr=True)
+controller = tobii_controller(win)
+controller.open_datafile('test.tsv', embed_events=False)
+
+# If the experiment is restarted, calibration saved less than one hour ago
+# is reapplied instead of running calibration again.
+if not controller.load_calibration(calibration_file, participant=participant, max_age=3600):
+    controller.show_status()
+    ret = controller.run_calibration(calibration_points)
+    if ret == 'abort':
+        win.close()
+        sys.exit()
+    ret = controller.run_validation(calibration_points)
+    
+    # Result of the validation is saved with calibration data.
+    controller.save_calibration(calibration_file, participant=participant)
+
+marker = psychopy.visual.Rect(win,size=(0.01,0.01))
+
+controller.subscribe()
+
+waitkey = True
+while waitkey:
+    currentGazePosition = controller.get_current_gaze_position()
+    if not np.nan in currentGazePosition:
+        marker.setPos(currentGazePosition[0:2])
+        marker.setLineColor('white')
+    else:
+        marker.setLineColor('red')
+    keys = psychopy.event.getKeys()
+    if 'space' in keys:
+        waitkey=False
+    elif len(keys)>=1:
+        controller.record_event(keys[0])
+    
+    marker.draw()
+    win.flip()
+
+controller.unsubscribe()
+controller.close_datafile()
+
+win.close()
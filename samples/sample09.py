@@ -0,0 +1,51 @@
+import psychopy.visual
+import psychopy.event
+import sys
+
+from psychopy_tobii_controller import tobii_controller
+
+win = psychopy.visual.Window(units='height', monitor='default', fullscr=True)
+controller = tobii_controller(win)
+controller.open_datafile('test.tsv', embed_events=False)
+
+controller.show_status()
+ret = controller.run_calibration(
+        [(-0.4,0.4), (0.4,0.4) , (0.0,0.0), (-0.4,-0.4), (0.4,-0.4)],
+    )
+if ret == 'abort':
+    win.close()
+    sys.exit()
+
+left = psychopy.visual.TextStim(win, 'LEFT', pos=(-0.4,0.0), height=0.08)
+right = psychopy.visual.Circle(win, radius=0.1, pos=(0.4,0.0), lineColor='white')
+star = psychopy.visual.ShapeStim(win, vertices='star7', size=0.1, pos=(0.0,-0.3), lineColor='white')
+
+# Register areas of interest (AOIs).  Positions are in the units of the window.
+# AOIs are tested against every gaze sample and dwell time is accumulated
+# while recording.
+controller.add_aoi_stim('left', left)
+controller.add_aoi_circle('right', right.pos, 0.1)
+controller.add_aoi_polygon('star', star.vertices*star.size+star.pos)
+
+msg = psychopy.visual.TextStim(win, '', pos=(0.0,0.4), height=0.04)
+
+controller.subscribe()
+
+while 'space' not in psychopy.event.getKeys():
+    # Names of AOIs that contain the latest gaze position.
+    current = controller.get_current_aoi()
+    msg.setText(', '.join(current))
+    for name, stim in (('left', left), ('right', right), ('star', star)):
+        stim.setColor('red' if name in current else 'white')
+        stim.draw()
+    msg.draw()
+    win.flip()
+
+controller.unsubscribe()
+controller.close_datafile()
+
+# Dwell time (ms), number of samples and number of entries of each AOI.
+for name, (dwell, n_samples, n_entries) in controller.get_aoi_counters().items():
+    print('{}: {:.1f} ms, {} samples, {} entries'.format(name, dwell, n_samples, n_entries))
+
+win.close()
@@ -0,0 +1,40 @@
+import psychopy.visual
+import psychopy.event
+import sys
+
+from psychopy_tobii_controller import tobii_controller
+from psychopy_tobii_controller.heatmap import heatmap_accumulator
+
+win = psychopy.visual.Window(units='height', monitor='default', fullscr=True)
+controller = tobii_controller(win)
+controller.open_datafile('test.tsv', embed_events=False)
+
+controller.show_status()
+ret = controller.run_calibration(
+        [(-0.4,0.4), (0.4,0.4) , (0.0,0.0), (-0.4,-0.4), (0.4,-0.4)],
+    )
+if ret == 'abort':
+    win.close()
+    sys.exit()
+
+# Heatmap of the whole screen with 64x36 bins.
+accumulator = heatmap_accumulator((64, 36))
+preview = psychopy.visual.ImageStim(win, size=(win.size[0]/win.size[1], 1.0), opacity=0.5)
+msg = psychopy.visual.TextStim(win, 'Press space to stop', pos=(0.0,-0.45), height=0.03)
+
+controller.subscribe()
+
+while 'space' not in psychopy.event.getKeys():
+    # Only samples received since the last call are added.
+    accumulator.update(controller.gaze_data)
+    
+    # Values of ImageStim range from -1.0 to 1.0.
+    preview.setImage(accumulator.get_heatmap(sigma=1.5)*2-1)
+    preview.draw()
+    msg.draw()
+    win.flip()
+
+controller.unsubscribe()
+controller.close_datafile()
+
+win.close()
@@ -0,0 +1,113 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.aoi import aoi_set
+
+
+def make_aois():
+    aois = aoi_set()
+    aois.add_rect('A', 0, 0, 1, 1)
+    aois.add_circle('B', 3, 0.5, 0.5)
+    aois.add_polygon('C', [(0, 2), (1, 2), (0.5, 3)])
+    return aois
+
+
+def test_contains():
+    aois = make_aois()
+    assert aois.get_names(aois.contains(0.5, 0.5)) == ['A']
+    assert aois.get_names(aois.contains(3.0, 0.9)) == ['B']
+    assert aois.get_names(aois.contains(3.45, 0.95)) == []
+    assert aois.get_names(aois.contains(0.5, 2.5)) == ['C']
+    assert aois.get_names(aois.contains(0.1, 2.9)) == []
+    assert len(aois.contains(np.nan, 0.5)) == 0
+
+
+def test_contains_points_matches_contains():
+    aois = make_aois()
+    aois.add_rect('D', 0.5, 0.5, 3, 2.5)
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-1, 4, 2000)
+    y = rng.uniform(-1, 4, 2000)
+    x[::100] = np.nan
+    points, indices = aois.contains_points(x, y)
+    expected = [(p, a) for p in range(len(x)) for a in aois.contains(x[p], y[p])]
+    assert list(zip(points.tolist(), indices.tolist())) == expected
+
+
+def test_add_and_remove():
+    aois = make_aois()
+    with pytest.raises(ValueError):
+        aois.add_rect('A', 0, 0, 1, 1)
+    aois.remove('B')
+    assert aois.names == ['A', 'C']
+    assert aois.get_names(aois.contains(3.0, 0.5)) == []
+    assert aois.get_names(aois.contains(0.5, 2.5)) == ['C']
+    aois.clear()
+    assert len(aois) == 0
+    assert len(aois.contains(0.5, 0.5)) == 0
+
+
+def test_update_counters():
+    aois = make_aois()
+    aois.update(0, 0.5, 0.5)
+    aois.update(10, 0.5, 0.5)
+    assert aois.get_current_dwell('A') == 10.0
+    aois.update(20, 3.0, 0.5)
+    aois.update(30, 0.5, 0.5)
+    aois.update(40, 5.0, 5.0)
+    counters = aois.get_counters()
+    assert counters['A'] == (30.0, 3, 2)
+    assert counters['B'] == (10.0, 1, 1)
+    assert counters['C'] == (0.0, 0, 0)
+    assert aois.get_current_dwell('A') == 0.0
+
+
+def test_remove_keeps_state_of_other_aois():
+    aois = aoi_set()
+    aois.add_rect('A', 0, 0, 1, 1)
+    aois.add_rect('B', 2, 0, 3, 1)
+    aois.update(0, 0.5, 0.5)
+    aois.update(10, 0.5, 0.5)
+    aois.remove('B')
+    aois.update(20, 5.0, 5.0)
+    aois.update(30, 5.0, 5.0)
+    assert aois.get_current_dwell('A') == 0.0
+    assert aois.get_counters()['A'] == (20.0, 2, 1)
+    aois.update(40, 0.5, 0.5)
+    assert aois.get_counters()['A'] == (20.0, 3, 2)
+
+
+def test_remove_preceding_aoi():
+    aois = aoi_set()
+    aois.add_rect('A', 0, 0, 1, 1)
+    aois.add_rect('B', 2, 0, 3, 1)
+    aois.update(0, 2.5, 0.5)
+    aois.remove('A')
+    aois.update(10, 2.5, 0.5)
+    assert aois.get_counters()['B'] == (10.0, 2, 1)
+    assert aois.get_current_dwell('B') == 10.0
+
+
+def test_update_batch_matches_update():
+    rng = np.random.default_rng(1)
+    t = np.cumsum(rng.uniform(1, 2, 500))
+    x = rng.uniform(-0.5, 4, 500)
+    y = rng.uniform(-0.5, 3.5, 500)
+    x[::50] = np.nan
+    expected = make_aois()
+    for ti, xi, yi in zip(t, x, y):
+        hits = expected.update(ti, xi, yi)
+    aois = make_aois()
+    for start, stop in ((0, 1), (1, 180), (180, 181), (181, 500)):
+        batch_hits = aois.update_batch(t[start:stop], x[start:stop], y[start:stop])
+    assert list(batch_hits) == list(hits)
+    for name, value in expected.get_counters().items():
+        assert aois.get_counters()[name] == pytest.approx(value)
+        assert aois.get_current_dwell(name) == pytest.approx(expected.get_current_dwell(name))
@@ -0,0 +1,66 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.aoi import aoi_set
+from psychopy_tobii_controller.utility import compute_aoi_metrics
+from psychopy_tobii_controller.session import gaze_session
+
+
+def make_aois():
+    aois = aoi_set()
+    aois.add_rect('A', 0, 0, 1, 1)
+    aois.add_rect('B', 2, 0, 3, 1)
+    # overlaps with B
+    aois.add_circle('C', 3, 0.5, 0.5)
+    aois.add_rect('D', 5, 5, 6, 6)
+    return aois
+
+
+def test_fixations():
+    # onset, duration, x, y
+    fixations = np.array([[100.0, 200.0, 0.5, 0.5],
+                          [350.0, 100.0, 0.6, 0.5],
+                          [500.0, 300.0, 2.9, 0.5],
+                          [850.0, 50.0, 9.0, 9.0],
+                          [950.0, 150.0, 0.5, 0.5]])
+    metrics = compute_aoi_metrics(fixations, make_aois(), start_time=0.0)
+    assert metrics['names'] == ['A', 'B', 'C', 'D']
+    np.testing.assert_allclose(metrics['dwell_time'], [450.0, 300.0, 300.0, 0.0])
+    np.testing.assert_array_equal(metrics['fixation_count'], [3, 1, 1, 0])
+    np.testing.assert_allclose(metrics['first_fixation_latency'], [100.0, 500.0, 500.0, np.nan])
+    np.testing.assert_allclose(metrics['first_fixation_duration'], [200.0, 300.0, 300.0, np.nan])
+    # A->A (refixation), A->B and A->C.  The fixation outside of AOIs
+    # breaks the sequence.
+    transitions = sorted(zip(*[v.tolist() for v in metrics['transitions']]))
+    assert transitions == [(0, 0, 1), (0, 1, 1), (0, 2, 1)]
+
+
+def test_samples():
+    data = np.zeros((6, 11))
+    data[:,TimeStamp] = np.arange(6)*10.0
+    data[:,GazePointXLeft] = [0.5, 0.5, 2.2, 2.2, np.nan, 0.5]
+    data[:,GazePointYLeft] = 0.5
+    data[:,ValidityLeft] = [1, 1, 1, 1, 0, 1]
+    metrics = compute_aoi_metrics(data, make_aois(), data_type='sample', eye='L')
+    # the last sample lasts for the median interval
+    np.testing.assert_allclose(metrics['dwell_time'], [30.0, 20.0, 0.0, 0.0])
+    np.testing.assert_allclose(metrics['first_fixation_latency'][:2], [0.0, 20.0])
+    session_metrics = compute_aoi_metrics(gaze_session(data), make_aois(), data_type='sample', eye='L')
+    np.testing.assert_allclose(session_metrics['dwell_time'], metrics['dwell_time'])
+
+
+def test_no_fixations():
+    metrics = compute_aoi_metrics(np.zeros((0, 4)), make_aois())
+    np.testing.assert_array_equal(metrics['fixation_count'], [0, 0, 0, 0])
+    assert np.isnan(metrics['first_fixation_latency']).all()
+    assert len(metrics['transitions'][2]) == 0
+    with pytest.raises(ValueError):
+        compute_aoi_metrics(np.zeros((0, 4)), make_aois(), data_type='saccade')
@@ -0,0 +1,87 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.buffer import gaze_buffer
+
+
+def make_records(n, start=0):
+    records = np.zeros((n, 9))
+    records[:,0] = (np.arange(n)+start)*1000.0
+    records[:,1] = records[:,5] = np.arange(n)+start
+    records[:,2] = records[:,6] = 0.5
+    records[:,4] = records[:,8] = 1
+    records[::3,4] = 0
+    records[::3,1:3] = np.nan
+    return records
+
+
+def test_append_and_extend_are_equivalent():
+    records = make_records(100)
+    a = gaze_buffer(capacity=8)
+    for record in records:
+        a.append(tuple(record))
+    b = gaze_buffer(capacity=8)
+    b.extend(records[:37])
+    b.extend(records[37:])
+    np.testing.assert_array_equal(a.array(), records)
+    np.testing.assert_array_equal(b.array(), records)
+    np.testing.assert_allclose(a._sums[:101], b._sums[:101])
+
+
+def test_growth_keeps_samples_and_sums():
+    buffer = gaze_buffer(capacity=1)
+    buffer.extend(make_records(3))
+    old_data = buffer.array()
+    buffer.extend(make_records(1000, 3))
+    assert len(buffer) == 1003
+    # views taken before growth are not changed
+    np.testing.assert_array_equal(old_data, make_records(3))
+    np.testing.assert_array_equal(buffer[:3], old_data)
+    assert buffer[-1][0] == 1002000.0
+    sums, n = buffer.get_window_sums(0)
+    assert n == 1003
+    valid = np.arange(1003) % 3 != 0
+    assert sums[2] == valid.sum()
+    assert sums[0] == pytest.approx(np.arange(1003)[valid].sum())
+    assert sums[5] == 1003
+
+
+def test_window_sums():
+    buffer = gaze_buffer()
+    buffer.extend(make_records(100))
+    sums, n = buffer.get_window_sums(10000.0, 19000.0)
+    assert n == 10
+    x = np.arange(10, 20)
+    valid = x % 3 != 0
+    assert sums[0] == pytest.approx(x[valid].sum())
+    assert sums[2] == valid.sum()
+    assert sums[6] == pytest.approx((x[valid]**2).sum())
+    assert sums[3] == pytest.approx(x.sum())
+    # open end and empty windows
+    assert buffer.get_window_sums(95000.0)[1] == 5
+    sums, n = buffer.get_window_sums(200000.0)
+    assert n == 0 and not sums.any()
+    assert buffer.get_window_sums(50000.0, 40000.0)[1] == 0
+
+
+def test_get_since():
+    buffer = gaze_buffer(capacity=4)
+    samples, cursor = buffer.get_since(0)
+    assert len(samples) == 0 and cursor == 0
+    buffer.extend(make_records(3))
+    samples, cursor = buffer.get_since(cursor)
+    assert len(samples) == 3 and cursor == 3
+    buffer.extend(make_records(10, 3))
+    samples, cursor = buffer.get_since(cursor)
+    assert cursor == 13
+    np.testing.assert_array_equal(samples[:,0], np.arange(3, 13)*1000.0)
+    samples, cursor = buffer.get_since(cursor)
+    assert len(samples) == 0 and cursor == 13
+
@@ -0,0 +1,96 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import io
+import types
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.clock import clock_sync, map_timestamps
+
+
+class fake_clocks:
+    # system clock in us; psychopy clock in s with an offset;
+    # device clock runs faster than the system clock.
+    def __init__(self, device_slope=1.0001):
+        self.system = 1e9
+        self.device_slope = device_slope
+
+    def get_system_time(self):
+        self.system += 10.0
+        return self.system
+
+    def get_psychopy_time(self):
+        return (self.system-1e9)/1e6+100.0
+
+    def sync_data(self):
+        request = self.get_system_time()
+        response = self.get_system_time()
+        device = 5e8+self.device_slope*((request+response)/2.0-1e9)
+        return types.SimpleNamespace(system_request_time_stamp=request,
+                                     system_response_time_stamp=response,
+                                     device_time_stamp=device)
+
+
+def test_fit():
+    clocks = fake_clocks()
+    sync = clock_sync(clocks.get_system_time, clocks.get_psychopy_time)
+    fit = sync.get_fit()
+    # only one reference: nominal slope
+    assert 'device' not in fit
+    assert fit['psychopy'][0] == 1e-6
+
+    for i in range(50):
+        clocks.system += 1e6
+        sync.on_time_synchronization_data(clocks.sync_data())
+    fit = sync.get_fit()
+    assert fit['device'][0] == pytest.approx(1.0001)
+    assert fit['psychopy'][0] == pytest.approx(1e-6)
+    assert sync.get_fit() is fit
+
+    t = 1e9+3e7
+    assert sync.map_timestamps(t, 'system', 'device') == pytest.approx(5e8+1.0001*3e7)
+    assert sync.map_timestamps(t, 'system', 'psychopy') == pytest.approx(130.0)
+    assert sync.map_timestamps(t, 'system', 'session', session_start=1e9) == pytest.approx(3e4)
+    # round trip
+    device = sync.map_timestamps(t, 'system', 'device')
+    assert sync.map_timestamps(device, 'device', 'psychopy') == pytest.approx(130.0)
+
+
+def test_ring_buffer_follows_drift():
+    clocks = fake_clocks(1.0)
+    sync = clock_sync(clocks.get_system_time, clocks.get_psychopy_time, size=16)
+    for i in range(20):
+        clocks.system += 1e6
+        sync.on_time_synchronization_data(clocks.sync_data())
+    assert sync.get_fit()['device'][0] == pytest.approx(1.0)
+    # old rows are overwritten, so the fit reflects only the new slope
+    clocks.device_slope = 1.001
+    for i in range(20):
+        clocks.system += 1e6
+        sync.on_time_synchronization_data(clocks.sync_data())
+    assert sync.get_fit()['device'][0] == pytest.approx(1.001)
+
+
+def test_write_fit():
+    clocks = fake_clocks()
+    sync = clock_sync(clocks.get_system_time, clocks.get_psychopy_time)
+    fp = io.StringIO()
+    sync.write_fit(fp, 1e9)
+    lines = fp.getvalue().splitlines()
+    assert [line.split('\t')[1] for line in lines] == ['psychopy', 'session']
+    assert tuple(float(v) for v in lines[1].split('\t')[2:]) == (1e-3, 1e9, 0.0)
+
+
+def test_map_timestamps_errors():
+    fit = {'psychopy': (1e-6, 0.0, 0.0)}
+    np.testing.assert_allclose(map_timestamps([1e6, 2e6], 'system', 'psychopy', fit), [1.0, 2.0])
+    with pytest.raises(ValueError):
+        map_timestamps(0.0, 'system', 'unknown', fit)
+    with pytest.raises(RuntimeError):
+        map_timestamps(0.0, 'system', 'device', fit)
@@ -0,0 +1,119 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import bz2
+import gzip
+import lzma
+import mmap
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller import compression
+from psychopy_tobii_controller.compression import open_text, detect_compression, end_member
+
+modules = {'gzip': gzip, 'bz2': bz2, 'lzma': lzma}
+extensions = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+
+
+def make_text(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    return ''.join('%.1f\t%.4f\t%.4f\t1\n' % tuple(row) for row in rng.random((n, 3)))
+
+
+def write_sessions(filename, text, n_sessions=3, **kwargs):
+    fp = open_text(filename, 'w', **kwargs)
+    for i in range(n_sessions):
+        fp.write('Session Start\n')
+        fp.write(text)
+        fp.write('Session End\n')
+        end_member(fp)
+    fp.close()
+    return ('Session Start\n' + text + 'Session End\n')*n_sessions
+
+
+@pytest.mark.parametrize('name', sorted(modules))
+def test_members_are_readable(tmp_path, name):
+    filename = str(tmp_path/('data.tsv'+extensions[name]))
+    expected = write_sessions(filename, make_text(), member_size=64*1024, buffer_size=16*1024)
+    assert detect_compression(filename) == name
+    # concatenated members are a valid file for the standard modules
+    with modules[name].open(filename, 'rt') as fp:
+        assert fp.read() == expected
+    for workers in (1, 3):
+        with open_text(filename, workers=workers) as fp:
+            assert fp.read() == expected
+
+
+@pytest.mark.parametrize('name', sorted(modules))
+def test_false_boundaries_are_skipped(tmp_path, name):
+    filename = str(tmp_path/('data.tsv'+extensions[name]))
+    expected = write_sessions(filename, make_text(5000), member_size=32*1024, buffer_size=8*1024)
+    with open(filename, 'rb') as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        starts = compression._find_members(data, name)
+        assert len(starts) > 3
+        # offsets inside members are not boundaries
+        starts = sorted(starts + [s+7 for s in starts[:-1]])
+        decompressed = b''.join(compression._iter_members(data, starts, name, 2))
+        data.close()
+    assert decompressed.decode() == expected
+
+
+@pytest.mark.parametrize('name', sorted(modules))
+def test_flush_does_not_end_member(tmp_path, name):
+    filename = str(tmp_path/('data.tsv'+extensions[name]))
+    text = make_text(2000)
+    fp = open_text(filename, 'w')
+    for line in text.splitlines(True):
+        fp.write(line)
+        fp.flush()
+    end_member(fp)
+    fp.write('Appended\n')
+    fp.close()
+    with open(filename, 'rb') as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        starts = compression._find_members(data, name)
+        members = list(compression._iter_members(data, starts, name, 2))
+        data.close()
+    assert len(members) == 2
+    assert b''.join(members).decode() == text + 'Appended\n'
+
+
+def test_single_member_file(tmp_path):
+    filename = str(tmp_path/'old.tsv.gz')
+    text = make_text(5000)
+    with gzip.open(filename, 'wt') as fp:
+        fp.write(text)
+    with open_text(filename, workers=4) as fp:
+        assert fp.read() == text
+
+
+def test_append(tmp_path):
+    filename = str(tmp_path/'data.tsv.bz2')
+    expected = write_sessions(filename, make_text(1000), n_sessions=1)
+    fp = open_text(filename, 'a')
+    fp.write('Appended\n')
+    fp.close()
+    with open_text(filename, workers=2) as fp:
+        assert fp.read() == expected + 'Appended\n'
+
+
+def test_close_before_end(tmp_path):
+    filename = str(tmp_path/'data.tsv.gz')
+    write_sessions(filename, make_text(), member_size=64*1024)
+    fp = open_text(filename, workers=2)
+    assert fp.readline() == 'Session Start\n'
+    fp.close()
+
+
+def test_uncompressed(tmp_path):
+    filename = str(tmp_path/'data.tsv')
+    expected = write_sessions(filename, make_text(100))
+    assert detect_compression(filename) is None
+    with open_text(filename) as fp:
+        assert fp.read() == expected
@@ -0,0 +1,27 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import os
+
+from psychopy_tobii_controller.discovery import load_eyetracker_cache, save_eyetracker_cache
+
+
+def test_save_and_load(tmp_path):
+    cache_file = str(tmp_path/'cache'/'eyetrackers.json')
+    assert load_eyetracker_cache(cache_file) == []
+    save_eyetracker_cache(['tet-tcp://1', 'tet-tcp://2'], cache_file)
+    assert load_eyetracker_cache(cache_file) == ['tet-tcp://1', 'tet-tcp://2']
+    save_eyetracker_cache(['tet-tcp://3'], cache_file)
+    assert load_eyetracker_cache(cache_file) == ['tet-tcp://3']
+    # no temporary file is left
+    assert os.listdir(os.path.dirname(cache_file)) == ['eyetrackers.json']
+
+
+def test_broken_cache(tmp_path):
+    cache_file = tmp_path/'eyetrackers.json'
+    cache_file.write_text('{"addresses": ["tet-tcp')
+    assert load_eyetracker_cache(str(cache_file)) == []
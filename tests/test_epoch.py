@@ -0,0 +1,72 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.utility import epoch
+
+
+def make_data(n=1000, interval=2.0):
+    data = np.zeros((n, 11))
+    data[:,TimeStamp] = np.arange(n)*interval
+    data[:,GazePointX] = data[:,TimeStamp]*2
+    data[:,GazePointY] = 1.0
+    data[:,PupilLeft] = 3.0
+    data[:,ValidityLeft] = 1
+    data[::2,ValidityRight] = 1
+    return data
+
+
+def test_native_rate():
+    data = make_data()
+    events = [[100.0, 'stim'], [500.0, 'resp'], [900.0, 'stim']]
+    epochs, times, selected = epoch(data, events, 'stim', -20, 40)
+    assert epochs.shape == (2, 30, 11)
+    assert selected == [events[0], events[2]]
+    np.testing.assert_allclose(times, np.arange(-20, 40, 2.0))
+    np.testing.assert_allclose(epochs[1,:,TimeStamp], 900+times)
+
+
+def test_epoch_before_and_after_data():
+    data = make_data(100)
+    epochs, times, selected = epoch(data, [[10.0, 'a'], [190.0, 'b']], None, -20, 20)
+    # only time points outside of the data are NaN
+    assert np.isnan(epochs[0,:5,TimeStamp]).all()
+    np.testing.assert_allclose(epochs[0,5:,TimeStamp], 10+times[5:])
+    np.testing.assert_allclose(epochs[1,:15,TimeStamp], 190+times[:15])
+    assert np.isnan(epochs[1,15:,TimeStamp]).all()
+
+
+def test_resampling():
+    data = make_data()
+    epochs, times, selected = epoch(data, [[101.0, 'stim']], None, -10, 10, rate=1000,
+                                    columns=[TimeStamp, GazePointX, ValidityRight])
+    np.testing.assert_allclose(times, np.arange(-10, 10, 1.0))
+    np.testing.assert_allclose(epochs[0,:,0], 101+times)
+    np.testing.assert_allclose(epochs[0,:,1], 2*(101+times))
+    # validity is not interpolated
+    assert set(np.unique(epochs[0,:,2])) <= {0.0, 1.0}
+
+
+def test_baseline():
+    data = make_data()
+    epochs, times, selected = epoch(data, [[100.0, 'stim']], None, -20, 20, baseline=(-20, 0))
+    baseline = epochs[0,times <= 0,GazePointX].mean()
+    assert baseline == pytest.approx(0.0)
+    np.testing.assert_allclose(epochs[0,:,GazePointX], 2*times - 2*times[times <= 0].mean())
+    assert (epochs[0,:,PupilLeft] == 0).all()
+    # timestamps and validity are not corrected
+    np.testing.assert_allclose(epochs[0,:,TimeStamp], 100+times)
+    assert (epochs[0,:,ValidityLeft] == 1).all()
+
+
+def test_baseline_out_of_range():
+    data = make_data()
+    with pytest.raises(ValueError):
+        epoch(data, [[100.0, 'stim']], None, -20, 20, baseline=(50, 100))
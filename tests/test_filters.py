@@ -0,0 +1,80 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.filters import exponential_filter, make_filter
+
+
+def run(f, t, values):
+    return np.array([f.update(ti, v).copy() for ti, v in zip(t, values)])
+
+
+def test_exponential():
+    f = exponential_filter(alpha=0.5, n_channels=1)
+    output = run(f, [0.0, 0.01, 0.02], [[0.0], [1.0], [1.0]])
+    np.testing.assert_allclose(output[:,0], [0.0, 0.5, 0.75])
+    assert f.latency == pytest.approx(10.0)
+    with pytest.raises(ValueError):
+        exponential_filter(alpha=0.0)
+
+
+@pytest.mark.parametrize('name', ['exponential', 'one_euro', 'kalman'])
+def test_restart_after_data_loss(name):
+    f = make_filter(name, n_channels=2)
+    t = np.arange(10)*0.01
+    values = np.column_stack((np.full(10, 0.2), np.full(10, 0.8)))
+    values[5,0] = np.nan
+    values[6:,0] = 0.6
+    output = run(f, t, values)
+    np.testing.assert_allclose(output[:5], values[:5])
+    assert np.isnan(output[5,0]) and not np.isnan(output[5,1])
+    # no smoothing across the gap
+    assert output[6,0] == 0.6
+    assert f.gain[0] < 1.0
+    f.reset()
+    assert np.isnan(f.output).all() and np.isnan(f.latency)
+
+
+@pytest.mark.parametrize('name', ['exponential', 'one_euro', 'kalman'])
+def test_update_batch_matches_update(name):
+    rng = np.random.default_rng(2)
+    t = np.cumsum(rng.uniform(0.005, 0.01, 300))
+    t[150] = t[149]
+    values = rng.random((300, 4))
+    values[rng.random((300, 4)) < 0.1] = np.nan
+    values[-1,3] = np.nan
+    expected = make_filter(name)
+    run(expected, t, values)
+    f = make_filter(name)
+    for start, stop in ((0, 1), (1, 120), (120, 300)):
+        f.update_batch(t[start:stop], values[start:stop])
+    np.testing.assert_allclose(f.output, expected.output)
+    np.testing.assert_allclose(f.gain, expected.gain)
+    assert f.latency == pytest.approx(expected.latency)
+
+
+@pytest.mark.parametrize('name', ['one_euro', 'kalman'])
+def test_noise_is_reduced(name):
+    rng = np.random.default_rng(0)
+    t = np.arange(600)/600.0
+    values = 0.5+rng.normal(0, 0.01, (600, 4))
+    output = run(make_filter(name), t, values)
+    assert output[100:].std(axis=0).max() < values[100:].std(axis=0).min()/2
+
+
+def test_kalman_follows_smooth_motion():
+    t = np.arange(600)/600.0
+    values = np.repeat((0.1+0.5*t)[:,np.newaxis], 4, axis=1)
+    output = run(make_filter('kalman'), t, values)
+    np.testing.assert_allclose(output[-1], values[-1], atol=1e-3)
+
+
+def test_make_filter_unknown():
+    with pytest.raises(ValueError):
+        make_filter('median')
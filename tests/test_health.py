@@ -0,0 +1,71 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.health import sampling_monitor
+
+
+def make_samples(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    intervals = rng.choice([833, 1666, 3332, -50, 200000], n,
+                           p=[0.93, 0.03, 0.03, 0.005, 0.005])
+    samples = np.zeros((n, 9))
+    samples[:,0] = 1e9 + np.cumsum(intervals)
+    samples[:,4] = rng.random(n) > 0.2
+    samples[:,8] = rng.random(n) > 0.2
+    samples[1000:1100,4] = 0
+    samples[1000:1120,8] = 0
+    return samples
+
+
+def test_regular_sampling():
+    monitor = sampling_monitor(1200)
+    for i in range(1200):
+        monitor.add(1e9+i*1e6/1200, 1, 1)
+    status = monitor.status
+    assert status.samples == 1200
+    assert status.late == 0 and status.dropped == 0 and status.discontinuities == 0
+    assert status.mean_rate == pytest.approx(1200)
+    assert status.rate == pytest.approx(1200, rel=1e-2)
+    assert status.valid_ratio == 1.0
+
+
+def test_dropped_and_loss_streak():
+    monitor = sampling_monitor(1000)
+    t = 0
+    for i in range(100):
+        t += 4000 if i == 50 else 1000
+        monitor.add(t, i < 60 or i >= 70, 0)
+    status = monitor.status
+    assert status.late == 1
+    assert status.dropped == 3
+    assert status.longest_loss_streak == pytest.approx(10.0)
+    assert status.loss_streak == 0.0
+
+
+@pytest.mark.parametrize('nominal_rate', [1200, None])
+def test_update_batch_matches_update(nominal_rate):
+    samples = make_samples()
+    monitor = sampling_monitor(nominal_rate)
+    for record in samples:
+        monitor.update(record)
+    batch_monitor = sampling_monitor(nominal_rate)
+    for block in np.array_split(samples, [1, 7, 300, 301, 1050, 2000]):
+        batch_monitor.update_batch(block)
+    for a, b in zip(monitor.status, batch_monitor.status):
+        assert a == pytest.approx(b)
+
+
+def test_threshold_callback_is_edge_triggered():
+    calls = []
+    monitor = sampling_monitor(1000)
+    monitor.set_threshold('loss_streak', 5.0, lambda name, status: calls.append(name))
+    for i in range(30):
+        monitor.add(i*1000, i % 15 < 5, 0)
+    assert calls == ['loss_streak', 'loss_streak']
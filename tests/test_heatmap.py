@@ -0,0 +1,64 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.heatmap import bin_points, compute_heatmap, heatmap_accumulator
+
+
+def test_bin_points_edges():
+    counts = bin_points([0.0, 1.0, 0.5, 1.5, np.nan], [0.0, 1.0, 0.5, 0.5, 0.5], (0, 1, 0, 1), (2, 2))
+    np.testing.assert_array_equal(counts, [[1, 0], [0, 2]])
+
+
+def test_compute_heatmap_eye_and_validity():
+    data = np.zeros((4, 11))
+    data[:,GazePointXLeft] = data[:,GazePointYLeft] = 0.25
+    data[:,GazePointXRight] = data[:,GazePointYRight] = 0.75
+    data[:,GazePointX] = data[:,GazePointY] = 0.5
+    data[:,ValidityLeft] = [1, 1, 0, 1]
+    data[:,ValidityRight] = 1
+    heatmap = compute_heatmap(data, (0, 1, 0, 1), (2, 2), eye='L', normalize=False)
+    np.testing.assert_array_equal(heatmap, [[3, 0], [0, 0]])
+    heatmap = compute_heatmap(data, (0, 1, 0, 1), (4, 4), eye='LR', normalize=False)
+    assert heatmap[2,2] == 4
+    heatmap = compute_heatmap(data, (0, 1, 0, 1), (2, 2), eye='R', sigma=0.5)
+    assert heatmap.sum() == pytest.approx(1.0)
+    assert heatmap[1,1] == heatmap.max()
+    with pytest.raises(ValueError):
+        compute_heatmap(data, (0, 1, 0, 1), (2, 2), eye='X')
+
+
+def test_accumulator_counts_binned_samples():
+    samples = np.zeros((5, 9))
+    samples[:,1:3] = 0.25
+    samples[:,5:7] = 0.75
+    samples[:,4] = samples[:,8] = 1
+    samples[1,4] = 0
+    samples[2,4] = samples[2,8] = 0
+    samples[3,5] = 1.5
+    samples[3,1] = 1.2
+
+    accumulator = heatmap_accumulator((2, 2), eye='L')
+    accumulator.add_samples(samples)
+    # invalid and off-grid samples are not counted
+    assert accumulator.n_samples == 2
+    # display area y is flipped: top-left is the last row
+    np.testing.assert_array_equal(accumulator.get_heatmap(scale=None), [[0, 0], [2, 0]])
+
+    accumulator = heatmap_accumulator((2, 2), eye='LR')
+    accumulator.add_samples(samples)
+    assert accumulator.n_samples == 3
+    np.testing.assert_array_equal(accumulator.get_heatmap(scale=None), [[0, 1], [0, 2]])
+    np.testing.assert_allclose(accumulator.get_heatmap(), [[0, 0.5], [0, 1]])
+    np.testing.assert_allclose(accumulator.get_heatmap(scale='sum'), [[0, 1/3], [0, 2/3]])
+    with pytest.raises(ValueError):
+        accumulator.get_heatmap(scale='max')
+    accumulator.reset()
+    assert accumulator.n_samples == 0
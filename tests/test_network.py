@@ -0,0 +1,80 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import socket
+import types
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.buffer import gaze_buffer
+from psychopy_tobii_controller.network import (pack_samples, unpack_samples,
+    gaze_publisher, gaze_subscriber)
+
+
+def make_samples(n, start=0):
+    samples = np.zeros((n, 9))
+    samples[:,0] = 1000000 + (start+np.arange(n))*833
+    samples[:,1:4] = np.random.default_rng(start).random((n, 3))
+    samples[:,4] = 1
+    samples[::3,6] = np.nan
+    return samples
+
+
+def make_controller(samples):
+    buffer = gaze_buffer()
+    buffer.extend(samples)
+    tobii_research = types.SimpleNamespace(get_system_time_stamp=lambda: 123)
+    return types.SimpleNamespace(gaze_data=buffer, tobii_research=tobii_research)
+
+
+@pytest.fixture
+def subscriber():
+    subscriber = gaze_subscriber(('127.0.0.1', 0))
+    yield subscriber
+    subscriber.stop()
+
+
+def test_pack_and_unpack():
+    samples = make_samples(20)
+    sequence, send_time, received = unpack_samples(pack_samples(samples, 2**32+5, 42))
+    assert sequence == 5
+    assert send_time == 42
+    np.testing.assert_allclose(received, samples, rtol=1e-6, equal_nan=True)
+    with pytest.raises(ValueError):
+        unpack_samples(b'PTGZ')
+
+
+def test_round_trip(subscriber):
+    samples = make_samples(100)
+    controller = make_controller(samples)
+    publisher = gaze_publisher(controller, subscriber._socket.getsockname(), max_samples=30)
+    publisher.send_new_samples()
+    controller.gaze_data.extend(make_samples(10, 100))
+    publisher.send_new_samples()
+    publisher.stop()
+    while subscriber.receive(1.0) is not None and len(subscriber.gaze_data) < 110:
+        pass
+    assert subscriber.received == 5
+    assert subscriber.lost == 0
+    assert subscriber.last_send_time == 123
+    np.testing.assert_allclose(subscriber.gaze_data.array(), controller.gaze_data.array(),
+                               rtol=1e-6, equal_nan=True)
+
+
+def test_lost_and_reordered(subscriber):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = subscriber._socket.getsockname()
+    for sequence, start in ((0, 0), (3, 30), (1, 10), (3, 30), (4, 40)):
+        sender.sendto(pack_samples(make_samples(10, start), sequence, 0), address)
+        assert subscriber.receive(1.0) is not None
+    sender.close()
+    assert subscriber.lost == 2
+    assert subscriber.reordered == 2
+    t = subscriber.gaze_data.array()[:,0]
+    assert len(t) == 30
+    assert np.all(np.diff(t) > 0)
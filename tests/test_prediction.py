@@ -0,0 +1,69 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.prediction import gaze_predictor
+
+
+def make_samples(n=20, interval=2000.0, speed=0.0):
+    samples = np.zeros((n, 9))
+    samples[:,0] = np.arange(n)*interval
+    samples[:,1] = samples[:,5] = 0.5+speed*samples[:,0]/1e6
+    samples[:,2] = samples[:,6] = 0.5
+    samples[:,4] = samples[:,8] = 1
+    return samples
+
+
+def test_fixation():
+    samples = make_samples()
+    predictor = gaze_predictor()
+    assert predictor.predict(samples, samples[-1,0]+10000) == pytest.approx((0.5, 0.5, 0.5, 0.5))
+    assert predictor.saccade == (False, False)
+    assert predictor.horizon == pytest.approx(10.0)
+
+
+def test_invalid_samples_in_window():
+    samples = make_samples(speed=5.0)
+    samples[-3,1:3] = np.nan
+    samples[-3,4] = 0
+    predictor = gaze_predictor(decay=1e6)
+    lx, ly, rx, ry = predictor.predict(samples, samples[-1,0]+4000)
+    # velocity is fitted on valid samples only
+    assert predictor.saccade == (True, True)
+    assert lx == pytest.approx(rx)
+    assert lx == pytest.approx(0.5+5.0*(samples[-1,0]+4000)/1e6, rel=1e-3)
+
+
+def test_fallback_to_last_valid_sample():
+    samples = make_samples()
+    samples[-8,1] = 0.3
+    samples[-7:,4] = 0
+    samples[-7:,1:3] = np.nan
+    predictor = gaze_predictor()
+    lx, ly, rx, ry = predictor.predict(samples, samples[-1,0]+10000)
+    assert (lx, ly) == (0.3, 0.5)
+    assert (rx, ry) == pytest.approx((0.5, 0.5))
+
+    samples[:,4] = 0
+    assert np.isnan(predictor.predict(samples, samples[-1,0])[:2]).all()
+    assert np.isnan(predictor.predict(samples[:0], 0)).all()
+
+
+def test_evaluate():
+    samples = make_samples(200, speed=2.0)
+    predictor = gaze_predictor(decay=1e6)
+    result = predictor.evaluate(samples, 10.0)
+    assert result['n'] > 0
+    # linear motion is predicted exactly while the latest sample lags
+    assert result['mean'] == pytest.approx(0.0, abs=1e-9)
+    assert result['baseline_mean'] == pytest.approx(2.0*0.01)
+    assert result['saccade_ratio'] == 1.0
+
+    result = predictor.evaluate(samples[:3], 10.0)
+    assert result['n'] == 0 and np.isnan(result['mean'])
@@ -0,0 +1,71 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.utility import detect_blinks, preprocess_pupil
+
+
+def make_data(n=1000, interval=2.0):
+    data = np.zeros((n, 11))
+    data[:,TimeStamp] = np.arange(n)*interval
+    # small noise so that the median absolute deviation is not zero
+    noise = np.random.default_rng(0).normal(0, 1e-4, (2, n))
+    data[:,PupilLeft] = 3.0+0.001*np.arange(n)+noise[0]
+    data[:,PupilRight] = 4.0+0.001*np.arange(n)+noise[1]
+    data[:,ValidityLeft] = data[:,ValidityRight] = 1
+    return data
+
+
+def test_blink_is_removed_and_interpolated():
+    data = make_data()
+    expected = data[:,PupilLeft].copy()
+    # blink from 400 to 500 ms with a fast drop at the edges
+    blink = (data[:,TimeStamp] >= 400) & (data[:,TimeStamp] <= 500)
+    data[blink,ValidityLeft] = 0
+    data[blink,PupilLeft] = np.nan
+    data[np.flatnonzero(blink)[[0, -1]]+[-1, 1],PupilLeft] = 1.0
+    blinks = detect_blinks(data, 'L')
+    assert len(blinks) == 1
+    # the sample before the drop changes fast toward the next sample
+    np.testing.assert_allclose(blinks[0], (396.0, 108.0))
+    pupil = preprocess_pupil(data, 'L')
+    assert not np.isnan(pupil).any()
+    np.testing.assert_allclose(pupil, expected, atol=1e-3)
+
+
+def test_long_gap_is_not_interpolated():
+    data = make_data()
+    gap = (data[:,TimeStamp] >= 400) & (data[:,TimeStamp] < 1000)
+    data[gap,ValidityLeft] = 0
+    pupil = preprocess_pupil(data, 'L', padding=(0, 0), max_gap=300)
+    assert np.isnan(pupil[gap]).all()
+    assert not np.isnan(pupil[~gap]).any()
+    pupil = preprocess_pupil(data, 'L', padding=(0, 0), max_gap=700)
+    assert not np.isnan(pupil).any()
+
+
+def test_average_of_eyes_and_baseline():
+    data = make_data()
+    data[:100,ValidityRight] = 0
+    data[:100,PupilRight] = np.nan
+    pupil = preprocess_pupil(data, 'LR', padding=(0, 0), max_gap=0)
+    # only the left eye is available at the beginning
+    np.testing.assert_allclose(pupil[:100], data[:100,PupilLeft])
+    np.testing.assert_allclose(pupil[100:], (data[100:,PupilLeft]+data[100:,PupilRight])/2)
+
+    baseline = data[:10,PupilLeft].mean()
+    pupil = preprocess_pupil(data, 'L', baseline=(0, 18))
+    np.testing.assert_allclose(pupil[:10], data[:10,PupilLeft]-baseline)
+    pupil = preprocess_pupil(data, 'L', baseline=(0, 18), baseline_mode='divide')
+    assert pupil[4] == pytest.approx(data[4,PupilLeft]/baseline)
+    with pytest.raises(ValueError):
+        preprocess_pupil(data, 'L', baseline=(0, 18), baseline_mode='z')
+    with pytest.raises(ValueError):
+        preprocess_pupil(data, 'X')
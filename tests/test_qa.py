@@ -0,0 +1,107 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+import psychopy_tobii_controller.qa as qa
+from psychopy_tobii_controller.compression import open_text
+
+columns = ('TimeStamp\tGazePointXLeft\tGazePointYLeft\tPupilLeft\tValidityLeft\t'
+           'GazePointXRight\tGazePointYRight\tPupilRight\tValidityRight\tGazePointX\tGazePointY')
+
+
+def write_session(fp, t, lv, rv, events, device=None):
+    fp.write('Session Start\n')
+    fp.write(columns+('' if device is None else '\tDevice')+'\n')
+    for i in range(len(t)):
+        row = [t[i], 0.5, 0.5, 3.0, lv[i], 0.5, 0.5, 3.0, rv[i], 0.5, 0.5]
+        line = '%.1f\t%.4f\t%.4f\t%.4f\t%d\t%.4f\t%.4f\t%.4f\t%d\t%.4f\t%.4f' % tuple(row)
+        fp.write(line+('' if device is None else '\t%d' % device[i])+'\n')
+    fp.write('TimeStamp\tEvent\n')
+    for e in events:
+        fp.write('%.1f\t%s\n' % e)
+    fp.write('Session End\n\n')
+
+
+def make_file(filename, summary=None):
+    t = np.arange(100)*2.0
+    lv = np.ones(100, dtype=int)
+    rv = np.ones(100, dtype=int)
+    # drop 2 samples and lose both eyes for 10 samples
+    t[50:] += 4.0
+    lv[70:80] = rv[70:80] = 0
+    rv[90:] = 0
+    fp = open_text(filename, 'w')
+    fp.write('Recording date:\t2026/01/01\nEvent recording mode:\tSeparated\n\n')
+    write_session(fp, t, lv, rv, [(10.0, 'a'), (20.0, 'b')])
+    # empty session
+    write_session(fp, [], [], [], [(0.0, 'c')])
+    write_session(fp, np.arange(10)*2.0, np.ones(10), np.zeros(10), [])
+    if summary is not None:
+        qa.write_summary(fp, [summary])
+    fp.close()
+
+
+def check_first_session(s):
+    assert s['session'] == 0 and s['device'] == ''
+    assert s['samples'] == 100 and s['events'] == 2
+    assert s['duration'] == 202.0
+    assert s['max_interval'] == 6.0
+    # from the last valid sample before the loss to the first valid sample after
+    assert s['longest_gap'] == 22.0
+    assert s['data_loss'] == 10.0
+    assert s['data_loss_left'] == 10.0
+    assert s['data_loss_right'] == 20.0
+    assert s['rate'] == pytest.approx(99/202.0*1000)
+    assert s['interval_mean'] == pytest.approx(202.0/99)
+
+
+@pytest.mark.parametrize('ext', ['tsv', 'tsv.gz'])
+def test_summarize_file(tmp_path, monkeypatch, ext):
+    # process samples in several chunks
+    monkeypatch.setattr(qa, 'chunk_size', 16)
+    filename = str(tmp_path/('data.'+ext))
+    make_file(filename)
+    summaries = qa.summarize_file(filename)
+    # sessions without samples are skipped but are not counted
+    assert [s['session'] for s in summaries] == [0, 1]
+    check_first_session(summaries[0])
+    assert summaries[1]['samples'] == 10 and summaries[1]['data_loss_right'] == 100.0
+
+
+def test_devices(tmp_path):
+    filename = str(tmp_path/'data.tsv')
+    t = np.repeat(np.arange(10)*2.0, 2)
+    fp = open_text(filename, 'w')
+    fp.write('Event recording mode:\tSeparated\n\n')
+    write_session(fp, t, np.ones(20), np.ones(20), [(1.0, 'a')], device=np.tile([0, 1], 10))
+    fp.close()
+    summaries = qa.summarize_file(filename)
+    assert [(s['device'], s['samples'], s['events']) for s in summaries] == [('0', 10, 1), ('1', 10, 1)]
+
+
+def test_written_summary(tmp_path):
+    filename = str(tmp_path/'data.tsv')
+    accumulator = qa.session_summary()
+    accumulator.add([0.0, 2.0, 4.0], [1, 1, 0], [1, 0, 0])
+    summary = accumulator.result()
+    summary['session'] = 0
+    summary['device'] = ''
+    make_file(filename, summary=summary)
+    summaries = qa.read_summary(filename)
+    assert summaries == [summary]
+    assert qa.summarize_file(filename) == summaries
+    # summaries are skipped when the data are read
+    check_first_session(qa.summarize_file(filename, use_summary=False)[0])
+    make_file(filename)
+    assert qa.read_summary(filename) is None
+
+
+def test_round_timestamps():
+    t = np.array([12.35, 0.15, 1.25, 7.04, -0.05, 1234.5678])
+    np.testing.assert_array_equal(qa.round_timestamps(t), [float('%.1f' % v) for v in t])
@@ -0,0 +1,88 @@
+#
+# Tobii controller for PsychoPy
+# 
+# author: Hiroyuki Sogo
+# Distributed under the terms of the GNU General Public License v3 (GPLv3).
+# 
+
+import numpy as np
+import pytest
+
+from psychopy_tobii_controller.constants import *
+from psychopy_tobii_controller.utility import convert_gaze_units
+
+info = {'Recording resolution': '1920 x 1080',
+        'Coordinate system': 'PsychoPy',
+        'Window units': 'height',
+        'Monitor width': '53.0',
+        'Viewing distance': '57.0',
+        'Monitor resolution': '1920 x 1080'}
+
+
+def make_data():
+    data = np.zeros((3, 11))
+    data[:,GazePointXLeft] = [0.0, 0.5, -0.5]
+    data[:,GazePointYLeft] = [0.0, 0.25, -0.5]
+    data[:,GazePointXRight] = [0.1, 0.5, np.nan]
+    data[:,GazePointYRight] = [0.0, 0.25, np.nan]
+    data[:,ValidityLeft] = 1
+    data[:,ValidityRight] = [1, 1, 0]
+    data[:,GazePointX] = [0.05, 0.5, -0.5]
+    data[:,GazePointY] = [0.0, 0.25, -0.5]
+    return data
+
+
+def test_simple_units():
+    data = make_data()
+    pix = convert_gaze_units(data, info, 'pix')
+    np.testing.assert_allclose(pix[:,GazePointXLeft], [0.0, 540.0, -540.0])
+    np.testing.assert_allclose(pix[:,GazePointYLeft], [0.0, 270.0, -540.0])
+    # average of eyes is recalculated
+    np.testing.assert_allclose(pix[:,GazePointX], [54.0, 540.0, -540.0])
+    norm = convert_gaze_units(data, info, 'norm')
+    np.testing.assert_allclose(norm[1,[GazePointXLeft, GazePointYLeft]], [0.5625, 0.5])
+    raw = convert_gaze_units(data, info, 'raw')
+    np.testing.assert_allclose(raw[2,[GazePointXLeft, GazePointYLeft]], [0.21875, 1.0])
+    # input is not modified
+    assert data[1,GazePointXLeft] == 0.5
+    assert convert_gaze_units(data, info, 'psychopy') is not data
+
+
+def test_round_trip():
+    data = make_data()
+    for units in ('raw', 'pix', 'norm', 'cm', 'deg', 'degFlat'):
+        converted = convert_gaze_units(data, info, units)
+        converted_info = dict(info, **{'Data units': units})
+        back = convert_gaze_units(converted, converted_info, 'psychopy')
+        np.testing.assert_allclose(back, data, atol=1e-12)
+
+
+def test_raw_data_file():
+    data = np.zeros((1, 11))
+    data[0,[GazePointXLeft, GazePointYLeft, GazePointXRight, GazePointYRight]] = [1.0, 0.0, 0.5, 0.5]
+    data[0,[ValidityLeft, ValidityRight]] = 1
+    raw_info = dict(info, **{'Coordinate system': 'Raw'})
+    pix = convert_gaze_units(data, raw_info, 'pix')
+    np.testing.assert_allclose(pix[0,[GazePointXLeft, GazePointYLeft]], [960.0, 540.0])
+    np.testing.assert_allclose(pix[0,[GazePointX, GazePointY]], [480.0, 270.0])
+
+
+def test_geometry():
+    data = make_data()
+    cm = convert_gaze_units(data, info, 'cm')
+    # 0.5 height = 540 pix = 540*53/1920 cm
+    assert cm[1,GazePointXLeft] == pytest.approx(540*53.0/1920)
+    # the resolution of the monitor is used to convert pixels to cm
+    scaled = dict(info, **{'Monitor resolution': '3840 x 2160'})
+    assert convert_gaze_units(data, scaled, 'cm')[1,GazePointXLeft] == pytest.approx(540*53.0/3840)
+    deg = convert_gaze_units(data, info, 'degFlat')
+    assert deg[1,GazePointXLeft] == pytest.approx(np.degrees(np.arctan(540*53.0/1920/57.0)))
+
+    no_geometry = dict(info)
+    del no_geometry['Viewing distance']
+    with pytest.raises(ValueError):
+        convert_gaze_units(data, no_geometry, 'deg')
+    with pytest.raises(ValueError):
+        convert_gaze_units(data, {'Recording resolution': '1920 x 1080'}, 'pix')
+    with pytest.raises(ValueError):
+        convert_gaze_units(data, info, 'inch')